@@ -41,19 +41,70 @@ XML
 _log = logging.getLogger('convirt')
 
 
-def monitorAllDomains(repo=None):
+def monitorAllDomains(repo=None, cgroupfs=False, pods=False):
     """
     Must not require root privileges.
+    If cgroupfs is True, scans the cgroup filesystem
+    instead of running systemctl.
+    If pods is True, also reports as stopped the rkt containers
+    whose pod is not running, checking all of them with one
+    rkt invocation.
+    With docker_api, the containers run through the Engine API, which
+    have no unit, are listed by the docker daemon.
     """
-    repo = command.Repo() if repo is None else repo
-    get_vm_uuids = functools.partial(runner.Runner.get_all, repo)
+    if cgroupfs:
+        get_vm_uuids = runner.Runner.get_all_from_cgroupfs
+    else:
+        repo = command.Repo() if repo is None else repo
+        get_vm_uuids = functools.partial(runner.Runner.get_all, repo)
+    if environ.current().docker_api:
+        get_vm_uuids = functools.partial(_with_docker_api, get_vm_uuids)
+    if pods:
+        get_vm_uuids = functools.partial(
+            _without_stopped_pods, get_vm_uuids, repo)
     monitoring.watchdog(get_vm_uuids)
 
 
+def _without_stopped_pods(get_vm_uuids, repo):
+    # the runtime modules are imported on demand, see runtime.py
+    from .runtimes import rkt
+    if not rkt.Rkt.available():
+        return list(get_vm_uuids())
+    try:
+        stopped = frozenset(rkt.Rkt.get_stopped(repo))
+    except (command.Failed, ValueError):
+        _log.warning('cannot list the rkt pods, not checking them',
+                     exc_info=True)
+        return list(get_vm_uuids())
+    return [rt_uuid for rt_uuid in get_vm_uuids() if rt_uuid not in stopped]
+
+
+def _with_docker_api(get_vm_uuids):
+    # containers run through the docker Engine API have no unit
+    from .runtimes import docker
+    return list(get_vm_uuids()) + docker.Docker.get_all()
+
+
+def watchDockerEvents():
+    """
+    Reports the docker containers which start or die as soon as the
+    daemon notices, through one subscription to its event stream,
+    instead of waiting for the next monitorAllDomains() scan.
+    """
+    from .runtimes import docker
+    docker.Docker.watch_events(monitoring.docker_event)
+
+
+def unwatchDockerEvents():
+    from .runtimes import docker
+    docker.Docker.unwatch_events()
+
+
 def recoveryAllDomains(repo=None):
     conf = environ.current()
     repo = command.Repo() if repo is None else repo
-    for rt_uuid in runner.Runner.get_all(repo):
+    _prefetch_pods(repo)
+    for rt_uuid in _recoverable(repo):
         _log.debug('trying to recover container %r', rt_uuid)
         xml_file = XMLFile(rt_uuid, conf)
         try:
@@ -66,6 +117,30 @@ def recoveryAllDomains(repo=None):
     return doms.get_all()
 
 
+def _recoverable(repo):
+    rt_uuids = runner.Runner.get_all(repo)
+    if environ.current().docker_api:
+        from .runtimes import docker
+        try:
+            rt_uuids.extend(docker.Docker.get_all())
+        except runner.OperationFailed:
+            _log.warning('cannot list the docker containers, '
+                         'not recovering them', exc_info=True)
+    return rt_uuids
+
+
+def _prefetch_pods(repo):
+    # one bulk query, instead of one per recovered container
+    from .runtimes import rkt
+    if not rkt.Rkt.available():
+        return
+    try:
+        rkt.Rkt.list_pods(repo)
+    except (command.Failed, ValueError):
+        _log.warning('cannot list the rkt pods, querying one by one',
+                     exc_info=True)
+
+
 def openConnection(uri, repo=None):
     if uri != 'convirt:///system':
         errors.throw()  # TODO: more specific error?
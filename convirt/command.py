@@ -24,12 +24,25 @@ Interaction with system commands.
 from __future__ import absolute_import
 
 import collections
+import functools
 import logging
 import os
 import os.path
 import shlex
 import subprocess
 import string
+import threading
+import time
+
+from six.moves import shlex_quote
+
+try:
+    import asyncio
+except ImportError:  # python 2
+    asyncio = None
+
+
+monotonic_time = getattr(time, 'monotonic', time.time)
 
 
 class NotFound(Exception):
@@ -56,7 +69,7 @@ class Path(object):
     @property
     def paths(self):
         if self._paths is None:
-            self._paths = self._find_paths()
+            return self._find_paths()
         return self._paths
 
     @property
@@ -71,8 +84,7 @@ class Path(object):
             return None
 
     def get(self):
-        if self._cmd is None:
-            self._cmd = self._which(self._name)
+        self._cmd = _resolve(self._name, tuple(self.paths))
         if self._cmd is None:
             raise NotFound(self._name)
         return self._cmd
@@ -84,12 +96,72 @@ class Path(object):
             paths = ''
         return paths.split(':')
 
-    def _which(self, name):
-        for path in self.paths:
-            cmd = os.path.join(path, self._name)
-            if os.access(cmd, os.X_OK):
-                return cmd
-        return None
+
+# how often a cached lookup is checked against the filesystem
+_CACHE_CHECK_INTERVAL = 1.  # seconds
+
+
+class _Resolved(object):
+
+    __slots__ = ('cmd', 'stamps', 'checked')
+
+    def __init__(self, cmd, stamps, checked):
+        self.cmd = cmd
+        # mtimes of the directories scanned to find `cmd`
+        self.stamps = stamps
+        self.checked = checked
+
+
+_cache_lock = threading.Lock()
+_cache = {}
+
+
+def _resolve(name, paths):
+    """
+    Process-wide cached lookup of `name` in `paths`. A cached result
+    is valid until any of the directories scanned to find it changes.
+    """
+    key = (name, paths)
+    now = monotonic_time()
+    with _cache_lock:
+        res = _cache.get(key)
+    if res is not None:
+        if now - res.checked < _CACHE_CHECK_INTERVAL:
+            return res.cmd
+        if res.stamps == _stamps(path for path, _ in res.stamps):
+            res.checked = now
+            return res.cmd
+    cmd, scanned = _which(name, paths)
+    res = _Resolved(cmd, _stamps(scanned), now)
+    with _cache_lock:
+        _cache[key] = res
+    return res.cmd
+
+
+def _which(name, paths):
+    scanned = []
+    for path in paths:
+        scanned.append(path)
+        cmd = os.path.join(path, name)
+        if os.access(cmd, os.X_OK):
+            return cmd, scanned
+    return None, scanned
+
+
+def _stamps(paths):
+    stamps = []
+    for path in paths:
+        try:
+            mtime = os.stat(path or '.').st_mtime
+        except OSError:
+            mtime = None
+        stamps.append((path, mtime))
+    return tuple(stamps)
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
 
 
 # TODO document the purpose
@@ -105,6 +177,18 @@ class Failed(Exception):
     command failed to execute
     """
 
+    def __init__(self, message, returncode=None, output=None):
+        super(Failed, self).__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+    @classmethod
+    def from_error(cls, exc):
+        """
+        Build from a subprocess.CalledProcessError.
+        """
+        return cls(str(exc), exc.returncode, exc.output)
+
 
 class NotAllowed(Exception):
     """
@@ -112,10 +196,321 @@ class NotAllowed(Exception):
     """
 
 
+class Template(object):
+    """
+    Command line template split into argv once, at creation time.
+    Each argument is stored as a sequence of literal chunks and
+    placeholder slots, so filling the template just joins strings.
+    """
+
+    def __init__(self, template):
+        self._args = tuple(
+            _parse_arg(arg) for arg in shlex.split(template)
+        )
+
+    def fill(self, mapping):
+        """
+        Build the argv from `mapping`. Values may be strings or,
+        for placeholders which are arguments on their own, lists
+        which are spliced into the argv.
+        Raises Unsafe if a value needs shell-like splitting.
+        """
+        argv = []
+        for arg in self._args:
+            if len(arg) == 1:
+                is_slot, text = arg[0]
+                if not is_slot:
+                    argv.append(text)
+                    continue
+                val = mapping[text]
+                if isinstance(val, list):
+                    argv.extend(val)
+                else:
+                    argv.append(_safe_value(val))
+                continue
+            chunks = []
+            for is_slot, text in arg:
+                if not is_slot:
+                    chunks.append(text)
+                    continue
+                val = mapping[text]
+                if isinstance(val, list):
+                    raise Unsafe(text)
+                chunks.append(_safe_value(val))
+            argv.append(''.join(chunks))
+        return argv
+
+
+class Unsafe(Exception):
+    """
+    template value requires the full shell-like splitting
+    """
+
+
+_SPECIAL_CHARS = frozenset(' \t\n\r\x0b\x0c\'"\\')
+
+
+def _safe_value(val):
+    val = '%s' % (val,)
+    if not val or not _SPECIAL_CHARS.isdisjoint(val):
+        raise Unsafe(val)
+    return val
+
+
+def _parse_arg(arg):
+    chunks = []
+    pos = 0
+    for match in string.Template.pattern.finditer(arg):
+        start, end = match.span()
+        if start > pos:
+            chunks.append((False, arg[pos:start]))
+        pos = end
+        if match.group('escaped') is not None:
+            chunks.append((False, string.Template.delimiter))
+        elif match.group('invalid') is not None:
+            raise ValueError('invalid placeholder in %r' % arg)
+        else:
+            name = match.group('named') or match.group('braced')
+            chunks.append((True, name))
+    if pos < len(arg):
+        chunks.append((False, arg[pos:]))
+    if not chunks:
+        chunks.append((False, ''))
+    return tuple(chunks)
+
+
+class ReadOnly(str):
+    """
+    Marks a template as read-only: the command has no side effects,
+    so concurrent identical invocations can share one execution.
+    """
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls: while a call for a key
+    is in flight, later callers wait for it and share its outcome.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def call(self, key, func, *args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+        if leader:
+            try:
+                flight.result = func(*args)
+            except Exception as exc:
+                flight.error = exc
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stream(self, key, func, *args):
+        """
+        Like call, but `func` returns an iterator, which the leader
+        consumes lazily while yielding its items. The items are kept
+        until the flight lands, so the other callers get all of them.
+        The flight takes off when the iteration begins, and lands when
+        the leader is done iterating: the others wait for it, so the
+        leader should not do slow work, or anything which could join
+        the same flight, between the items.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                flight.result = []
+                self._flights[key] = flight
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            for item in flight.result:
+                yield item
+            return
+        try:
+            items = func(*args)
+            for item in items:
+                flight.result.append(item)
+                yield item
+        except GeneratorExit:
+            # the leader stopped early, the others still need the rest
+            try:
+                flight.result.extend(items)
+            except Exception as exc:
+                flight.error = exc
+            raise
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+_flights = SingleFlight()
+
+
+LimiterStats = collections.namedtuple(
+    'LimiterStats', ['limit', 'running', 'waiting',
+                     'waited', 'wait_time_total', 'wait_time_max'])
+
+
+class Limiter(object):
+    """
+    Bounds the number of commands running concurrently.
+    Callers exceeding the limit wait in FIFO order; threads and
+    asyncio callers (see acquire_async) share the same queue.
+    """
+
+    def __init__(self, limit):
+        if limit < 1:
+            raise ValueError('limit must be positive, got %r' % limit)
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._running = 0
+        self._waited = 0
+        self._wait_time_total = 0.
+        self._wait_time_max = 0.
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def acquire(self):
+        with self._lock:
+            if self._running < self._limit and not self._queue:
+                self._running += 1
+                return
+            slot = threading.Event()
+            self._queue.append(slot)
+        start = monotonic_time()
+        slot.wait()
+        # release() handed its slot over to us, _running is unchanged
+        self._waited_for(monotonic_time() - start)
+
+    def acquire_async(self, loop):
+        """
+        Like acquire, but doesn't block: returns a future of `loop`,
+        resolved once the caller got a slot. Cancelling the future
+        gives up the slot, even if it was already handed over.
+        """
+        slot = _AsyncSlot(self, loop)
+        with self._lock:
+            if self._running < self._limit and not self._queue:
+                self._running += 1
+                slot.future.set_result(None)
+            else:
+                self._queue.append(slot)
+        return slot.future
+
+    def _waited_for(self, elapsed):
+        with self._lock:
+            self._waited += 1
+            self._wait_time_total += elapsed
+            self._wait_time_max = max(self._wait_time_max, elapsed)
+
+    def release(self):
+        with self._lock:
+            if self._queue:
+                self._queue.popleft().set()
+            else:
+                self._running -= 1
+
+    def stats(self):
+        with self._lock:
+            return LimiterStats(
+                limit=self._limit,
+                running=self._running,
+                waiting=len(self._queue),
+                waited=self._waited,
+                wait_time_total=self._wait_time_total,
+                wait_time_max=self._wait_time_max,
+            )
+
+
+class _AsyncSlot(object):
+    """
+    A place in the Limiter queue for an asyncio caller. Like the
+    threading.Event used by the threads, release() sets it from
+    any thread; the future is resolved in its loop.
+    """
+
+    def __init__(self, limiter, loop):
+        self._limiter = limiter
+        self._loop = loop
+        self._start = monotonic_time()
+        self.future = asyncio.Future(loop=loop)
+
+    def set(self):
+        self._loop.call_soon_threadsafe(self._granted)
+
+    def _granted(self):
+        if self.future.cancelled():
+            # nobody wants it anymore, pass it on
+            self._limiter.release()
+            return
+        self._limiter._waited_for(monotonic_time() - self._start)
+        self.future.set_result(None)
+
+
+class _Unlimited(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_UNLIMITED = _Unlimited()
+
+
 class Command(object):
+    """
+    Values passed when calling the command fill the template
+    placeholders. Command values are expanded to their command line,
+    list values are expanded to one argument per item.
+    """
 
     _log = logging.getLogger('command')
 
+    # blocking commands can be coalesced, see ReadOnly
+    blocking = True
+
+    limiter = None
+
     @classmethod
     def from_name(cls, name, template, **kwargs):
         return cls(Path(name), template, **kwargs)
@@ -123,23 +518,55 @@ class Command(object):
     def __init__(self, path, template, **kwargs):
         self.ident = '*'
         self._path = path
+        self._read_only = isinstance(template, ReadOnly)
         tmpl = string.Template(template)
         self._template = string.Template(tmpl.safe_substitute(**kwargs))
+        try:
+            self._compiled = Template(self._template.template)
+        except ValueError:
+            # unbalanced quotes or bad placeholders: let substitute()
+            # and shlex report the error when the command is used.
+            self._compiled = None
 
     @property
     def path(self):
         return self._path.cmd
 
+    @property
+    def read_only(self):
+        return self._read_only
+
     def argv(self, **kwargs):
         return self.path + ' ' + self._template.substitute(**kwargs)
 
     def cmdline(self, **kwargs):
+        path = self.path
+        if (self._compiled is None or path is None or
+                not _SPECIAL_CHARS.isdisjoint(path)):
+            return self._cmdline_slow(**kwargs)
+        args = {}
+        for key, val in kwargs.items():
+            if isinstance(val, Command):
+                ctx = kwargs.copy()
+                ctx.pop(key)
+                val = val.cmdline(**ctx)
+            args[key] = val
+        try:
+            argv = self._compiled.fill(args)
+        except Unsafe:
+            return self._cmdline_slow(**kwargs)
+        argv.insert(0, path)
+        return argv
+
+    def _cmdline_slow(self, **kwargs):
         args = {}
         for key, val in kwargs.items():
             if isinstance(val, Command):
                 ctx = kwargs.copy()
                 ctx.pop(key)
                 val = val.argv(**ctx)
+            elif isinstance(val, list):
+                val = ' '.join(shlex_quote(item) for item in val)
             args[key] = val
         optstr = self.argv(**args)
         return shlex.split(optstr)
@@ -148,7 +575,43 @@ class Command(object):
         cmd = self.cmdline(**kwargs)
         if not self.allowed(cmd):
             raise NotAllowed(cmd)
-        return self._execute(cmd)
+        if self.read_only and self.blocking:
+            return _flights.call(
+                (self.__class__, tuple(cmd)), self._run, cmd
+            )
+        return self._run(cmd)
+
+    def stream(self, **kwargs):
+        """
+        Like calling the command, but returns an iterator over the
+        lines of the output, without the line terminators. Backends
+        which support it read the output while the command runs.
+        Like calls, concurrent streams of read only commands are
+        coalesced: the lines are kept until the command ends.
+        The command, its limiter slot and the coalesced stream are held
+        until the iteration ends, so consume the lines promptly.
+        """
+        cmd = self.cmdline(**kwargs)
+        if not self.allowed(cmd):
+            raise NotAllowed(cmd)
+        if self.read_only and self.blocking:
+            return _flights.stream(
+                (self.__class__, tuple(cmd), 'stream'), self._stream, cmd
+            )
+        return self._stream(cmd)
+
+    def _run(self, argv):
+        with self._limited():
+            return self._execute(argv)
+
+    def _limited(self):
+        return _UNLIMITED if self.limiter is None else self.limiter
+
+    def _stream(self, argv):
+        out = self._run(argv)
+        if isinstance(out, bytes):
+            out = out.decode('utf-8')
+        return iter(out.splitlines())
 
     def allowed(self, argv):
         return True
@@ -180,15 +643,213 @@ class SubProcCommand(Command):
         try:
             return subprocess.check_output(argv)
         except subprocess.CalledProcessError as exc:
-            raise Failed(str(exc))
+            raise Failed.from_error(exc)
         finally:
             self._log.debug('%s called %r',
                             self.ident, argv)
 
+    def _stream(self, argv):
+        self._log.debug('%s streaming %r',
+                        self.ident, argv)
+        with self._limited():
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+            try:
+                for line in proc.stdout:
+                    yield line.decode('utf-8').rstrip('\n')
+            finally:
+                proc.stdout.close()
+                retcode = proc.wait()
+                self._log.debug('%s streamed %r',
+                                self.ident, argv)
+        if retcode != 0:
+            raise Failed(
+                'Command %r returned non-zero exit status %i' % (
+                    argv, retcode),
+                retcode)
+
+
+class SpawnCommand(Command):
+    """
+    Runs the command using posix_spawn, avoiding to duplicate
+    the address space of the (possibly big) calling process.
+    The child gets a pipe for stdout and the descriptors listed
+    in pass_fds, and, like with any exec, inherits every descriptor
+    without the close-on-exec flag: stdin and stderr, and the ones
+    made inheritable (python creates them non-inheritable).
+    Requires python >= 3.8.
+    """
+
+    pass_fds = ()
+
+    def _execute(self, argv):
+        self._log.debug('%s spawning %r',
+                        self.ident, argv)
+        rfd, wfd = os.pipe()
+        actions = [
+            (os.POSIX_SPAWN_CLOSE, rfd),
+            (os.POSIX_SPAWN_DUP2, wfd, 1),
+            (os.POSIX_SPAWN_CLOSE, wfd),
+        ]
+        actions.extend(
+            (os.POSIX_SPAWN_DUP2, fd, fd) for fd in self.pass_fds
+        )
+        try:
+            pid = os.posix_spawn(argv[0], argv, os.environ,
+                                 file_actions=actions)
+        except Exception:
+            os.close(rfd)
+            raise
+        finally:
+            os.close(wfd)
+        try:
+            with os.fdopen(rfd, 'rb') as src:
+                out = src.read()
+        finally:
+            # never leave a zombie behind
+            _, status = os.waitpid(pid, 0)
+        self._log.debug('%s spawned %r',
+                        self.ident, argv)
+        if os.WIFSIGNALED(status):
+            retcode = -os.WTERMSIG(status)
+        else:
+            retcode = os.WEXITSTATUS(status)
+        if retcode != 0:
+            exc = subprocess.CalledProcessError(retcode, argv, out)
+            raise Failed.from_error(exc)
+        return out
+
+
+def spawn_available():
+    return hasattr(os, 'posix_spawn')
+
+
+class AsyncSubProcCommand(Command):
+    """
+    Runs the command using asyncio subprocesses. Calling the command
+    does not block: it returns a future, resolved with the command
+    output, or failed with Failed if the command exits with error.
+    Cancelling the future kills the command.
+    If the command has a limiter, the command waits for a slot
+    without blocking the loop, and keeps it until the future is done.
+    Must be called from code running inside the event loop.
+    Requires python >= 3.4.2.
+    """
+
+    blocking = False
+
+    def _run(self, argv):
+        # the limiter is taken by the future, see _execute
+        return self._execute(argv)
+
+    def _execute(self, argv):
+        loop = asyncio.get_event_loop()
+        res = asyncio.Future(loop=loop)
+        if self.limiter is None:
+            self._spawn(argv, loop, res)
+            return res
+        gate = self.limiter.acquire_async(loop)
+        gate.add_done_callback(
+            functools.partial(self._admitted, argv, loop, res)
+        )
+        # cancelling a command still waiting gives up its place
+        res.add_done_callback(lambda _: gate.cancel())
+        return res
+
+    def _admitted(self, argv, loop, res, gate):
+        if gate.cancelled():
+            return  # see _execute
+        limiter = self.limiter
+        res.add_done_callback(lambda _: limiter.release())
+        if not res.done():
+            self._spawn(argv, loop, res)
+
+    def _spawn(self, argv, loop, res):
+        self._log.debug('%s calling %r (async)',
+                        self.ident, argv)
+        spawn = loop.create_task(
+            asyncio.create_subprocess_exec(
+                *argv, stdout=subprocess.PIPE
+            )
+        )
+        spawn.add_done_callback(
+            functools.partial(self._spawned, argv, loop, res)
+        )
+        res.add_done_callback(
+            functools.partial(self._finished, argv, loop, spawn)
+        )
+
+    def _spawned(self, argv, loop, res, spawn):
+        if res.done():
+            return  # cancelled, see _finished
+        if spawn.cancelled():
+            res.cancel()
+            return
+        exc = spawn.exception()
+        if exc is not None:
+            res.set_exception(exc)
+            return
+        proc = spawn.result()
+        comm = loop.create_task(proc.communicate())
+        comm.add_done_callback(
+            functools.partial(self._done, argv, proc, res)
+        )
+
+    def _finished(self, argv, loop, spawn, res):
+        if not res.cancelled():
+            return
+        if not spawn.done():
+            spawn.cancel()
+            return
+        if spawn.cancelled() or spawn.exception() is not None:
+            return
+        proc = spawn.result()
+        if proc.returncode is not None:
+            return
+        self._log.debug('%s killing %r (async)',
+                        self.ident, argv)
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass  # exited meanwhile
+        # reap it
+        loop.create_task(proc.wait())
+
+    def _done(self, argv, proc, res, comm):
+        self._log.debug('%s called %r (async)',
+                        self.ident, argv)
+        if res.cancelled():
+            return
+        if comm.cancelled():
+            res.cancel()
+            return
+        exc = comm.exception()
+        if exc is not None:
+            res.set_exception(exc)
+            return
+        out, _ = comm.result()
+        if proc.returncode != 0:
+            exc = subprocess.CalledProcessError(proc.returncode, argv, out)
+            res.set_exception(Failed.from_error(exc))
+        else:
+            res.set_result(out)
+
+
+_default_class = SubProcCommand
+
+
+def set_default_class(cls):
+    """
+    Sets the command class used by the Repos created without an
+    explicit default; None restores SubProcCommand.
+    """
+    global _default_class
+    _default_class = SubProcCommand if cls is None else cls
+
 
 class Repo(object):
 
-    def __init__(self, cmds=None, execs=None, default=SubProcCommand):
+    def __init__(self, cmds=None, execs=None, default=None,
+                 limits=None):
         self._cmds = collections.defaultdict(lambda: default)
         if cmds is not None:
             self.update(cmds)
@@ -197,6 +858,11 @@ class Repo(object):
         }
         if execs is not None:
             self._execs.update(execs)
+        self._limiters = {}
+        if limits is not None:
+            self._limiters.update(
+                (name, Limiter(limit)) for name, limit in limits.items()
+            )
 
     def __nonzero__(self):
         return bool(self._cmds)
@@ -204,11 +870,19 @@ class Repo(object):
     def __repr__(self):
         return repr(self._cmds)
 
+    @property
+    def limiters(self):
+        return self._limiters.copy()
+
     def update(self, cmds):
         self._cmds.update(cmds)
 
     def get(self, name, template, **kwargs):
         cls = self._cmds[name]
+        if cls is None:
+            cls = _default_class
         path = self._execs[name]
         # TODO: KeyError?
-        return cls(path, template, **kwargs)
+        cmd = cls(path, template, **kwargs)
+        cmd.limiter = self._limiters.get(name)
+        return cmd
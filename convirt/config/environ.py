@@ -45,6 +45,23 @@ _ENV = Environment(
     tools_dir='/usr/libexec/convirt',
     run_dir='/run/convirt',
     cgroup_slice='convirt',  # XXX: or 'machine' ?
+    # resources accounted for the containers, see runner.ACCOUNTING_PROFILES
+    accounting='full',
+    # 'transient' units, or 'instance's of the convirt@.service template
+    unit_mode='transient',
+    # where the template unit is installed
+    unit_dir='/run/systemd/system',
+    # start the containers without waiting for them to be up
+    async_start=False,
+    # run the commands through the helper process, see convirt.helper
+    use_helper=False,
+    # talk to the docker daemon instead of running the docker CLI
+    docker_api=False,
+    docker_socket='/var/run/docker.sock',
+    # runtime name -> runtimes.WaitPolicy, overriding the runtime's own
+    wait_policies={},
+    # runtimes.fake.Behavior of the fake runtime, None for its default
+    fake_behavior=None,
 )
 
 
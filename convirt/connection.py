@@ -62,13 +62,15 @@ class Connection(object):
 
     def lookupByUUIDString(self, guid):
         self._log.debug('looking for container %r', guid)
-        try:
-            dom = doms.get_by_uuid(guid)
-        except KeyError:
-            errors.throw(code=libvirt.VIR_ERR_NO_DOMAIN)
-        else:
-            self._log.debug('found container %r', guid)
-            return dom
+        for get in (doms.get_by_uuid, doms.get_pending, doms.get_defined):
+            try:
+                dom = get(guid)
+            except KeyError:
+                continue
+            else:
+                self._log.debug('found container %r', guid)
+                return dom
+        errors.throw(code=libvirt.VIR_ERR_NO_DOMAIN)
 
     def lookupByID(self, intid):
         # hack?
@@ -86,6 +88,10 @@ class Connection(object):
         conf = config.environ.current()
         return domain.Domain.create(domxml, conf=conf, repo=self._repo)
 
+    def defineXML(self, domxml):
+        conf = config.environ.current()
+        return domain.Domain.define(domxml, conf=conf, repo=self._repo)
+
     def getLibVersion(self):
         return 0x001002018  # TODO
 
@@ -0,0 +1,267 @@
+#
+# Copyright 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+"""
+Minimal client for the Docker Engine API.
+
+Talks HTTP/1.1 over the unix socket of the daemon, keeping a small
+pool of persistent connections, so each operation costs one round
+trip instead of spawning the docker CLI.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import json
+import logging
+import socket
+import threading
+
+from six.moves import http_client
+from six.moves.urllib.parse import quote, urlencode
+
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+API_VERSION = '1.24'
+
+
+class Error(Exception):
+    """
+    the daemon rejected the request, or could not be reached
+    """
+
+    def __init__(self, message, status=None):
+        super(Error, self).__init__(message)
+        self.status = status
+
+
+class NotFound(Error):
+    """
+    no such container, or image
+    """
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http_client.HTTPConnection.__init__(self, 'localhost')
+        self._path = path
+        self._timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self._timeout is not None:
+            sock.settimeout(self._timeout)
+        sock.connect(self._path)
+        self.sock = sock
+
+
+class Client(object):
+
+    _log = logging.getLogger('convirt.dockerapi')
+
+    def __init__(self, path=DEFAULT_SOCKET, pool_size=4, timeout=30.):
+        self._path = path
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._pool = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    def close(self):
+        with self._lock:
+            conns = list(self._pool)
+            self._pool.clear()
+        for conn in conns:
+            conn.close()
+
+    def create(self, name, image, **config):
+        """
+        Creates a container, returns its ID. `config` is merged
+        in the request, e.g. HostConfig={'Memory': size}.
+        """
+        body = {'Image': image}
+        body.update(config)
+        res = self.request(
+            'POST', '/containers/create', body=body, params={'name': name})
+        return res['Id']
+
+    def start(self, container):
+        self.request('POST', '/containers/%s/start' % quote(container))
+
+    def stop(self, container, timeout=10):
+        self.request('POST', '/containers/%s/stop' % quote(container),
+                     params={'t': timeout})
+
+    def remove(self, container, force=False):
+        self.request('DELETE', '/containers/%s' % quote(container),
+                     params={'force': int(force)})
+
+    def inspect(self, container):
+        return self.request('GET', '/containers/%s/json' % quote(container))
+
+    def list(self, filters=None):
+        """
+        Returns the running containers matching `filters`, e.g.
+        {'name': ['foo']}, as the summaries the daemon sends.
+        """
+        params = {'filters': json.dumps(filters)} if filters else None
+        return self.request('GET', '/containers/json', params=params)
+
+    def events(self, filters=None):
+        """
+        Subscribes to the event stream of the daemon. Returns an
+        EventStream, which yields the events as dicts as soon as the
+        daemon sends them, on a connection of its own.
+        """
+        path = '/v%s/events' % API_VERSION
+        if filters:
+            path += '?' + urlencode({'filters': json.dumps(filters)})
+        conn = UnixHTTPConnection(self._path)
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+        except (socket.error, http_client.HTTPException) as exc:
+            conn.close()
+            raise Error('GET /events: %s' % exc)
+        if resp.status != 200:
+            reply = resp.read()
+            conn.close()
+            raise Error(_message(reply), resp.status)
+        return EventStream(conn, resp)
+
+    def request(self, method, url, body=None, params=None):
+        """
+        Performs one request, returns the decoded JSON reply,
+        or None if the reply is empty.
+        """
+        path = '/v%s%s' % (API_VERSION, url)
+        if params:
+            path += '?' + urlencode(sorted(params.items()))
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        conn, reused = self._acquire()
+        try:
+            status, reply, reusable = self._roundtrip(
+                conn, method, path, data, headers)
+        except (socket.error, http_client.HTTPException) as exc:
+            conn.close()
+            if not reused:
+                raise Error('%s %s: %s' % (method, url, exc))
+            # the daemon closed an idle connection: try once on a new one
+            self._log.debug('stale connection, retrying %s %s', method, url)
+            conn, _ = self._acquire(fresh=True)
+            try:
+                status, reply, reusable = self._roundtrip(
+                    conn, method, path, data, headers)
+            except (socket.error, http_client.HTTPException) as exc:
+                conn.close()
+                raise Error('%s %s: %s' % (method, url, exc))
+        self._release(conn, reusable)
+
+        if status == 404:
+            raise NotFound(_message(reply), status)
+        if status >= 400:
+            raise Error(_message(reply), status)
+        if not reply:
+            return None
+        return json.loads(reply.decode('utf-8'))
+
+    def _roundtrip(self, conn, method, path, data, headers):
+        conn.request(method, path, body=data, headers=headers)
+        resp = conn.getresponse()
+        reply = resp.read()
+        return resp.status, reply, not resp.will_close
+
+    def _acquire(self, fresh=False):
+        if not fresh:
+            with self._lock:
+                if self._pool:
+                    return self._pool.pop(), True
+        return UnixHTTPConnection(self._path, self._timeout), False
+
+    def _release(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                if len(self._pool) < self._pool_size:
+                    self._pool.append(conn)
+                    return
+        conn.close()
+
+
+class EventStream(object):
+
+    # py3 reads whatever the daemon sent; py2 lacks read1()
+    _READ_SIZE = 4096
+
+    def __init__(self, conn, resp):
+        self._conn = conn
+        self._resp = resp
+        self._closed = False
+
+    def __iter__(self):
+        read = getattr(self._resp, 'read1', None)
+        if read is None:
+            def read(_):
+                return self._resp.read(1)
+        buf = b''
+        while not self._closed:
+            try:
+                data = read(self._READ_SIZE)
+            except (socket.error, http_client.HTTPException,
+                    ValueError) as exc:
+                if self._closed:
+                    return
+                raise Error('event stream: %s' % exc)
+            if not data:
+                return
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+    def close(self):
+        """
+        Ends the subscription. Can be called from another thread,
+        to wake up a reader waiting for the next event.
+        """
+        self._closed = True
+        sock = self._conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # already disconnected
+        self._conn.close()
+
+
+def _message(reply):
+    try:
+        return json.loads(reply.decode('utf-8'))['message']
+    except (ValueError, KeyError, TypeError):
+        return reply.decode('utf-8', 'replace').strip()
@@ -44,7 +44,17 @@ class Domain(object):
     def create(cls, xmldesc, conf, repo):  # FIXME
         inst = cls(xmldesc, conf=conf, repo=repo)
         inst._startup()
-        doms.add(inst)
+        return inst
+
+    @classmethod
+    def define(cls, xmldesc, conf, repo):  # FIXME
+        """
+        Creates the container, doing ahead of time all the work the
+        runtime allows, but does not start it: use createWithFlags().
+        """
+        inst = cls(xmldesc, conf=conf, repo=repo)
+        inst._prepare()
+        doms.add_defined(inst)
         return inst
 
     @classmethod
@@ -57,6 +67,7 @@ class Domain(object):
     def __init__(self, xmldesc, conf, repo,
                  rt_uuid=None):  # FIXME
         self._xmldesc = xmldesc
+        self._conf = conf
         self._root = ET.fromstring(xmldesc)
         self._vm_uuid = uuid.UUID(self._root.find('./uuid').text)
         rt_name = _find_container_type(self._root)
@@ -76,6 +87,27 @@ class Domain(object):
         #  flags are unused
         vm_uuid = self.UUIDString()
 
+        try:
+            doms.remove_defined(vm_uuid)
+        except KeyError:
+            pass  # not defined, or already started
+        else:
+            self._log.debug('discarding defined container %r', vm_uuid)
+            self._discard()
+            return
+
+        try:
+            doms.remove_pending(vm_uuid)
+        except KeyError:
+            pass  # not starting
+        else:
+            self._log.debug('shutting down starting container %r', vm_uuid)
+            try:
+                self._shutdown()
+            except runner.OperationFailed:
+                errors.throw()  # FIXME: specific error
+            return
+
         self._log.debug('shutting down container %r', vm_uuid)
         try:
             self._shutdown()
@@ -88,6 +120,18 @@ class Domain(object):
     def destroy(self):
         return self.destroyFlags(0)
 
+    def createWithFlags(self, flags):
+        #  flags are unused
+        self._log.debug('starting defined container %r', self.UUIDString())
+        try:
+            self._launch()
+        except runner.OperationFailed:
+            errors.throw()  # FIXME: specific error
+        try:
+            doms.remove_defined(self.UUIDString())
+        except KeyError:
+            pass  # created without being defined first
+
     def reset(self, flags):
         self._log.debug('resetting container %r', self.UUIDString())
         self._rt.stop()
@@ -127,6 +171,16 @@ class Domain(object):
         return [[], []]
 
     def _startup(self):
+        self._configure()
+        self._launch()
+
+    def _prepare(self):
+        self._configure()
+        self._log.debug('preparing container %r', self.UUIDString())
+        self._rt.prepare()
+        self._log.debug('prepared container %r', self.UUIDString())
+
+    def _configure(self):
         self._log.debug('clearing XML cache for %r', self.UUIDString())
         self._xml_file.clear()
         self._log.debug('setting up container %r', self.UUIDString())
@@ -135,9 +189,46 @@ class Domain(object):
         self._rt.configure(self._root)
         self._log.debug('saving domain XML for %r', self.UUIDString())
         self._xml_file.save(self._root)
+
+    def _launch(self):
+        """
+        Starts the container and registers the domain; if the start
+        is asynchronous, the domain is pending until _started().
+        """
         self._log.debug('starting container %r', self.UUIDString())
-        self._rt.start()
-        self._log.debug('started container %r', self.UUIDString())
+        if self._conf.async_start:
+            # before starting: _started() may run before start_async returns
+            doms.add_pending(self)
+            try:
+                self._rt.start_async(self._started)
+            except Exception:
+                doms.remove_pending(self.UUIDString())
+                raise
+        else:
+            self._rt.start()
+            self._log.debug('started container %r', self.UUIDString())
+            doms.add(self)
+
+    def _started(self, error):
+        vm_uuid = self.UUIDString()
+        try:
+            doms.remove_pending(vm_uuid)
+        except KeyError:
+            self._log.debug('container %r destroyed while starting',
+                            vm_uuid)
+            return
+        if error is None:
+            self._log.debug('started container %r', vm_uuid)
+            doms.add(self)
+            event = (libvirt.VIR_DOMAIN_EVENT_STARTED,
+                     libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED)
+        else:
+            self._log.warning('container %r failed to start: %s',
+                              vm_uuid, error)
+            event = (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED)
+        self.events.fire(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                         self, *event)
 
     def _resync(self):
         self._log.debug('resyncing container %r', self.UUIDString())
@@ -152,6 +243,11 @@ class Domain(object):
         self._xml_file.clear()
         self._log.debug('turn down container %r', self.UUIDString())
 
+    def _discard(self):
+        self._rt.teardown()
+        self._xml_file.clear()
+        self._log.debug('discarded container %r', self.UUIDString())
+
     def __getattr__(self, name):
         # virDomain does not expose non-callable attributes.
         return self._fake_method
@@ -54,7 +54,49 @@ def remove(vm_uuid):
         del _doms[vm_uuid]
 
 
+# defined, but not yet started, domains. They are not running, so they
+# are kept apart from the others, and the watchdog ignores them.
+_defined = {}
+
+
+def add_defined(dom):
+    with _lock:
+        _defined[dom.UUIDString()] = dom
+
+
+def get_defined(vm_uuid):
+    with _lock:
+        return _defined[str(vm_uuid)]
+
+
+def remove_defined(vm_uuid):
+    with _lock:
+        del _defined[vm_uuid]
+
+
+# domains started asynchronously, not yet up: the watchdog would find
+# no running unit for them, so they join the others only once started.
+_pending = {}
+
+
+def add_pending(dom):
+    with _lock:
+        _pending[dom.UUIDString()] = dom
+
+
+def get_pending(vm_uuid):
+    with _lock:
+        return _pending[str(vm_uuid)]
+
+
+def remove_pending(vm_uuid):
+    with _lock:
+        del _pending[vm_uuid]
+
+
 # use only for testing
 def clear():
     with _lock:
         _doms.clear()
+        _defined.clear()
+        _pending.clear()
@@ -19,9 +19,16 @@
 #
 from __future__ import absolute_import
 
+import ctypes
 import errno
 import logging
 import os
+import os.path
+import select
+import struct
+import sys
+
+from . import command
 
 
 def rm_file(target):
@@ -38,3 +45,90 @@ def rm_file(target):
 def read_file(path):
     with open(path, 'rt') as f:
         return f.read()
+
+
+class WatchUnavailable(Exception):
+    """
+    inotify cannot be used on this host
+    """
+
+
+# from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# struct inotify_event, without the trailing name
+_EVENT = struct.Struct('iIII')
+
+_EVENTS_BUFSIZE = 4096
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def inotify_available():
+    return _libc is not None
+
+
+def wait_for_file(path, timeout):
+    """
+    Waits up to `timeout` seconds for `path` to be written, or moved
+    in place, using inotify on its directory.
+    Returns True if the file exists, False on timeout.
+    Raises WatchUnavailable if inotify cannot be used.
+    """
+    if _libc is None:
+        raise WatchUnavailable('inotify not supported')
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        raise WatchUnavailable(os.strerror(ctypes.get_errno()))
+    try:
+        wd = _libc.inotify_add_watch(
+            fd, _encode(dirname), _IN_CLOSE_WRITE | _IN_MOVED_TO)
+        if wd < 0:
+            raise WatchUnavailable(os.strerror(ctypes.get_errno()))
+        # the file may have been written before the watch was added
+        if os.path.exists(path):
+            return True
+        name = _encode(basename)
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        deadline = command.monotonic_time() + timeout
+        while True:
+            remaining = deadline - command.monotonic_time()
+            if remaining <= 0:
+                return False
+            if not poller.poll(remaining * 1000):
+                return False
+            if name in _event_names(os.read(fd, _EVENTS_BUFSIZE)):
+                return True
+    finally:
+        os.close(fd)
+
+
+def _event_names(data):
+    pos = 0
+    while pos + _EVENT.size <= len(data):
+        _, _, _, size = _EVENT.unpack_from(data, pos)
+        pos += _EVENT.size
+        yield data[pos:pos + size].rstrip(b'\0')
+        pos += size
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
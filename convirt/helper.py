@@ -0,0 +1,332 @@
+#
+# Copyright 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+"""
+Out of process command execution.
+
+The helper is a small process, started once, which runs the commands
+on behalf of the main process, so the main process never forks.
+Requests and replies are JSON lines exchanged over a unix socket,
+one command per connection. Only the owner can connect to the socket,
+and the helper serves only clients running with its own user ID, or
+with one of the allowed ones.
+
+Enable it with `use_helper` in the configuration: runtime.setup()
+starts the helper, and makes HelperCommand, which forwards the
+commands to it, the default command class of the Repos.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import json
+import logging
+import os
+import os.path
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from .config import environ
+from . import command
+
+
+_SOCKET_NAME = 'helper.sock'
+
+_SOCKET_MODE = 0o600
+
+# not exported by python 2
+_SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+_PEERCRED = struct.Struct('3i')  # pid, uid, gid
+
+_lock = threading.Lock()
+_helper = None
+
+
+class Error(Exception):
+    """
+    the helper failed to run the command
+    """
+
+
+def default_path(run_dir=None):
+    if run_dir is None:
+        run_dir = environ.current().run_dir
+    return os.path.join(run_dir, _SOCKET_NAME)
+
+
+class Server(object):
+
+    _log = logging.getLogger('convirt.helper.Server')
+
+    def __init__(self, path, fake=False, uids=()):
+        self._path = path
+        self._fake = fake
+        self._uids = frozenset(uids) | frozenset([os.geteuid()])
+        self._sock = None
+        self._stopped = threading.Event()
+
+    @property
+    def path(self):
+        return self._path
+
+    def bind(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self._path)
+        # nobody can connect before listen(), so no race here
+        os.chmod(self._path, _SOCKET_MODE)
+        sock.listen(128)
+        self._sock = sock
+
+    def serve(self):
+        self._log.debug('serving on %r', self._path)
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                if self._stopped.is_set():
+                    break
+                raise
+            worker = threading.Thread(target=self._handle, args=(conn,))
+            worker.daemon = True
+            worker.start()
+        self._log.debug('stopped serving on %r', self._path)
+
+    def stop(self):
+        self._stopped.set()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # not connected, nothing to do
+            self._sock.close()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def _handle(self, conn):
+        try:
+            uid = _peer_uid(conn)
+            if uid not in self._uids:
+                self._log.warning('refused request from uid %i', uid)
+                _send(conn, {'error': 'permission denied'})
+                return
+            req = _recv(conn)
+            if req is None:
+                return  # just checking we are up, see Helper.start
+            _send(conn, self._run(req['argv']))
+        except Exception as exc:
+            self._log.exception('error handling request')
+            try:
+                _send(conn, {'error': 'helper failed: %s' % exc})
+            except socket.error:
+                pass  # the client went away
+        finally:
+            conn.close()
+
+    def _run(self, argv):
+        if self._fake:
+            # mimic command.FakeCommand
+            return _reply(0, ' '.join(argv).encode('utf-8'))
+        try:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+            out, _ = proc.communicate()
+        except OSError as exc:
+            return {'error': str(exc)}
+        return _reply(proc.returncode, out)
+
+
+class Helper(object):
+    """
+    Manages the helper process.
+    """
+
+    _log = logging.getLogger('convirt.helper')
+
+    _TRIES = 100
+
+    _DELAY = 0.05  # seconds
+
+    def __init__(self, path, fake=False):
+        self._path = path
+        self._fake = fake
+        self._proc = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def running(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self):
+        if os.path.exists(self._path):
+            # left behind by a helper which didn't stop cleanly
+            self._log.warning('removing stale helper socket %r',
+                              self._path)
+            os.unlink(self._path)
+        argv = [sys.executable, '-m', __name__, self._path]
+        if self._fake:
+            argv.append('--fake')
+        self._log.debug('starting helper %r', argv)
+        self._proc = subprocess.Popen(argv, close_fds=True)
+        for _ in range(self._TRIES):
+            if self._accepting():
+                return
+            if self._proc.poll() is not None:
+                break
+            time.sleep(self._DELAY)
+        self.stop()
+        raise Error('helper failed to start')
+
+    def _accepting(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+        return True
+
+    def stop(self):
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            self._proc.terminate()
+        self._proc.wait()
+        self._proc = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._log.debug('stopped helper on %r', self._path)
+
+
+class HelperCommand(command.Command):
+    """
+    Forwards the command to the helper process listening
+    on socket_path, instead of running it directly.
+    If socket_path is not set, uses the default path
+    in the configured run_dir.
+    """
+
+    socket_path = None
+
+    def _execute(self, argv):
+        self._log.debug('%s forwarding %r',
+                        self.ident, argv)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(
+                default_path() if self.socket_path is None else
+                self.socket_path
+            )
+            _send(sock, {'argv': argv})
+            res = _recv(sock)
+        except (socket.error, ValueError) as exc:
+            raise Error('cannot talk to the helper: %s' % exc)
+        finally:
+            sock.close()
+        if res is None:
+            raise Error('the helper closed the connection')
+        self._log.debug('%s forwarded %r',
+                        self.ident, argv)
+        if 'error' in res:
+            raise Error(res['error'])
+        out = base64.b64decode(res['output'])
+        if res['status'] != 0:
+            exc = subprocess.CalledProcessError(res['status'], argv, out)
+            raise command.Failed.from_error(exc)
+        return out
+
+
+def start(path=None, fake=False):
+    """
+    Starts the helper of this process, if not running yet.
+    """
+    global _helper
+    with _lock:
+        if _helper is not None and _helper.running:
+            return _helper
+        helper = Helper(default_path() if path is None else path, fake)
+        helper.start()
+        _helper = helper
+        return helper
+
+
+def stop():
+    global _helper
+    with _lock:
+        if _helper is not None:
+            _helper.stop()
+            _helper = None
+
+
+def _peer_uid(sock):
+    data = sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _PEERCRED.size)
+    _, uid, _ = _PEERCRED.unpack(data)
+    return uid
+
+
+def _reply(status, out):
+    return {
+        'status': status,
+        'output': base64.b64encode(out).decode('ascii'),
+    }
+
+
+def _send(sock, obj):
+    sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+def _recv(sock):
+    """
+    Returns the next JSON line, or None if the peer closed the
+    connection without sending anything.
+    """
+    chunks = []
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        chunks.append(data)
+        if data.endswith(b'\n'):
+            break
+    if not chunks:
+        return None
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def _main(args):
+    path = args[0]
+    server = Server(path, fake='--fake' in args[1:])
+    server.bind()
+    try:
+        server.serve()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
@@ -93,17 +93,34 @@ _READER_ALIASES = {
 }
 
 
+# the reader fed by the accounting of each resource, see
+# runner.ACCOUNTING_PROFILES
+_ACCOUNTING_READERS = {
+    'CPU': 'cpuacct',
+    'Memory': 'memory',
+    'BlockIO': 'blkio',
+}
+
+
 class Monitorable(object):
 
-    def __init__(self, pid):
+    def __init__(self, pid, accounting=None):
+        """
+        `accounting` is the sequence of resources accounted for
+        the process, or None if all of them are.
+        """
         self._pid = pid
         self._cgroups = ()
         self._info = {}
         self._readers = {}
+        self._unavailable = () if accounting is None else tuple(sorted(
+            reader for res, reader in _ACCOUNTING_READERS.items()
+            if res not in accounting
+        ))
 
     @classmethod
-    def from_pid(cls, pid):
-        obj = cls(pid)
+    def from_pid(cls, pid, accounting=None):
+        obj = cls(pid, accounting)
         obj.setup()
         obj.update()
         return obj
@@ -120,6 +137,8 @@ class Monitorable(object):
             num, name, path = line.strip().split(':')
             if path != '/':
                 rname = _READER_ALIASES.get(name, name)
+                if rname in self._unavailable:
+                    continue  # not accounted, the data is meaningless
                 try:
                     reader = _READERS[rname]
                 except KeyError:
@@ -153,6 +172,14 @@ class Monitorable(object):
     def cgroups(self):
         return self._cgroups
 
+    @property
+    def unavailable(self):
+        """
+        The fields which are never reported, because the accounting
+        profile does not enable them.
+        """
+        return self._unavailable
+
     @property
     def pid(self):
         return self._pid
@@ -20,6 +20,7 @@
 from __future__ import absolute_import
 
 import logging
+import threading
 
 from . import doms
 
@@ -44,4 +45,42 @@ def watchdog(get_vm_uuids):
                             libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
 
 
+# docker containers which hit the memory limit: the OOM killer
+# may or may not end them, so this is reported only on 'die'
+_oom_hit = set()
+_oom_lock = threading.Lock()
+
+
+def docker_event(rt_uuid, action, attributes):
+    """
+    Fires the lifecycle event matching the docker `action` on the
+    domain of the container `rt_uuid`, if any.
+    """
+    with _oom_lock:
+        if action == 'oom':
+            _oom_hit.add(rt_uuid)
+            return
+        oom = rt_uuid in _oom_hit
+        _oom_hit.discard(rt_uuid)
+    if action == 'start':
+        event = (libvirt.VIR_DOMAIN_EVENT_STARTED,
+                 libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED)
+    elif action == 'die' and oom:
+        event = (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                 libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED)
+    elif action == 'die':
+        event = (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                 libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN
+                 if attributes.get('exitCode', '0') == '0' else
+                 libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED)
+    else:
+        return
+    for dom in doms.get_all():
+        if dom.runtimeUUIDString() == rt_uuid:
+            logging.info('container %r: docker event %r', rt_uuid, action)
+            dom.events.fire(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                            dom, *event)
+            return
+
+
 # TODO: poll container stats (use cgview)
@@ -0,0 +1,232 @@
+#
+# Copyright 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+"""
+Record and replay command executions.
+
+The recording backend runs the commands through a real backend and
+logs argv, exit status, output and latency of each execution to a
+file, one JSON object per line. The replay backend serves the outputs
+back from such a file, waiting the recorded (optionally scaled)
+latency, without running anything.
+
+Executions are matched on a normalized argv, so a recording can be
+replayed on another host or run: the executable is matched on its
+basename, and any UUID matches any other UUID.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import collections
+import json
+import logging
+import os.path
+import re
+import threading
+import time
+
+import six
+
+from . import command
+
+
+Record = collections.namedtuple(
+    'Record', ['argv', 'returncode', 'output', 'latency'])
+
+
+_UUID = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+    re.IGNORECASE)
+
+
+def normalize(argv):
+    """
+    The key used to match an execution: `argv` without the host
+    and run specific parts.
+    """
+    if not argv:
+        return ()
+    return (os.path.basename(argv[0]),) + tuple(
+        _UUID.sub('<uuid>', arg) for arg in argv[1:])
+
+
+class NotRecorded(Exception):
+    """
+    no recorded execution matches the command
+    """
+
+
+class Recorder(object):
+
+    _log = logging.getLogger('convirt.recording')
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    def add(self, record):
+        line = json.dumps({
+            'argv': record.argv,
+            'returncode': record.returncode,
+            'output': base64.b64encode(record.output).decode('ascii'),
+            'latency': record.latency,
+        })
+        with self._lock:
+            with open(self._path, 'at') as dst:
+                dst.write(line + '\n')
+
+
+def load(path):
+    records = []
+    with open(path, 'rt') as src:
+        for line in src:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            records.append(Record(
+                argv=data['argv'],
+                returncode=data['returncode'],
+                output=base64.b64decode(data['output']),
+                latency=data['latency'],
+            ))
+    return records
+
+
+def recording(path, backend=command.SubProcCommand):
+    """
+    Returns a command class, suitable for command.Repo, which runs
+    the commands using `backend` and appends them to `path`.
+    Streamed executions are recorded once the command exited,
+    if all of their output was read.
+    """
+    recorder = Recorder(path)
+    # backends which don't stream get here through _execute
+    streams = (six.get_unbound_function(backend._stream) is not
+               six.get_unbound_function(command.Command._stream))
+
+    def _record(argv, returncode, output, start):
+        recorder.add(Record(
+            argv=list(argv),
+            returncode=returncode,
+            output=_as_bytes(output),
+            latency=command.monotonic_time() - start,
+        ))
+
+    class RecordingCommand(backend):
+
+        def _execute(self, argv):
+            start = command.monotonic_time()
+            try:
+                out = super(RecordingCommand, self)._execute(argv)
+            except command.Failed as exc:
+                _record(argv, exc.returncode, exc.output, start)
+                raise
+            _record(argv, 0, out, start)
+            return out
+
+        def _stream(self, argv):
+            if not streams:
+                return super(RecordingCommand, self)._stream(argv)
+            return self._recorded_stream(argv)
+
+        def _recorded_stream(self, argv):
+            start = command.monotonic_time()
+            lines = []
+            try:
+                for line in super(RecordingCommand, self)._stream(argv):
+                    lines.append(line)
+                    yield line
+            except command.Failed as exc:
+                _record(argv, exc.returncode, _joined(lines), start)
+                raise
+            _record(argv, 0, _joined(lines), start)
+
+    return RecordingCommand
+
+
+class Replay(object):
+    """
+    Serves recorded executions. Executions of the same normalized
+    argv are served in the recorded order; once exhausted, the last
+    one is served again.
+    """
+
+    def __init__(self, records, scale=1.):
+        self._scale = scale
+        self._lock = threading.Lock()
+        self._records = collections.defaultdict(collections.deque)
+        for rec in records:
+            self._records[normalize(rec.argv)].append(rec)
+
+    @property
+    def scale(self):
+        return self._scale
+
+    def next(self, argv):
+        with self._lock:
+            recs = self._records.get(normalize(argv))
+            if not recs:
+                raise NotRecorded(argv)
+            if len(recs) > 1:
+                return recs.popleft()
+            return recs[0]
+
+
+def replaying(path, scale=1.):
+    """
+    Returns a command class, suitable for command.Repo, which serves
+    the executions recorded in `path`, waiting the recorded latency
+    multiplied by `scale`.
+    """
+    replay = Replay(load(path), scale)
+
+    class ReplayCommand(command.Command):
+
+        def _execute(self, argv):
+            self._log.debug('%s replaying %r',
+                            self.ident, argv)
+            rec = replay.next(argv)
+            delay = rec.latency * replay.scale
+            if delay > 0:
+                time.sleep(delay)
+            if rec.returncode != 0:
+                raise command.Failed(
+                    'Command %r returned non-zero exit status %s' % (
+                        argv, rec.returncode),
+                    rec.returncode, rec.output)
+            return rec.output
+
+    return ReplayCommand
+
+
+def _joined(lines):
+    return ''.join(line + '\n' for line in lines)
+
+
+def _as_bytes(out):
+    if out is None:
+        return b''
+    if isinstance(out, bytes):
+        return out
+    return out.encode('utf-8')
@@ -19,25 +19,56 @@
 #
 from __future__ import absolute_import
 
+import collections
 import logging
 import os
 import os.path
+import re
+import shlex
+import threading
+import time
+
+import six
 
 from . import command
 from . import config
 
 
 PREFIX = 'convirt-'
+INSTANCE_PREFIX = 'convirt@'
 _SERVICE_EXT = ".service"
+_SLICE_EXT = ".slice"
+
+_CGROUPFS_ROOT = '/sys/fs/cgroup'
+
+# keep well below the kernel limits on the argv size
+_ARGV_MAX_BYTES = 64 * 1024
+
+_START_TIMEOUT = 60.  # seconds
+
+
+# resources whose accounting each profile enables on the container unit.
+# Block IO accounting has a measurable overhead on busy hosts.
+ACCOUNTING_PROFILES = {
+    'full': ('CPU', 'Memory', 'BlockIO'),
+    'cpu+memory': ('CPU', 'Memory'),
+    'none': (),
+}
+
+# dash separated parts of the slice name: systemd nests the slices
+# along the dashes, machine-convirt.slice is a child of machine.slice
+_SLICE_NAME = re.compile(r'^[A-Za-z0-9_.:]+(-[A-Za-z0-9_.:]+)*$')
+
+# where systemd keeps its hierarchy, relative to the cgroupfs root:
+# unified (v2), hybrid and legacy (v1) layouts, in order of preference.
+_CGROUPFS_LAYOUTS = ('', 'unified', 'systemd')
 
 
 _TEMPLATES = {
     'systemd-run':
         '--unit=${unit} '
         '--slice=${slice} '
-        '--property=CPUAccounting=1 '
-        '--property=MemoryAccounting=1 '
-        '--property=BlockIOAccounting=1 '
+        '${accounting} '
         '${command}',
 
     'machinectl_poweroff':
@@ -48,28 +79,208 @@ _TEMPLATES = {
         'stop '
         '${name}',
 
-    'systemctl_list':
+    'systemctl_list': command.ReadOnly(
         'list-units '
         '--no-pager '
         '--no-legend '
-        '${prefix}*',
+        '${prefix}* '
+        '${instance_prefix}*'
+    ),
+
+    'systemctl_start':
+        'start '
+        '${name}',
+
+    'systemctl_set_property':
+        'set-property '
+        '--runtime '
+        '${name} '
+        '${properties}',
+
+    'systemctl_daemon_reload':
+        'daemon-reload',
+
+    'systemctl_show': command.ReadOnly(
+        'show '
+        '--property=Id,MainPID,ControlGroup,ActiveState,SubState,'
+        'ActiveEnterTimestamp '
+        '${units}'
+    ),
 }
 
 
+UnitInfo = collections.namedtuple(
+    'UnitInfo', ['unit', 'main_pid', 'control_group',
+                 'active_state', 'sub_state', 'start_timestamp'])
+
+
 class OperationFailed(Exception):
     """
     WRITEME
     """
 
 
+class StartJob(object):
+    """
+    Tracks a unit started without waiting for its activation.
+    """
+
+    def __init__(self, unit_name, repo, callback=None,
+                 timeout=_START_TIMEOUT):
+        self._unit_name = unit_name
+        self._repo = repo
+        self._callback = callback
+        self._deadline = command.monotonic_time() + timeout
+        self._done = threading.Event()
+        self._info = None
+
+    @property
+    def unit_name(self):
+        return self._unit_name
+
+    @property
+    def repo(self):
+        return self._repo
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def info(self):
+        """
+        UnitInfo of the unit when the job completed,
+        None if the job timed out.
+        """
+        return self._info
+
+    @property
+    def succeeded(self):
+        return self._info is not None and self._info.active_state == 'active'
+
+    @property
+    def expired(self):
+        return command.monotonic_time() >= self._deadline
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done
+
+    def complete(self, info):
+        self._info = info
+        self._done.set()
+        if self._callback is not None:
+            try:
+                self._callback(self)
+            except Exception:
+                logging.exception('start callback for %r failed',
+                                  self._unit_name)
+
+
+class StartTracker(object):
+    """
+    Polls the state of the pending StartJobs in the background,
+    using one systemctl invocation for all the jobs sharing a Repo.
+    The polling thread runs only while there are pending jobs.
+    """
+
+    _log = logging.getLogger('convirt.runner.StartTracker')
+
+    _INTERVAL_MIN = 0.01  # seconds
+
+    _INTERVAL_MAX = 0.5  # seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._thread = None
+
+    def track(self, job):
+        with self._lock:
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='convirt-start-tracker')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        interval = self._INTERVAL_MIN
+        while True:
+            time.sleep(interval)
+            interval = min(interval * 2, self._INTERVAL_MAX)
+            with self._lock:
+                jobs = self._jobs[:]
+            try:
+                completed = self._poll(jobs)
+            except Exception:
+                self._log.exception('failed to poll %i jobs', len(jobs))
+                completed = []
+            with self._lock:
+                self._jobs = [
+                    job for job in self._jobs if job not in completed
+                ]
+                if not self._jobs:
+                    self._thread = None
+                    return
+
+    def _poll(self, jobs):
+        completed = []
+        by_repo = collections.defaultdict(list)
+        for job in jobs:
+            by_repo[id(job.repo)].append(job)
+        for group in by_repo.values():
+            try:
+                states = self._show(group)
+            except Exception:
+                # the jobs can still expire, and the other groups
+                # must be polled anyway
+                self._log.exception('failed to poll %i jobs', len(group))
+                states = {}
+            for job in group:
+                info = states.get(_service_name(job.unit_name))
+                if info is not None and info.active_state in (
+                        'active', 'failed'):
+                    job.complete(info)
+                elif job.expired:
+                    self._log.warning('unit %r not active before timeout',
+                                      job.unit_name)
+                    job.complete(None)
+                else:
+                    continue
+                completed.append(job)
+        return completed
+
+    def _show(self, group):
+        systemctl_show = group[0].repo.get(
+            'systemctl', _TEMPLATES['systemctl_show'],
+        )
+        output = systemctl_show(
+            units=[_service_name(job.unit_name) for job in group]
+        )
+        if isinstance(output, bytes):
+            output = output.decode('utf-8')
+        return dict(
+            (info.unit, info)
+            for info in _parse_systemctl_show(output)
+        )
+
+
+_tracker = StartTracker()
+
+
 class Runner(object):
 
     _log = logging.getLogger('convirt.runner')
 
+    # start_async() is supported
+    ASYNC_START = True
+
     def __init__(self, unit_name, repo):
         self._unit_name = unit_name
         self._repo = repo
         self._conf = config.environ.current()
+        self._accounting = _check_accounting(self._conf.accounting)
         self._running = False
         self._machinectl_poweroff = self._repo.get(
             'machinectl', _TEMPLATES['machinectl_poweroff'],
@@ -80,7 +291,12 @@ class Runner(object):
         self._systemd_run = self._repo.get(
             'systemd-run', _TEMPLATES['systemd-run'],
             unit=self._unit_name,
-            slice=self._conf.cgroup_slice,
+            slice=slice_unit(self._conf.cgroup_slice),
+        )
+        self._systemd_run_no_block = self._repo.get(
+            'systemd-run', '--no-block ' + _TEMPLATES['systemd-run'],
+            unit=self._unit_name,
+            slice=slice_unit(self._conf.cgroup_slice),
         )
 
     @property
@@ -91,8 +307,17 @@ class Runner(object):
     def running(self):
         return self._running
 
+    @property
+    def accounting(self):
+        return self._accounting
+
+    @accounting.setter
+    def accounting(self, profile):
+        self._accounting = _check_accounting(profile)
+
     def configure(self, conf):
         self._conf = conf
+        self.accounting = conf.accounting
 
     def stop(self, runtime_name=None):
         if runtime_name is None:
@@ -102,8 +327,28 @@ class Runner(object):
         self._running = False
 
     def start(self, **kwargs):
-        self._systemd_run(**kwargs)
+        self._systemd_run(
+            accounting=_accounting_options(self._accounting), **kwargs)
+        self._running = True
+
+    def start_async(self, callback=None, timeout=_START_TIMEOUT, **kwargs):
+        """
+        Like start, but does not wait for systemd to activate the unit.
+        Returns a StartJob, which completes once the unit is active,
+        or failed, or after `timeout` seconds, calling `callback`
+        with the job itself.
+        """
+        def _done(job):
+            self._running = job.succeeded
+            if callback is not None:
+                callback(job)
+
+        self._systemd_run_no_block(
+            accounting=_accounting_options(self._accounting), **kwargs)
         self._running = True
+        job = StartJob(self._unit_name, self._repo, _done, timeout)
+        _tracker.track(job)
+        return job
 
     def get_pid(self):
         if not self._running:
@@ -116,24 +361,404 @@ class Runner(object):
 
     @classmethod
     def get_all(cls, repo=None):
+        """
+        Returns the runtime UUIDs of the running containers. The output
+        is parsed while systemctl runs, but the result is returned only
+        once it exited: the callers may run systemctl on each item.
+        """
         repo = command.Repo() if repo is None else repo
         systemctl_list = repo.get(
             'systemctl', _TEMPLATES['systemctl_list'],
         )
-        output = systemctl_list(prefix=PREFIX)
-        for item in _parse_systemctl_list_units(output):
-            yield item
+        lines = systemctl_list.stream(
+            prefix=PREFIX, instance_prefix=INSTANCE_PREFIX
+        )
+        prefixes = (PREFIX, INSTANCE_PREFIX)
+        return list(_parse_systemctl_list_units(lines, prefixes))
+
+    @classmethod
+    def stop_all(cls, unit_names, repo=None, max_bytes=_ARGV_MAX_BYTES):
+        """
+        Stops many units using as few systemctl invocations
+        as possible. Returns a dict mapping each unit name to
+        True if it was stopped, False otherwise.
+        """
+        repo = command.Repo() if repo is None else repo
+        systemctl_stop = repo.get(
+            'systemctl', _TEMPLATES['systemctl_stop'],
+        )
+        res = {}
+        for chunk in _chunked(unit_names, max_bytes):
+            try:
+                systemctl_stop(name=chunk)
+            except command.Failed:
+                # find out which ones failed
+                cls._log.warning('failed to stop %i units, retrying '
+                                 'one by one', len(chunk))
+                for unit_name in chunk:
+                    res[unit_name] = _stop_one(systemctl_stop, unit_name)
+            else:
+                res.update((unit_name, True) for unit_name in chunk)
+        return res
+
+    @classmethod
+    def show_all(cls, repo=None, rt_uuids=None):
+        """
+        Returns a dict mapping runtime UUIDs to the UnitInfo of their
+        units, using one systemctl invocation for all the units.
+        If rt_uuids is None, queries all the running containers.
+        Both the transient and the instance unit of each container are
+        queried; the one which is loaded and not inactive wins.
+        """
+        repo = command.Repo() if repo is None else repo
+        if rt_uuids is None:
+            rt_uuids = cls.get_all(repo)
+        if not rt_uuids:
+            return {}
+        systemctl_show = repo.get(
+            'systemctl', _TEMPLATES['systemctl_show'],
+        )
+        units = []
+        for rt_uuid in rt_uuids:
+            units.append(_unit_from_vm_uuid(rt_uuid))
+            units.append(_instance_from_vm_uuid(rt_uuid))
+        output = systemctl_show(units=units)
+        if isinstance(output, bytes):
+            output = output.decode('utf-8')
+        res = {}
+        for info in _parse_systemctl_show(output):
+            try:
+                rt_uuid = _vm_uuid_from_unit(info.unit)
+            except ValueError:
+                cls._log.warning('unexpected unit %r', info.unit)
+                continue
+            if rt_uuid not in res or not _is_alive(res[rt_uuid]):
+                res[rt_uuid] = info
+        return res
+
+    @classmethod
+    def get_all_from_cgroupfs(cls, slice_name=None, root=None):
+        """
+        Like get_all, but reads the cgroup filesystem instead of
+        running systemctl. A unit is considered running if any
+        process is in its cgroup, or in any cgroup below it.
+        """
+        if slice_name is None:
+            slice_name = config.environ.current().cgroup_slice
+        base = _find_slice_dir(
+            _CGROUPFS_ROOT if root is None else root,
+            slice_unit(slice_name),
+        )
+        if base is None:
+            cls._log.warning('slice %r not found in cgroupfs', slice_name)
+            return
+        for unit in os.listdir(base):
+            if not unit.startswith((PREFIX, INSTANCE_PREFIX)):
+                continue
+            try:
+                rt_uuid = _vm_uuid_from_unit(unit)
+            except ValueError:
+                continue
+            if _cgroup_populated(os.path.join(base, unit)):
+                yield rt_uuid
+
+
+_INSTANCE_TEMPLATE = """\
+[Unit]
+Description=convirt container %%i
+
+[Service]
+Slice=%(slice)s
+EnvironmentFile=%(run_dir)s/%%i.env
+ExecStart=/usr/bin/env $CONVIRT_COMMAND
+%(accounting)s"""
+
+
+class InstanceRunner(Runner):
+    """
+    Runs the containers as instances of a convirt@.service template
+    unit, installed once in conf.unit_dir (default /run/systemd/system),
+    instead of creating a transient unit with systemd-run for each
+    container.
+    The command to run is passed through a per-instance
+    environment file in conf.run_dir.
+    """
+
+    _log = logging.getLogger('convirt.runner.InstanceRunner')
+
+    _TEMPLATE_NAME = INSTANCE_PREFIX + _SERVICE_EXT
+
+    ASYNC_START = False
+
+    _install_lock = threading.Lock()
+
+    def __init__(self, unit_name, repo):
+        super(InstanceRunner, self).__init__(unit_name, repo)
+        name = unit_name
+        if name.startswith(PREFIX):
+            name = name[len(PREFIX):]
+        self._instance = name
+        self._systemctl_start = self._repo.get(
+            'systemctl', _TEMPLATES['systemctl_start'],
+        )
+        self._systemctl_set_property = self._repo.get(
+            'systemctl', _TEMPLATES['systemctl_set_property'],
+        )
+
+    @property
+    def instance_name(self):
+        return '%s%s%s' % (INSTANCE_PREFIX, self._instance, _SERVICE_EXT)
+
+    @property
+    def env_path(self):
+        return os.path.join(self._conf.run_dir, '%s.env' % self._instance)
+
+    @classmethod
+    def install(cls, conf, repo):
+        """
+        Installs or updates the template unit. Returns True if
+        the unit file changed and systemd was reloaded.
+        """
+        path = os.path.join(conf.unit_dir, cls._TEMPLATE_NAME)
+        profile = _check_accounting(conf.accounting)
+        content = _INSTANCE_TEMPLATE % {
+            'slice': slice_unit(conf.cgroup_slice),
+            'run_dir': conf.run_dir,
+            'accounting': ''.join(
+                '%s\n' % prop for prop in _accounting_properties(profile)
+            ),
+        }
+        with cls._install_lock:
+            try:
+                with open(path, 'rt') as src:
+                    if src.read() == content:
+                        return False
+            except IOError:
+                pass  # not yet installed
+            cls._log.info('installing template unit %r', path)
+            with open(path, 'wt') as dst:
+                dst.write(content)
+            daemon_reload = repo.get(
+                'systemctl', _TEMPLATES['systemctl_daemon_reload'],
+            )
+            daemon_reload()
+            return True
+
+    def start(self, **kwargs):
+        self.install(self._conf, self._repo)
+        argv = _command_argv(kwargs)
+        if any(not arg or arg.split() != [arg] for arg in argv):
+            raise OperationFailed(
+                'arguments not supported by instance units: %r' % argv)
+        with open(self.env_path, 'wt') as dst:
+            dst.write('CONVIRT_COMMAND=%s\n' % ' '.join(argv))
+        self._systemctl_start(name=self.instance_name)
+        self._running = True
+        if self._accounting != self._conf.accounting:
+            # the template carries the host-wide profile
+            self._systemctl_set_property(
+                name=self.instance_name,
+                properties=_accounting_properties(
+                    self._accounting, disabled=True),
+            )
+
+    def start_async(self, callback=None, timeout=_START_TIMEOUT, **kwargs):
+        raise OperationFailed('not supported by instance units')
+
+    def stop(self, runtime_name=None):
+        if runtime_name is None:
+            self._systemctl_stop(name=self.instance_name)
+        else:
+            self._machinectl_poweroff(name=runtime_name)
+        self._running = False
+        try:
+            os.unlink(self.env_path)
+        except OSError:
+            pass  # never started, or already cleaned up
+
+
+def create(unit_name, repo, conf):
+    """
+    Returns the runner for `unit_name`, according to conf.unit_mode:
+    'transient' (the default) or 'instance'.
+    """
+    mode = conf.unit_mode
+    if mode == 'instance':
+        runr = InstanceRunner(unit_name, repo)
+    elif mode == 'transient':
+        runr = Runner(unit_name, repo)
+    else:
+        raise ValueError('unknown unit mode %r' % mode)
+    runr.configure(conf)
+    return runr
+
+
+def slice_unit(name):
+    """
+    Returns the unit of the slice `name`. Like systemd, reads the
+    dashes as nesting: machine-convirt is inside the machine slice.
+    """
+    if not _SLICE_NAME.match(name):
+        raise ValueError('invalid slice name %r' % name)
+    return name + _SLICE_EXT
+
+
+def _check_accounting(profile):
+    if profile not in ACCOUNTING_PROFILES:
+        raise ValueError('unknown accounting profile %r' % profile)
+    return profile
+
+
+def _accounting_properties(profile, disabled=False):
+    """
+    Returns the unit properties which enable the accounting for
+    `profile`. If `disabled` is True, also the ones which explicitly
+    disable the accounting of the other resources.
+    """
+    enabled = ACCOUNTING_PROFILES[profile]
+    return [
+        '%sAccounting=%i' % (res, res in enabled)
+        for res in ACCOUNTING_PROFILES['full']
+        if disabled or res in enabled
+    ]
+
+
+def _accounting_options(profile):
+    return [
+        '--property=%s' % prop for prop in _accounting_properties(profile)
+    ]
+
+
+def _command_argv(kwargs):
+    ctx = kwargs.copy()
+    cmd = ctx.pop('command')
+    if isinstance(cmd, command.Command):
+        return cmd.cmdline(**ctx)
+    return shlex.split(cmd)
 
 
 def _vm_uuid_from_unit(unit):
     name, ext = os.path.splitext(unit)
     if ext != _SERVICE_EXT:  # TODO: check this
         raise ValueError(unit)
+    if name.startswith(INSTANCE_PREFIX):
+        return name[len(INSTANCE_PREFIX):]
     return name.replace(PREFIX, '', 1)
 
 
-def _parse_systemctl_list_units(output):
-    for line in output.splitlines():
+def _stop_one(systemctl_stop, unit_name):
+    try:
+        systemctl_stop(name=[unit_name])
+    except command.Failed:
+        logging.exception('failed to stop unit %r', unit_name)
+        return False
+    return True
+
+
+def _chunked(items, max_bytes):
+    chunk, size = [], 0
+    for item in items:
+        # account for the terminating NUL
+        item_size = len(item) + 1
+        if chunk and size + item_size > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        yield chunk
+
+
+def _service_name(unit_name):
+    if unit_name.endswith(_SERVICE_EXT):
+        return unit_name
+    return unit_name + _SERVICE_EXT
+
+
+def _unit_from_vm_uuid(rt_uuid):
+    return '%s%s%s' % (PREFIX, rt_uuid, _SERVICE_EXT)
+
+
+def _instance_from_vm_uuid(rt_uuid):
+    return '%s%s%s' % (INSTANCE_PREFIX, rt_uuid, _SERVICE_EXT)
+
+
+def _is_alive(info):
+    return info.main_pid != 0 or info.active_state not in ('', 'inactive')
+
+
+def _parse_systemctl_show(output):
+    # one block of key=value lines per unit, separated by empty lines
+    props = {}
+    for line in output.splitlines() + ['']:
+        line = line.strip()
+        if line:
+            key, _, val = line.partition('=')
+            props[key] = val
+            continue
+        if not props:
+            continue
+        try:
+            pid = int(props.get('MainPID', 0))
+        except ValueError:
+            pid = 0
+        yield UnitInfo(
+            unit=props.get('Id', ''),
+            main_pid=pid,
+            control_group=props.get('ControlGroup', ''),
+            active_state=props.get('ActiveState', ''),
+            sub_state=props.get('SubState', ''),
+            start_timestamp=props.get('ActiveEnterTimestamp', ''),
+        )
+        props = {}
+
+
+def _find_slice_dir(root, slice_unit):
+    for layout in _CGROUPFS_LAYOUTS:
+        path = os.path.join(root, layout, _slice_path(slice_unit))
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def _slice_path(slice_unit):
+    # machine-convirt.slice -> machine.slice/machine-convirt.slice
+    parts = slice_unit[:-len(_SLICE_EXT)].split('-')
+    return os.path.join(*[
+        '-'.join(parts[:idx]) + _SLICE_EXT
+        for idx in range(1, len(parts) + 1)
+    ])
+
+
+def _cgroup_populated(path):
+    try:
+        with open(os.path.join(path, 'cgroup.procs'), 'rt') as src:
+            if src.read().strip():
+                return True
+        entries = os.listdir(path)
+    except (IOError, OSError):
+        return False  # the unit went away meanwhile
+    return any(
+        _cgroup_populated(os.path.join(path, entry))
+        for entry in entries
+        if os.path.isdir(os.path.join(path, entry))
+    )
+
+
+def _parse_systemctl_list_units(lines, prefix=''):
+    """
+    Parses the output of systemctl list-units, either as string or as
+    iterable of lines, skipping the units not starting with `prefix`
+    (a string or a tuple of strings).
+    """
+    if isinstance(lines, six.string_types):
+        lines = lines.splitlines()
+    for line in lines:
+        # cheap check first: most lines are skipped here
+        if not line.startswith(prefix):
+            line = line.lstrip()
+            if not line.startswith(prefix):
+                continue
         if not line:
             continue
         try:
@@ -17,33 +17,141 @@
 #
 # Refer to the README and COPYING files for full details of the license
 #
+"""
+Registry of the container runtimes.
+
+The runtimes are declared by name, and their modules are imported,
+and their availability probed, only the first time a name is used.
+Besides the runtimes shipped with convirt, other packages can declare
+theirs with an entry point in the ENTRY_POINTS group, whose value is
+the module; like the builtin ones, the module must have a register()
+function returning the available runtime classes by name.
+"""
 from __future__ import absolute_import
 
 import importlib
 import logging
-import pkgutil
 import threading
 
+from .config import environ
+from . import command
+from . import helper
 from . import runtimes
 
 
+ENTRY_POINTS = 'convirt.runtimes'
+
+_BUILTIN = {
+    'docker': '%s.docker' % runtimes.__name__,
+    'fake': '%s.fake' % runtimes.__name__,
+    'rkt': '%s.rkt' % runtimes.__name__,
+}
+
+
 _lock = threading.Lock()
+# runtime name -> module
+_modules = dict(_BUILTIN)
+_scanned = False
+# runtime name -> class, or None if not available
 _rts = {}
 _ready = False
 
 
+def declare(name, module_name):
+    """
+    Declares the runtime `name`, implemented in `module_name`.
+    Nothing is imported until the runtime is used; if setup() was
+    already done, the runtime is set up then.
+    """
+    with _lock:
+        _modules[name] = module_name
+        _rts.pop(name, None)
+
+
+def _declared():
+    global _scanned
+    if not _scanned:
+        for name, module_name in _entry_points().items():
+            if name in _modules:
+                _log.warning('runtime %r from %r already declared, ignored',
+                             name, module_name)
+                continue
+            _modules[name] = module_name
+        _scanned = True
+    return _modules
+
+
+def _entry_points():
+    try:
+        from importlib import metadata
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return {}
+        return {
+            ep.name: ep.module_name
+            for ep in pkg_resources.iter_entry_points(ENTRY_POINTS)
+        }
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=ENTRY_POINTS)
+    else:
+        eps = eps.get(ENTRY_POINTS, ())
+    return {ep.name: ep.value.split(':')[0].strip() for ep in eps}
+
+
+def _resolve(name):
+    """
+    Returns the class of the runtime `name`, or None if it is
+    unknown, or not available on this host.
+    """
+    with _lock:
+        if name in _rts:
+            return _rts[name]
+        module_name = _modules.get(name)
+        if module_name is None:
+            # maybe from a package installed later
+            module_name = _declared().get(name)
+    if module_name is None:
+        return None
+    # import and probe without the lock, they may take a while;
+    # racing on the same runtime is harmless
+    klass = _probe(name, module_name)
+    with _lock:
+        found = name in _rts
+        klass = _rts.setdefault(name, klass)
+        # runtimes found after setup() need to be set up as well
+        late = _ready and not found and klass is not None
+    if late:
+        _log.debug('setting up runtime %r', name)
+        klass.setup_runtime()
+    return klass
+
+
+def _probe(name, module_name):
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as exc:
+        _log.warning('cannot import runtime %r from %r: %s',
+                     name, module_name, exc)
+        return None
+    return module.register().get(name)
+
+
 def _register():
-    global _rts
-    if not _rts:
-        rts = {}
-        for _, module_name, _ in pkgutil.iter_modules([runtimes.__path__[0]]):
-            module = importlib.import_module(
-                '%s.%s' % (runtimes.__name__, module_name)
-            )
-            if hasattr(module, 'register'):
-                rts.update(module.register())
-        _rts = rts
-    return _rts
+    with _lock:
+        names = sorted(_declared())
+    for name in names:
+        _resolve(name)
+    with _lock:
+        return _available()
+
+
+def _available():
+    return {
+        name: klass for name, klass in _rts.items() if klass is not None
+    }
 
 
 def _unregister():
@@ -65,12 +173,7 @@ _log = logging.getLogger('convirt.runtime')
 
 
 def create(rt, conf, repo, **kwargs):
-    global _lock
-    global _rts
-
-    with _lock:
-        klass = _rts.get(rt, None)
-
+    klass = _resolve(rt)
     if klass is None:
         raise Unsupported(rt)
 
@@ -80,23 +183,28 @@ def create(rt, conf, repo, **kwargs):
 
 # FIXME: testing (half-hack)
 def supported(register=True):
-    global _lock
-    global _rts
+    """
+    The names of the available runtimes. If register is False,
+    only of the ones already used.
+    """
+    if register:
+        _register()
     with _lock:
-        if register:
-            _register()
-        return frozenset(list(_rts.keys()))
+        return frozenset(_available())
 
 
 def setup():
     global _lock
     global _ready
-    global _rts
+    rts = _register()
     with _lock:
         if _ready:
             raise SetupError('setup already done')
-        _register()
-        for name, rt in list(_rts.items()):
+        if environ.current().use_helper:
+            _log.debug('starting the command helper')
+            helper.start()
+            command.set_default_class(helper.HelperCommand)
+        for name, rt in sorted(rts.items()):
             _log.debug('setting up runtime %r', name)
             rt.setup_runtime()
         _ready = True
@@ -105,23 +213,23 @@ def setup():
 def teardown():
     global _lock
     global _ready
-    global _rts
     with _lock:
         if not _ready:
             raise SetupError('teardown already done')
-        for name, rt in list(_rts.items()):
+        for name, rt in sorted(_available().items()):
             _log.debug('shutting down runtime %r', name)
             rt.teardown_runtime()
+        command.set_default_class(None)
+        helper.stop()
         _unregister()
         _ready = False
 
 
 def configure():
     global _lock
-    global _rts
+    rts = _register()
     with _lock:
-        _register()
-        for name, rt in list(_rts.items()):
+        for name, rt in sorted(rts.items()):
             _log.debug('configuring runtime %r', name)
             rt.configure_runtime()
 
@@ -21,11 +21,10 @@ from __future__ import absolute_import
 
 import collections
 import logging
+import random
 import time
 import uuid
 
-from six.moves import range
-
 from .. import command
 from .. import runner
 from .. import xmlconstants
@@ -49,6 +48,46 @@ class NotYetReady(Exception):
     """
 
 
+# one wait for readiness: `attempts` holds the time elapsed, in seconds,
+# since the beginning of the wait at the end of each attempt.
+WaitRecord = collections.namedtuple(
+    'WaitRecord', ['what', 'ready', 'elapsed', 'attempts'])
+
+
+class WaitPolicy(object):
+    """
+    How to poll for a container to become ready: the delay between
+    attempts starts at `initial` seconds and grows by `factor` up to
+    `max_delay`, each delay randomized by +/- `jitter` (a fraction),
+    until `deadline` seconds are passed since the first attempt.
+    """
+
+    def __init__(self, initial=0.005, factor=2., max_delay=0.5,
+                 deadline=10., jitter=0.1):
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def delays(self, rand=random.random):
+        """
+        Yields the delays between attempts, forever.
+        """
+        delay = self.initial
+        while True:
+            yield delay * (1. + self.jitter * (2. * rand() - 1.))
+            delay = min(delay * self.factor, self.max_delay)
+
+    def __repr__(self):
+        return (
+            'WaitPolicy(initial=%r, factor=%r, max_delay=%r, '
+            'deadline=%r, jitter=%r)' % (
+                self.initial, self.factor, self.max_delay,
+                self.deadline, self.jitter)
+        )
+
+
 _NULL = command.Path('false', paths=tuple())
 
 
@@ -60,9 +99,11 @@ class ContainerRuntime(object):
 
     _PATH = _NULL
 
-    _TRIES = 10  # TODO: make config item?
+    # overridden by conf.wait_policies[NAME], if present
+    WAIT_POLICY = WaitPolicy()
 
-    _DELAY = 1  # seconds  TODO: make config item?
+    # how many WaitRecords to keep for each runtime
+    _WAIT_HISTORY = 16
 
     def __init__(self, conf, repo, rt_uuid=None):
         self._conf = conf
@@ -70,10 +111,10 @@ class ContainerRuntime(object):
             uuid.uuid4() if rt_uuid is None else
             uuid.UUID(rt_uuid)
         )
-        self._runner = runner.Runner(self.unit_name(), repo)
-        self._runner.configure(self._conf)
+        self._runner = runner.create(self.unit_name(), repo, self._conf)
         self._run_conf = None
         self._pid = 0
+        self._waits = collections.deque(maxlen=self._WAIT_HISTORY)
 
     @property
     def pid(self):
@@ -94,12 +135,28 @@ class ContainerRuntime(object):
         mapping = dom.drives_map()
         net = dom.network()
         self._run_conf = RunConfig(path, volumes, mapping, mem, net)
+        accounting = dom.accounting()
+        if accounting is not None:
+            try:
+                self._runner.accounting = accounting
+            except ValueError:
+                raise ConfigError('accounting profile %r' % accounting)
         self._log.debug('configured runtime %s: %s',
                         self.uuid, self._run_conf)
 
     def start(self, target=None):
         raise NotImplementedError
 
+    def start_async(self, callback, target=None):
+        """
+        Like start, but may return before the container is up.
+        `callback` is called with None once the container started,
+        or with the exception which made the start fail.
+        Runtimes which can't start asynchronously just start().
+        """
+        self.start(target)
+        callback(None)
+
     def stop(self):
         raise NotImplementedError
 
@@ -109,6 +166,14 @@ class ContainerRuntime(object):
     def runtime_name(self):
         raise NotImplementedError
 
+    def resync(self):
+        # runtimes which can't find their containers again
+        raise runner.OperationFailed(
+            '%s containers cannot be recovered' % self.__class__.__name__)
+
+    def prepare(self, target=None):
+        pass  # optional
+
     def setup(self):
         pass  # optional
 
@@ -127,6 +192,26 @@ class ContainerRuntime(object):
     def configure_runtime(cls):
         pass  # optional
 
+    @property
+    def accounting(self):
+        """
+        The resources accounted for this container, as a tuple of
+        names from runner.ACCOUNTING_PROFILES.
+        """
+        return runner.ACCOUNTING_PROFILES[self._runner.accounting]
+
+    @property
+    def wait_policy(self):
+        return self._conf.wait_policies.get(self.NAME, self.WAIT_POLICY)
+
+    @property
+    def waits(self):
+        """
+        The most recent waits for readiness, as WaitRecords,
+        oldest first.
+        """
+        return list(self._waits)
+
     @property
     def runtime_config(self):
         """
@@ -135,19 +220,33 @@ class ContainerRuntime(object):
         return self._run_conf
 
     def _retry(self, what, func, *args, **kwargs):
-        ret = None
-        for i in range(self._TRIES):
+        policy = self.wait_policy
+        attempts = []
+        start = command.monotonic_time()
+        for delay in policy.delays():
             try:
                 ret = func(*args, **kwargs)
             except NotYetReady:
-                self._log.debug('%s: try %i/%i failed',
-                                what, i+1, self._TRIES)
-                time.sleep(self._DELAY)
+                elapsed = command.monotonic_time() - start
+                attempts.append(elapsed)
+                self._log.debug('%s: try %i failed after %.3fs',
+                                what, len(attempts), elapsed)
+                remaining = policy.deadline - elapsed
+                if remaining <= 0:
+                    break
+                time.sleep(min(delay, remaining))
             else:
-                self._log.info('%s: done at try %i/%i',
-                               what, i+1, self._TRIES)
+                elapsed = command.monotonic_time() - start
+                attempts.append(elapsed)
+                self._log.info('%s: done at try %i after %.3fs',
+                               what, len(attempts), elapsed)
+                self._waits.append(
+                    WaitRecord(what, True, elapsed, tuple(attempts)))
                 return ret
-        raise runner.OperationFailed('%s failed', what)
+        self._waits.append(
+            WaitRecord(what, False, elapsed, tuple(attempts)))
+        raise runner.OperationFailed('%s failed after %.3fs' % (
+            what, elapsed))
 
 
 class DomainParser(object):
@@ -231,10 +330,20 @@ class DomainParser(object):
             image = images[0]
         return image
 
+    def accounting(self):
+        profile = self._container_attr('accounting')
+        if profile is not None:
+            self._log.debug('runtime %r found accounting profile %r',
+                            self.uuid, profile)
+        return profile
+
     def _override_image(self):
+        return self._container_attr('image')
+
+    def _container_attr(self, name):
         cont = self._xml_tree.find(
             './metadata/{%s}container' % xmlconstants.METADATA_CONTAINERS_URI
         )
         if cont is None:
             return None
-        return cont.get('image')
+        return cont.get(name)
@@ -20,8 +20,12 @@
 from __future__ import absolute_import
 
 import logging
+import os.path
+import threading
 
+from ..config import environ
 from .. import command
+from .. import dockerapi
 from .. import runner
 from . import ContainerRuntime
 
@@ -29,12 +33,35 @@ from . import ContainerRuntime
 command.executables['docker'] = command.Path('docker')
 
 
+# The container is created detached, with its cgroup under the convirt
+# slice; the transient unit runs `docker wait`, so it lives as long as
+# the container does. Through the Engine API (conf.docker_api) there is
+# no unit: Docker.get_all() finds the containers.
 _TEMPLATES = {
     'docker_run':
         'run '
+        '--detach '
+        '--cgroup-parent=${cgroup_parent} '
         '--name=${unit_name} '
         '${image}',
 
+    'docker_wait':
+        'wait '
+        '${unit_name}',
+
+    'docker_stop':
+        'stop '
+        '${unit_name}',
+
+    'docker_rm':
+        'rm '
+        '${unit_name}',
+
+    'docker_pid': command.ReadOnly(
+        'inspect '
+        '--format={{.State.Pid}} '
+        '${unit_name}'
+    ),
 }
 
 
@@ -55,6 +82,17 @@ class Docker(ContainerRuntime):
 
     _PREFIX = 'dkr-'
 
+    # API clients, and their connection pools, shared by all containers
+    _clients = {}
+
+    _clients_lock = threading.Lock()
+
+    _watcher = None
+
+    # events convirt causes itself, by runtime UUID: the watcher drops
+    # them, the caller of start() or stop() already knows the outcome
+    _expected = {}
+
     def __init__(self,
                  conf,
                  repo,
@@ -65,32 +103,364 @@ class Docker(ContainerRuntime):
         self._docker_run = self._runner.repo.get(
             'docker', _TEMPLATES['docker_run'],
             unit_name=self.unit_name(),
+            cgroup_parent=self.cgroup_parent(),
+        )
+        self._docker_wait = self._runner.repo.get(
+            'docker', _TEMPLATES['docker_wait'],
+            unit_name=self.unit_name(),
+        )
+        self._docker_stop = self._runner.repo.get(
+            'docker', _TEMPLATES['docker_stop'],
+            unit_name=self.unit_name(),
+        )
+        self._docker_rm = self._runner.repo.get(
+            'docker', _TEMPLATES['docker_rm'],
+            unit_name=self.unit_name(),
         )
+        self._docker_pid = self._runner.repo.get(
+            'docker', _TEMPLATES['docker_pid'],
+            unit_name=self.unit_name(),
+        )
+        # with conf.docker_api, talk to the daemon instead of
+        # running the docker CLI
+        self._api = None
+        if self._conf.docker_api:
+            self._api = self._client(self._conf.docker_socket)
+        self._container_id = None
 
     @staticmethod
     def available():
+        conf = environ.current()
+        if conf.docker_api:
+            return os.path.exists(conf.docker_socket)
         docker = command.executables['docker']
         return docker.available
 
+    @classmethod
+    def get_all(cls, socket_path=None):
+        """
+        Returns the runtime UUIDs of the convirt containers running
+        through the Engine API, which have no unit: runner.Runner.get_all
+        doesn't know them.
+        """
+        if socket_path is None:
+            socket_path = environ.current().docker_socket
+        try:
+            conts = cls._client(socket_path).list(
+                {'name': [runner.PREFIX]})
+        except dockerapi.Error as exc:
+            raise runner.OperationFailed(str(exc))
+        prefix = '/' + runner.PREFIX
+        res = []
+        for cont in conts or ():
+            for name in cont.get('Names', ()):
+                # the name filter matches anywhere in the name
+                if name.startswith(prefix):
+                    res.append(name[len(prefix):])
+        return res
+
     @classmethod
     def configure_runtime(cls):
         pass  # TODO
 
+    @classmethod
+    def teardown_runtime(cls):
+        cls.unwatch_events()
+        with cls._clients_lock:
+            clients = list(cls._clients.values())
+            cls._clients.clear()
+        for client in clients:
+            client.close()
+
+    @classmethod
+    def watch_events(cls, callback, socket_path=None):
+        """
+        Subscribes to the event stream of the daemon, calling
+        `callback(rt_uuid, action, attributes)` whenever a convirt
+        container starts, dies or runs out of memory.
+        """
+        if socket_path is None:
+            socket_path = environ.current().docker_socket
+        watcher = EventWatcher(cls._client(socket_path), callback)
+        with cls._clients_lock:
+            if cls._watcher is not None:
+                raise runner.OperationFailed('already watching events')
+            cls._watcher = watcher
+        watcher.start()
+
+    @classmethod
+    def unwatch_events(cls):
+        with cls._clients_lock:
+            watcher, cls._watcher = cls._watcher, None
+            cls._expected.clear()
+        if watcher is not None:
+            watcher.stop()
+
+    @classmethod
+    def expected_event(cls, rt_uuid, action):
+        """
+        Returns True if convirt caused the event `action` of the
+        container `rt_uuid`, which is then no longer expected.
+        """
+        with cls._clients_lock:
+            actions = cls._expected.get(rt_uuid)
+            if actions is None or action not in actions:
+                return False
+            actions.discard(action)
+            if not actions:
+                del cls._expected[rt_uuid]
+            return True
+
+    def _expect_event(self, action):
+        with self._clients_lock:
+            if self._watcher is not None:
+                # replaces any event which never came
+                self._expected[self.uuid] = set([action])
+
+    @classmethod
+    def _client(cls, path):
+        with cls._clients_lock:
+            client = cls._clients.get(path)
+            if client is None:
+                client = dockerapi.Client(path)
+                cls._clients[path] = client
+            return client
+
+    def cgroup_parent(self):
+        """
+        The parent of the cgroup of the container processes: the slice
+        of the convirt units, in the form the systemd cgroup driver of
+        docker expects. Docker creates a docker-<id>.scope in it.
+        So the container is a sibling of its unit, not a child, and the
+        accounting of the unit only covers `docker wait`. The accounting
+        of the slice covers both. The cgroups sampler follows the
+        container pid, which is in the scope. Through the Engine API
+        there is no unit, and the slice covers just the container.
+        """
+        return runner.slice_unit(self._conf.cgroup_slice)
+
     @property
     def running(self):
-        return self._runner.running
+        if self._api is not None:
+            return self._container_id is not None
+        return self._running
 
     def start(self, target=None):
         if self.running:
             raise runner.OperationFailed('already running')
 
-        self._runner.start(
-            command=self._docker_run,
-            image=self._run_conf.image_path if target is None else target,
-        )
+        image = self._run_conf.image_path if target is None else target
+        self._expect_event('start')
+        try:
+            if self._api is not None:
+                self._start_api(image)
+            else:
+                self._start_cli(image)
+        except Exception:
+            self.expected_event(self.uuid, 'start')  # not anymore
+            raise
+
+    def _start_cli(self, image):
+        self._docker_run(image=image)
+        try:
+            self._runner.start(command=self._docker_wait)
+        except command.Failed:
+            self._remove_container()
+            raise
+        self._running = True
+        self._pid = self._fetch_pid()
+        self._log.info('docker container %s pid %i', self._uuid, self._pid)
 
     def stop(self):
         if not self.running:
             raise runner.OperationFailed('not running')
 
+        self._expect_event('die')
+        try:
+            if self._api is not None:
+                self._stop_api()
+            else:
+                self._stop_cli()
+        except Exception:
+            self.expected_event(self.uuid, 'die')  # not anymore
+            raise
+
+    def _stop_cli(self):
+        # the unit only waits for the container
         self._runner.stop()
+        self._running = False
+        self._remove_container()
+        self._pid = 0
+
+    def resync(self):
+        """
+        Rebuilds the state of a container started before,
+        asking docker about it.
+        """
+        if self._api is not None:
+            self._resync_api()
+            return
+        try:
+            pid = self._fetch_pid()
+        except command.Failed:
+            raise runner.OperationFailed(
+                'docker container %s not found' % self._uuid)
+        if not pid:
+            raise runner.OperationFailed(
+                'docker container %s not running' % self._uuid)
+        self._pid = pid
+        self._running = True
+        self._log.info('docker container %s pid %i resynced',
+                       self._uuid, self._pid)
+
+    def _remove_container(self):
+        try:
+            self._docker_stop()
+            self._docker_rm()
+        except command.Failed as exc:
+            raise runner.OperationFailed(str(exc))
+
+    def _fetch_pid(self):
+        out = self._docker_pid().strip()
+        try:
+            return int(out)
+        except ValueError:
+            self._log.warning('docker container %s unknown pid %r',
+                              self._uuid, out)
+            return 0
+
+    def _start_api(self, image):
+        try:
+            container_id = self._api.create(
+                self.unit_name(), image,
+                HostConfig={
+                    'Memory': int(self._run_conf.memory_size_mib) << 20,
+                    'CgroupParent': self.cgroup_parent(),
+                },
+            )
+        except dockerapi.Error as exc:
+            raise runner.OperationFailed(str(exc))
+        try:
+            self._api.start(container_id)
+            info = self._api.inspect(container_id)
+        except dockerapi.Error as exc:
+            self._discard_api(container_id)
+            raise runner.OperationFailed(str(exc))
+        self._container_id = container_id
+        self._pid = info['State']['Pid']
+        self._log.info('docker container %s id %s pid %i',
+                       self._uuid, container_id, self._pid)
+
+    def _resync_api(self):
+        try:
+            info = self._api.inspect(self.unit_name())
+        except dockerapi.NotFound:
+            raise runner.OperationFailed(
+                'docker container %s not found' % self._uuid)
+        except dockerapi.Error as exc:
+            raise runner.OperationFailed(str(exc))
+        if not info['State'].get('Running'):
+            raise runner.OperationFailed(
+                'docker container %s not running' % self._uuid)
+        self._container_id = info['Id']
+        self._pid = info['State']['Pid']
+        self._log.info('docker container %s id %s pid %i resynced',
+                       self._uuid, self._container_id, self._pid)
+
+    def _stop_api(self):
+        try:
+            self._api.stop(self._container_id)
+            self._api.remove(self._container_id)
+        except dockerapi.NotFound:
+            pass  # already gone, nothing to do
+        except dockerapi.Error as exc:
+            raise runner.OperationFailed(str(exc))
+        self._container_id = None
+        self._pid = 0
+
+    def _discard_api(self, container_id):
+        try:
+            self._api.remove(container_id, force=True)
+        except dockerapi.NotFound:
+            pass  # already gone, nothing to do
+        except dockerapi.Error:
+            self._log.exception('cannot remove docker container %s (%s)',
+                                self._uuid, container_id)
+
+
+class EventWatcher(object):
+    """
+    Holds one subscription to the event stream of the daemon, and
+    calls `callback(rt_uuid, action, attributes)` for each event about
+    a convirt container. Subscribes again if the stream breaks.
+    """
+
+    _log = logging.getLogger('convirt.runtime.Docker')
+
+    ACTIONS = ('start', 'die', 'oom')
+
+    _RETRY_DELAY = 1.  # seconds
+
+    def __init__(self, client, callback):
+        self._client = client
+        self._callback = callback
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._stream = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='docker-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            stream = self._stream
+        if stream is not None:
+            stream.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        filters = {'type': ['container'], 'event': list(self.ACTIONS)}
+        while not self._stopped.is_set():
+            try:
+                stream = self._client.events(filters)
+            except dockerapi.Error as exc:
+                self._log.warning('cannot subscribe to events: %s', exc)
+                self._stopped.wait(self._RETRY_DELAY)
+                continue
+            with self._lock:
+                self._stream = stream
+            if self._stopped.is_set():
+                # stop() may have missed the stream
+                stream.close()
+            self._log.debug('subscribed to events')
+            try:
+                for event in stream:
+                    self._dispatch(event)
+            except dockerapi.Error as exc:
+                self._log.warning('event stream broken: %s', exc)
+            finally:
+                with self._lock:
+                    self._stream = None
+                stream.close()
+            self._stopped.wait(self._RETRY_DELAY)
+
+    def _dispatch(self, event):
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        name = attributes.get('name', '')
+        if not name.startswith(runner.PREFIX):
+            return
+        action = event.get('Action', event.get('status'))
+        rt_uuid = name[len(runner.PREFIX):]
+        if Docker.expected_event(rt_uuid, action):
+            self._log.debug('container %r: own event %r', rt_uuid, action)
+            return
+        try:
+            self._callback(rt_uuid, action, attributes)
+        except Exception:
+            self._log.exception('error handling event %r', event)
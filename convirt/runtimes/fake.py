@@ -17,11 +17,25 @@
 #
 # Refer to the README and COPYING files for full details of the license
 #
+"""
+Runtime which runs nothing, to exercise convirt itself.
+
+Each operation can be given a latency, drawn from a distribution,
+and a failure rate; running containers report simulated cgroup
+stats. This allows to load test the concurrency, the locking and
+the event paths with many thousands of containers on a single host.
+"""
 from __future__ import absolute_import
 
+import itertools
 import logging
+import math
+import random
+import threading
+import time
 
 from .. import runner
+from ..metrics import cgroups
 from . import ContainerRuntime
 
 
@@ -31,6 +45,137 @@ def register():
     }
 
 
+class Latency(object):
+    """
+    How long an operation takes, in seconds. Build it with
+    fixed(), uniform() or lognormal().
+    """
+
+    DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+    def __init__(self, dist, *params):
+        if dist not in self.DISTRIBUTIONS:
+            raise ValueError('unknown distribution: %r' % dist)
+        self.dist = dist
+        self.params = params
+
+    @classmethod
+    def fixed(cls, value=0.):
+        return cls('fixed', value)
+
+    @classmethod
+    def uniform(cls, low, high):
+        return cls('uniform', low, high)
+
+    @classmethod
+    def lognormal(cls, median, sigma):
+        """
+        Long tailed: half of the samples are below `median`,
+        `sigma` is the standard deviation of the underlying normal.
+        """
+        return cls('lognormal', math.log(median), sigma)
+
+    def sample(self, rand=random):
+        if self.dist == 'uniform':
+            return rand.uniform(*self.params)
+        if self.dist == 'lognormal':
+            return rand.lognormvariate(*self.params)
+        return self.params[0]
+
+    def __repr__(self):
+        return 'Latency(%s)' % ', '.join(
+            repr(item) for item in (self.dist,) + self.params)
+
+
+class Behavior(object):
+    """
+    How the fake containers behave: `latencies` maps each action
+    (start, stop, resync) to a Latency, `failures` maps each action
+    to the probability it fails. Missing actions complete at once,
+    and never fail. `seed` makes the run reproducible.
+    """
+
+    ACTIONS = ('start', 'stop', 'resync')
+
+    def __init__(self, latencies=None, failures=None, seed=None):
+        self.latencies = {} if latencies is None else dict(latencies)
+        self.failures = {} if failures is None else dict(failures)
+        for action in set(self.latencies) | set(self.failures):
+            if action not in self.ACTIONS:
+                raise ValueError('unknown action: %r' % action)
+        self.rand = random.Random(seed)
+
+    def delay(self, action):
+        latency = self.latencies.get(action)
+        if latency is None:
+            return 0.
+        return max(0., latency.sample(self.rand))
+
+    def fails(self, action):
+        rate = self.failures.get(action, 0.)
+        return rate > 0. and self.rand.random() < rate
+
+    def __repr__(self):
+        return 'Behavior(latencies=%r, failures=%r)' % (
+            self.latencies, self.failures)
+
+
+class Stats(object):
+    """
+    Simulated cgroups.Monitorable of a fake container: the memory
+    wobbles around a working set, the CPU time grows with the load.
+    """
+
+    # USER_HZ, the unit of cpuacct.stat
+    _TICKS = 100
+
+    def __init__(self, pid, memory_kib, load, rand=random, now=time.time):
+        self._pid = pid
+        self._memory_kib = memory_kib
+        self._load = load
+        self._rand = rand
+        self._now = now
+        self._since = now()
+        self._info = {}
+
+    @property
+    def pid(self):
+        return self._pid
+
+    @property
+    def cgroups(self):
+        return ('cpuacct', 'memory')
+
+    @property
+    def unavailable(self):
+        return ()
+
+    def update(self):
+        ticks = (self._now() - self._since) * self._TICKS * self._load
+        self._info = {
+            'cpuacct': cgroups.Cpuacct.Stats(
+                user=int(ticks * 0.8),
+                system=int(ticks * 0.2),
+            ),
+            'memory': cgroups.Memory.Stats(
+                rss=self._memory_kib * self._rand.uniform(0.95, 1.05),
+                swap=0.,
+            ),
+        }
+
+    @property
+    def cpuacct(self):
+        return self._info.get('cpuacct')
+
+    @property
+    def memory(self):
+        return self._info.get('memory')
+
+    @property
+    def blkio(self):
+        return None
+
+
 class Fake(ContainerRuntime):
 
     _log = logging.getLogger('convirt.runtime.Fake')
@@ -39,22 +184,60 @@ class Fake(ContainerRuntime):
 
     _PREFIX = 'fake-'
 
+    # overridden by conf.fake_behavior, if present
+    BEHAVIOR = Behavior()
+
+    # memory of the containers without a configuration
+    _MEMORY_MIB = 256
+
+    # unlikely to clash with real processes
+    _pids = itertools.count(4 << 20)
+
     def __init__(self,
                  conf,
                  repo,
                  rt_uuid=None):
         super(Fake, self).__init__(conf, repo, rt_uuid)
         self._log.debug('fake runtime %s', self._uuid)
+        self._behavior = (
+            self.BEHAVIOR if conf.fake_behavior is None else
+            conf.fake_behavior
+        )
+        self._lock = threading.Lock()
         self._running = False
+        self._stats = None
         self._actions = {
             'start': 0,
             'stop': 0,
             'resync': 0,
         }
+        self._failures = {
+            'start': 0,
+            'stop': 0,
+            'resync': 0,
+        }
 
     @property
     def actions(self):
-        return self._actions.copy()
+        with self._lock:
+            return self._actions.copy()
+
+    @property
+    def failures(self):
+        with self._lock:
+            return self._failures.copy()
+
+    @property
+    def behavior(self):
+        return self._behavior
+
+    @property
+    def stats(self):
+        """
+        The simulated cgroups.Monitorable of the container,
+        None if not running.
+        """
+        return self._stats
 
     @staticmethod
     def available():
@@ -72,15 +255,44 @@ class Fake(ContainerRuntime):
         if self.running:
             raise runner.OperationFailed('already running')
 
-        self._actions['start'] += 1
+        self._act('start')
+        self._pid = next(self._pids)
+        memory_mib = (
+            self._MEMORY_MIB if self._run_conf is None else
+            int(self._run_conf.memory_size_mib)
+        )
+        rand = self._behavior.rand
+        self._stats = Stats(
+            self._pid,
+            memory_kib=(memory_mib << 10) * rand.uniform(0.3, 0.8),
+            load=rand.uniform(0.01, 0.5),
+            rand=rand,
+        )
         self._running = True
 
     def stop(self):
         if not self.running:
             raise runner.OperationFailed('not running')
 
-        self._actions['stop'] += 1
+        self._act('stop')
         self._running = False
+        self._stats = None
+        self._pid = 0
 
     def resync(self):
-        self._actions['resync'] += 1
+        self._act('resync')
+
+    def _act(self, action):
+        delay = self._behavior.delay(action)
+        if delay > 0.:
+            _sleep(delay)
+        with self._lock:
+            self._actions[action] += 1
+            failed = self._behavior.fails(action)
+            if failed:
+                self._failures[action] += 1
+        if failed:
+            raise runner.OperationFailed('simulated %s failure' % action)
+
+
+_sleep = time.sleep
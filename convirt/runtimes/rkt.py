@@ -19,11 +19,15 @@
 #
 from __future__ import absolute_import
 
+import collections
+import functools
 import json
 import logging
 import os
 import os.path
+import threading
 
+from ..config import environ
 from ..config import network
 from .. import command
 from .. import fs
@@ -43,12 +47,46 @@ _TEMPLATES = {
         '${image} '
         '--memory=${memsize}M',
 
-    'rkt_status':
+    'rkt_status': command.ReadOnly(
         'status '
+        '${rkt_uuid}'
+    ),
+
+    'rkt_prepare':
+        '--insecure-options=image '  # FIXME
+        'prepare '
+        '--quiet '
+        '${image} '
+        '--memory=${memsize}M',
+
+    'rkt_run_prepared':
+        'run-prepared '
+        '--net=${network} '
         '${rkt_uuid}',
+
+    'rkt_rm':
+        'rm '
+        '${rkt_uuid}',
+
+    'rkt_list': command.ReadOnly(
+        'list '
+        '--format=json'
+    ),
 }
 
 
+PodStatus = collections.namedtuple('PodStatus', ['state', 'pid'])
+
+
+# saved at start, to resync without running rkt. `start_time` is the
+# one in /proc/<pid>/stat, to detect pid reuse.
+PodRecord = collections.namedtuple(
+    'PodRecord', ['rkt_uuid', 'pid', 'start_time', 'cgroup'])
+
+
+_PROCBASE = '/proc'
+
+
 def register():
     res = {}
     if Rkt.available():
@@ -68,6 +106,15 @@ class Rkt(ContainerRuntime):
 
     _RKT_UUID_FILE = 'rkt_uuid'
 
+    # the last snapshot taken by list_pods()
+    _pods = {}
+
+    _pods_time = 0.
+
+    _pods_lock = threading.Lock()
+
+    _PODS_MAX_AGE = 2.  # seconds
+
     @staticmethod
     def available():
         rkt = command.executables['rkt']
@@ -85,7 +132,10 @@ class Rkt(ContainerRuntime):
             'rkt runtime %s uuid_path=[%s]',
             self._uuid, self._rkt_uuid_path
         )
+        self._record_path = self._rkt_uuid_path + '.json'
         self._rkt_uuid = None
+        self._prepared_uuid = None
+        self._cgroup = None
         self._rkt_run = self._runner.repo.get(
             'rkt', _TEMPLATES['rkt_run'],
             uuid_path=self._rkt_uuid_path,
@@ -93,6 +143,57 @@ class Rkt(ContainerRuntime):
         self._rkt_status = self._runner.repo.get(
             'rkt', _TEMPLATES['rkt_status'],
         )
+        self._rkt_prepare = self._runner.repo.get(
+            'rkt', _TEMPLATES['rkt_prepare'],
+        )
+        self._rkt_run_prepared = self._runner.repo.get(
+            'rkt', _TEMPLATES['rkt_run_prepared'],
+        )
+        self._rkt_rm = self._runner.repo.get(
+            'rkt', _TEMPLATES['rkt_rm'],
+        )
+
+    @classmethod
+    def list_pods(cls, repo=None):
+        """
+        Returns the status of all the pods known to rkt, as a dict
+        of PodStatus keyed by rkt UUID, running rkt only once.
+        The result is kept as a class-wide snapshot, which the
+        containers use instead of querying rkt one by one.
+        """
+        repo = command.Repo() if repo is None else repo
+        rkt_list = repo.get('rkt', _TEMPLATES['rkt_list'])
+        output = rkt_list()
+        if isinstance(output, bytes):
+            output = output.decode('utf-8')
+        pods = _parse_pod_list(output)
+        with cls._pods_lock:
+            cls._pods = pods
+            cls._pods_time = command.monotonic_time()
+        return pods
+
+    @classmethod
+    def get_stopped(cls, repo=None, conf=None):
+        """
+        Returns the runtime UUIDs of the containers which were started
+        with rkt, and whose pod is not running anymore.
+        """
+        conf = environ.current() if conf is None else conf
+        pods = cls.list_pods(repo)
+        stopped = []
+        for rt_uuid, rkt_uuid in _saved_rkt_uuids(conf.run_dir, cls.NAME):
+            pod = pods.get(rkt_uuid)
+            if pod is None or pod.state != 'running':
+                stopped.append(rt_uuid)
+        return stopped
+
+    @classmethod
+    def _cached_pod(cls, rkt_uuid):
+        with cls._pods_lock:
+            age = command.monotonic_time() - cls._pods_time
+            if age > cls._PODS_MAX_AGE:
+                return None
+            return cls._pods.get(rkt_uuid)
 
     @classmethod
     def configure_runtime(cls):
@@ -104,9 +205,42 @@ class Rkt(ContainerRuntime):
     def running(self):
         return self._rkt_uuid is not None
 
+    @property
+    def cgroup(self):
+        return self._cgroup
+
+    @property
+    def prepared(self):
+        return self._prepared_uuid is not None
+
+    def prepare(self, target=None):
+        """
+        Renders the pod with `rkt prepare`, so the next start() only
+        needs to launch it with `rkt run-prepared`.
+        """
+        if self.running:
+            raise runner.OperationFailed('already running')
+        if self.prepared:
+            raise runner.OperationFailed('already prepared')
+        out = self._rkt_prepare(
+            image=self._run_conf.image_path if target is None else target,
+            memsize=self._run_conf.memory_size_mib,
+        )
+        lines = out.decode('utf-8').strip().splitlines()
+        if not lines:
+            raise runner.OperationFailed('rkt prepare returned no UUID')
+        self._prepared_uuid = lines[-1].strip()
+        self._log.info('rkt container %s prepared rkt_uuid %s',
+                       self._uuid, self._prepared_uuid)
+
     def start(self, target=None):
         if self.running:
             raise runner.OperationFailed('already running')
+        if self.prepared:
+            if target is None:
+                self._start_prepared()
+                return
+            self._discard_prepared()
         fs.rm_file(self._rkt_uuid_path)
         self._runner.start(
             command=self._rkt_run,
@@ -114,40 +248,199 @@ class Rkt(ContainerRuntime):
             network=self._run_conf.network,
             memsize=self._run_conf.memory_size_mib,
         )
-        self._retry(
-            'read rkt UUID', self._read_rkt_uuid, self._rkt_uuid_path
-        )
+        self._wait_rkt_uuid()
         self._retry(
             'fetch rkt state', self._fetch_rkt_state
         )
+        self._save_record()
+
+    def start_async(self, callback, target=None):
+        """
+        Starts the pod without waiting for systemd to activate its unit;
+        the rkt state is then collected in the background.
+        Prepared pods, and runners which can't track the start, fall
+        back to the synchronous start.
+        """
+        if (self.running or self.prepared or
+                not self._runner.ASYNC_START):
+            super(Rkt, self).start_async(callback, target)
+            return
+        fs.rm_file(self._rkt_uuid_path)
+        self._runner.start_async(
+            callback=functools.partial(self._unit_started, callback),
+            command=self._rkt_run,
+            image=self._run_conf.image_path if target is None else target,
+            network=self._run_conf.network,
+            memsize=self._run_conf.memory_size_mib,
+        )
+
+    def _unit_started(self, callback, job):
+        # called from the StartTracker thread, which must not block
+        # waiting for the rkt UUID
+        thread = threading.Thread(
+            target=self._finish_start, args=(callback, job),
+            name='convirt-rkt-start-%s' % self._uuid)
+        thread.daemon = True
+        thread.start()
+
+    def _finish_start(self, callback, job):
+        try:
+            if not job.succeeded:
+                raise runner.OperationFailed(
+                    'unit %s not started' % job.unit_name)
+            self._wait_rkt_uuid()
+            self._retry(
+                'fetch rkt state', self._fetch_rkt_state
+            )
+            self._save_record()
+        except Exception as exc:
+            self._log.error('rkt container %s failed to start: %s',
+                            self._uuid, exc)
+            callback(exc)
+        else:
+            callback(None)
 
     def stop(self):
         if not self.running:
             raise runner.OperationFailed('not running')
 
         self._runner.stop(self.runtime_name())
-        try:
-            os.remove(self._rkt_uuid_path)
-        except OSError:
-            pass  # TODO
+        for path in (self._rkt_uuid_path, self._record_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # TODO
         self._rkt_uuid = None
+        self._cgroup = None
+
+    def teardown(self):
+        if self.prepared:
+            self._discard_prepared()
+
+    def resync(self):
+        """
+        Rebuilds the state of a container started before, from the
+        files saved in run_dir at start. If the saved record is missing
+        or stale, queries rkt, using the pod snapshot if fresh.
+        """
+        try:
+            self._rkt_uuid = self._read_file(self._rkt_uuid_path).strip()
+        except IOError:
+            raise runner.OperationFailed(
+                'rkt UUID file %r not found' % self._rkt_uuid_path)
+
+        rec = _load_record(self._record_path)
+        if rec is not None and _matches(rec, self._rkt_uuid):
+            self._pid = rec.pid
+            self._cgroup = rec.cgroup
+            self._log.info('rkt container %s rkt_uuid %s resynced',
+                           self._uuid, self._rkt_uuid)
+            return
+
+        self._log.debug('rkt container %s record missing or stale',
+                        self._uuid)
+        try:
+            self._fetch_rkt_state()
+        except NotYetReady:
+            self._rkt_uuid = None
+            raise runner.OperationFailed('rkt container %s not running' %
+                                         self._uuid)
+        self._save_record()
 
     def runtime_name(self):
         if self._rkt_uuid is None:
             return None
         return '%s%s' % (self._PREFIX, self._rkt_uuid)
 
+    def _start_prepared(self):
+        rkt_uuid = self._prepared_uuid
+        # run-prepared does not save the UUID, but the rest of
+        # the runtime, and recovery, expect the file
+        with open(self._rkt_uuid_path, 'wt') as dst:
+            dst.write(rkt_uuid)
+        try:
+            self._runner.start(
+                command=self._rkt_run_prepared,
+                network=self._run_conf.network,
+                rkt_uuid=rkt_uuid,
+            )
+        except (command.Failed, runner.OperationFailed):
+            # the pod would be left prepared forever
+            fs.rm_file(self._rkt_uuid_path)
+            self._discard_prepared()
+            raise
+        self._prepared_uuid = None
+        self._rkt_uuid = rkt_uuid
+        self._retry(
+            'fetch rkt state', self._fetch_rkt_state
+        )
+        self._save_record()
+
+    def _discard_prepared(self):
+        rkt_uuid, self._prepared_uuid = self._prepared_uuid, None
+        self._log.debug('rkt container %s discarding prepared %s',
+                        self._uuid, rkt_uuid)
+        try:
+            self._rkt_rm(rkt_uuid=rkt_uuid)
+        except command.Failed:
+            # rkt gc will take care of it
+            self._log.warning('cannot remove prepared pod %s', rkt_uuid)
+
+    def _wait_rkt_uuid(self):
+        try:
+            found = fs.wait_for_file(
+                self._rkt_uuid_path, self.wait_policy.deadline)
+        except fs.WatchUnavailable as exc:
+            self._log.debug('cannot watch %r (%s), polling',
+                            self._rkt_uuid_path, exc)
+        else:
+            if not found:
+                raise runner.OperationFailed(
+                    'rkt UUID file %r not written' % self._rkt_uuid_path)
+        # reads at once if the file was found, polls otherwise
+        self._retry(
+            'read rkt UUID', self._read_rkt_uuid, self._rkt_uuid_path
+        )
+
     def _read_rkt_uuid(self, path):
         try:
             data = self._read_file(path)
         except IOError:
             raise NotYetReady('container not running')
-        else:
-            self._rkt_uuid = data.strip()
-            self._log.info('rkt container %s rkt_uuid %s',
-                           self._uuid, self._rkt_uuid)
+        rkt_uuid = data.strip()
+        if not rkt_uuid:
+            # created, but not yet written
+            raise NotYetReady('rkt UUID not yet written')
+        self._rkt_uuid = rkt_uuid
+        self._log.info('rkt container %s rkt_uuid %s',
+                       self._uuid, self._rkt_uuid)
+
+    def _save_record(self):
+        self._cgroup = _read_cgroup(self._pid, self.unit_name())
+        rec = PodRecord(
+            rkt_uuid=self._rkt_uuid,
+            pid=self._pid,
+            start_time=_start_time(self._pid),
+            cgroup=self._cgroup,
+        )
+        tmp_path = self._record_path + '.tmp'
+        try:
+            with open(tmp_path, 'wt') as dst:
+                json.dump(rec._asdict(), dst)
+            os.rename(tmp_path, self._record_path)
+        except (IOError, OSError):
+            # not fatal: resync will query rkt
+            self._log.warning('cannot save the record of %s',
+                              self._uuid, exc_info=True)
 
     def _fetch_rkt_state(self):
+        pod = self._cached_pod(self._rkt_uuid)
+        if pod is not None and pod.state == 'running' and pod.pid:
+            self._pid = pod.pid
+            self._log.info('rkt container %s rkt_uuid %s state %s (cached)',
+                           self._uuid, self._rkt_uuid, pod.state)
+            return
+
         out = self._rkt_status(rkt_uuid=self._rkt_uuid)
 
         # TODO: find a better solution
@@ -161,6 +454,77 @@ class Rkt(ContainerRuntime):
                        self._uuid, self._rkt_uuid, data['state'])
 
 
+def _parse_pod_list(output):
+    pods = {}
+    for item in json.loads(output) or ():
+        pods[item['name']] = PodStatus(
+            state=item.get('state'),
+            pid=int(item.get('pid', 0)),
+        )
+    return pods
+
+
+def _saved_rkt_uuids(run_dir, ext):
+    suffix = '.%s' % ext
+    try:
+        names = os.listdir(run_dir)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith(suffix):
+            continue
+        try:
+            data = fs.read_file(os.path.join(run_dir, name))
+        except IOError:
+            continue  # removed meanwhile
+        yield name[:-len(suffix)], data.strip()
+
+
+def _load_record(path):
+    try:
+        data = json.loads(fs.read_file(path))
+        return PodRecord(**data)
+    except (IOError, ValueError, TypeError):
+        return None
+
+
+def _matches(rec, rkt_uuid):
+    """
+    Tells if the saved record still describes the pod `rkt_uuid`: the
+    process must be alive, and be the same one, not a reused pid.
+    """
+    if rec.rkt_uuid != rkt_uuid or rec.start_time is None:
+        return False
+    start_time = _start_time(rec.pid)
+    return start_time is not None and start_time == rec.start_time
+
+
+def _start_time(pid):
+    """
+    Returns the start time of `pid`, in clock ticks since boot,
+    or None if the process does not exist.
+    """
+    try:
+        data = fs.read_file('%s/%i/stat' % (_PROCBASE, pid))
+    except IOError:
+        return None
+    # the command name may contain spaces and parens
+    fields = data[data.rfind(')') + 2:].split()
+    return int(fields[19])
+
+
+def _read_cgroup(pid, unit_name):
+    try:
+        data = fs.read_file('%s/%i/cgroup' % (_PROCBASE, pid))
+    except IOError:
+        return None
+    for line in data.splitlines():
+        path = line.split(':', 2)[-1]
+        if unit_name in path:
+            return path
+    return None
+
+
 def _parse_keyval(output):
     res = {}
     for line in output.splitlines():
@@ -0,0 +1,331 @@
+#
+# Copyright 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+"""
+Benchmarks. They time things instead of checking behaviour, so they
+are not part of the test suite; run them explicitly:
+
+    python -m tests.bench [NAME...]
+
+runs all the benchmarks, or only the named ones, and prints the
+timings. Unless noted, the commands run are the fake ones from
+tests/fake/bin, so the numbers measure the overhead of convirt,
+not the cost of the real tools.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+from contextlib import contextmanager
+import collections
+import io
+import logging
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import uuid
+import xml.etree.ElementTree as ET
+
+import six
+
+import convirt
+import convirt.command
+import convirt.runner
+import convirt.runtime
+import convirt.runtimes.docker
+import convirt.runtimes.fake
+from convirt.runtimes import rkt
+
+from . import fakedocker
+from . import monkey
+from . import testlib
+
+
+_BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(func):
+    _BENCHMARKS[func.__name__] = func
+    return func
+
+
+@contextmanager
+def fake_environment():
+    """
+    Like testlib.RunnableTestCase: the fake executables, and a
+    temporary run_dir, which is yielded.
+    """
+    run_dir = tempfile.mkdtemp()
+    patch = monkey.Patch([
+        (rkt.Network, 'DIR', run_dir),
+        (convirt.command, 'executables', testlib.fake_executables()),
+    ])
+    patch.apply()
+    try:
+        convirt.runtime.clear()
+        convirt.runtime.configure()
+        yield run_dir
+    finally:
+        patch.revert()
+        shutil.rmtree(run_dir)
+
+
+def per_call(seconds, rounds, scale=1e3):
+    return seconds * scale / rounds
+
+
+@benchmark
+def cmdline(rounds=2000):
+    sdrun = convirt.command.Command(
+        testlib.fake_executables()['systemd-run'],
+        convirt.runner._TEMPLATES['systemd-run'],
+        unit='convirt-test', slice='convirt')
+    inner = convirt.command.Command.from_name(
+        'echo', '--name=${unit_name} ${image}', unit_name='test')
+    kwargs = {
+        'command': inner, 'image': '/path/to/image',
+        'accounting': convirt.runner._accounting_options('full'),
+    }
+    fast = timeit.timeit(lambda: sdrun.cmdline(**kwargs), number=rounds)
+    slow = timeit.timeit(lambda: sdrun._cmdline_slow(**kwargs),
+                         number=rounds)
+    print('cmdline: compiled %.2f us/call, shlex %.2f us/call' % (
+        per_call(fast, rounds, 1e6), per_call(slow, rounds, 1e6)))
+
+
+@benchmark
+def spawn(rounds=20):
+    """
+    The cost of fork grows with the memory of the parent,
+    the one of posix_spawn should not.
+    """
+    if not convirt.command.spawn_available():
+        print('spawn: posix_spawn not available')
+        return
+    spawn = convirt.command.SpawnCommand.from_name('true', '')
+    subproc = convirt.command.SubProcCommand.from_name('true', '')
+    ballast = []
+    for size_mib in (0, 64, 256):
+        # make sure the pages are actually touched
+        grow = size_mib * 1024 * 1024 - sum(len(b) for b in ballast)
+        ballast.append(b'x' * grow)
+        fast = timeit.timeit(spawn, number=rounds)
+        slow = timeit.timeit(subproc, number=rounds)
+        print('spawn with +%i MiB RSS: posix_spawn %.2f ms, '
+              'subprocess %.2f ms' % (
+                  size_mib, per_call(fast, rounds), per_call(slow, rounds)))
+    del ballast
+
+
+@benchmark
+def list_units(units=10000, rounds=5):
+    """
+    Parses a synthetic 'systemctl list-units' output of a busy host,
+    as a whole and line by line.
+    """
+    lines = []
+    for idx in range(units):
+        # a busy host: mostly unrelated units
+        name = 'convirt-%s' % uuid.uuid4() if idx % 20 == 0 else \
+            'unrelated-unit-%i' % idx
+        lines.append('%s.service   loaded active running '
+                     'some description of the unit' % name)
+    output = '\n'.join(lines) + '\n'
+
+    def _whole():
+        return list(_parse_whole_output(output))
+
+    def _streaming():
+        stream = io.StringIO(six.text_type(output))
+        return list(convirt.runner._parse_systemctl_list_units(
+            (line.rstrip('\n') for line in stream),
+            convirt.runner.PREFIX))
+
+    whole = timeit.timeit(_whole, number=rounds)
+    streaming = timeit.timeit(_streaming, number=rounds)
+    print('list_units: parse %i units: whole output %.2f ms, '
+          'streaming %.2f ms' % (
+              units, per_call(whole, rounds), per_call(streaming, rounds)))
+
+
+@benchmark
+def unit_modes(rounds=20):
+    """
+    Starts and stops a unit, transient or instance of the template.
+    Runs the fake systemd-run and systemctl, so this measures only
+    the work done by convirt, not the one done by systemd.
+    """
+    with fake_environment() as run_dir:
+        repo = convirt.command.Repo(execs=testlib.fake_executables())
+
+        def _cycle(mode):
+            conf = testlib.make_conf(
+                run_dir=run_dir, unit_dir=run_dir, unit_mode=mode)
+            runr = convirt.runner.create(
+                convirt.runner.PREFIX + str(uuid.uuid4()), repo, conf)
+            runr.start(command='/bin/true')
+            runr.stop()
+
+        transient = timeit.timeit(
+            lambda: _cycle('transient'), number=rounds)
+        instance = timeit.timeit(
+            lambda: _cycle('instance'), number=rounds)
+    print('unit_modes: start+stop (fake executables): '
+          'transient %.2f ms, instance %.2f ms' % (
+              per_call(transient, rounds), per_call(instance, rounds)))
+
+
+@benchmark
+def docker_api(rounds=20):
+    """
+    Starts and stops a docker container with the CLI and with the
+    Engine API. The CLI is the fake one, and the daemon is the fake one
+    from tests/fakedocker.py: this measures only the overhead of
+    convirt, of the processes it runs and of the HTTP round trips.
+    """
+    with fake_environment() as run_dir:
+        daemon = fakedocker.FakeDaemon(os.path.join(run_dir, 'docker.sock'))
+        daemon.start()
+        try:
+            root = ET.fromstring(testlib.minimal_dom_xml())
+            repo = convirt.command.Repo(execs=testlib.fake_executables())
+
+            def _cycle(conf):
+                docker = convirt.runtimes.docker.Docker(conf, repo)
+                docker.configure(root)
+                docker.start()
+                docker.stop()
+
+            cli = timeit.timeit(
+                lambda: _cycle(testlib.make_conf(run_dir=run_dir)),
+                number=rounds)
+            api_conf = testlib.make_conf(
+                run_dir=run_dir, docker_api=True,
+                docker_socket=daemon.path)
+            api = timeit.timeit(lambda: _cycle(api_conf), number=rounds)
+        finally:
+            convirt.runtimes.docker.Docker.teardown_runtime()
+            daemon.stop()
+    print('docker_api: start+stop: docker CLI %.2f ms, '
+          'engine API %.2f ms' % (
+              per_call(cli, rounds), per_call(api, rounds)))
+
+
+@benchmark
+def fake_load(containers=10000, workers=100):
+    """
+    Starts and destroys many fake domains concurrently, through the
+    runtime registry and Domain. The fake runtime only simulates the
+    latencies, so this measures the overhead of convirt under load.
+    """
+    with fake_environment() as run_dir:
+        conf = testlib.make_conf(
+            run_dir=run_dir,
+            fake_behavior=convirt.runtimes.fake.Behavior(
+                latencies={
+                    'start': convirt.runtimes.fake.Latency.lognormal(
+                        0.0005, 0.5),
+                    'stop': convirt.runtimes.fake.Latency.uniform(
+                        0., 0.0005),
+                },
+                failures={'start': 0.01},
+                seed=0,
+            ),
+        )
+        begin = timeit.default_timer()
+        started, failed = testlib.start_fake_domains(
+            conf, containers, workers)
+        created = timeit.default_timer()
+        for dom in started:
+            dom.destroy()
+        destroyed = timeit.default_timer()
+    print('fake_load: %i domains, %i workers: create %.2f s, '
+          'destroy %.2f s, %i start failures' % (
+              containers, workers, created - begin,
+              destroyed - created, len(failed)))
+
+
+@benchmark
+def registry(rounds=5):
+    """
+    Startup cost of the runtime registry, in a fresh interpreter:
+    creating the first container only imports its own runtime, while
+    supported() has to import and probe all of them.
+    """
+    lazy = _best_startup(
+        'import convirt, convirt.runtime, convirt.command; '
+        'convirt.runtime.create("fake", convirt.config.environ.current(), '
+        'convirt.command.Repo())', rounds)
+    probe_all = _best_startup(
+        'import convirt, convirt.runtime; convirt.runtime.supported()',
+        rounds)
+    print('registry: import convirt + first create(): %.1f ms, '
+          'import convirt + first supported(): %.1f ms' % (
+              lazy * 1e3, probe_all * 1e3))
+
+
+def _best_startup(code, rounds):
+    timer = (
+        'import timeit; begin = timeit.default_timer(); %s; '
+        'print(timeit.default_timer() - begin)' % code)
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return min(
+        float(subprocess.check_output([sys.executable, '-c', timer],
+                                      cwd=topdir))
+        for _ in range(rounds))
+
+
+def _parse_whole_output(output):
+    # the parser as it was before streaming support,
+    # plus filtering by prefix
+    for line in output.splitlines():
+        if not line:
+            continue
+        try:
+            unit, loaded, active, sub, desc = line.split(None, 4)
+        except ValueError:
+            continue
+        if not unit.startswith(convirt.runner.PREFIX):
+            continue
+        if not convirt.runner._is_running_unit(loaded, active, sub):
+            continue
+        try:
+            yield convirt.runner._vm_uuid_from_unit(unit)
+        except ValueError:
+            pass
+
+
+def _main(args):
+    # the fake commands make convirt complain; only the timings matter
+    logging.basicConfig(level=logging.ERROR)
+    names = args or list(_BENCHMARKS)
+    unknown = [name for name in names if name not in _BENCHMARKS]
+    if unknown:
+        sys.stderr.write('unknown benchmarks: %s\navailable: %s\n' % (
+            ' '.join(unknown), ' '.join(_BENCHMARKS)))
+        return 1
+    for name in names:
+        _BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
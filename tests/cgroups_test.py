@@ -65,3 +65,21 @@ class CgroupTests(testlib.CgroupTestCase):
         mon = convirt.metrics.cgroups.Monitorable(self.pid)
         mon.update()
         self.assertEquals(mon.cgroups, ())
+
+    def test_unavailable_default(self):
+        mon = convirt.metrics.cgroups.Monitorable(self.pid)
+        self.assertEquals(mon.unavailable, ())
+
+    def test_unavailable_cpu_memory(self):
+        mon = convirt.metrics.cgroups.Monitorable.from_pid(
+            self.pid, accounting=('CPU', 'Memory'))
+        self.assertEquals(mon.unavailable, ('blkio',))
+        self.assertNotIn('blkio', mon.cgroups)
+        self.assertIs(mon.blkio, None)
+        self.assertIsNot(mon.memory, None)
+
+    def test_unavailable_none(self):
+        mon = convirt.metrics.cgroups.Monitorable.from_pid(
+            self.pid, accounting=())
+        self.assertEquals(mon.unavailable, ('blkio', 'cpuacct', 'memory'))
+        self.assertEquals(mon.cgroups, ())
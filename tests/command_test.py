@@ -20,11 +20,18 @@
 from __future__ import absolute_import
 
 import os
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
 import uuid
 
 import convirt
 import convirt.command
+import convirt.runner
 
 from . import monkey
 from . import testlib
@@ -59,6 +66,60 @@ class PathTests(testlib.TestCase):
             self.assertRaises(convirt.command.NotFound, cp.cmd)
 
 
+class PathCacheTests(testlib.TestCase):
+
+    def setUp(self):
+        convirt.command.clear_cache()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        convirt.command.clear_cache()
+
+    def _make_exec(self, name):
+        path = os.path.join(self.path, name)
+        with open(path, 'wt') as dst:
+            dst.write('#!/bin/sh\n')
+        os.chmod(path, 0o755)
+        return path
+
+    def test_cached(self):
+        path = self._make_exec('foo')
+        calls = []
+
+        def _access(*args):
+            calls.append(args)
+            return True
+
+        cp = convirt.command.Path('foo', paths=[self.path])
+        self.assertEqual(cp.cmd, path)
+        with monkey.patch_scope([(os, 'access', _access)]):
+            for _ in range(10):
+                other = convirt.command.Path('foo', paths=[self.path])
+                self.assertEqual(other.cmd, path)
+        self.assertEqual(calls, [])
+
+    def test_invalidated_on_change(self):
+        path = self._make_exec('foo')
+        with monkey.patch_scope([
+            (convirt.command, '_CACHE_CHECK_INTERVAL', 0),
+        ]):
+            cp = convirt.command.Path('foo', paths=[self.path])
+            self.assertEqual(cp.cmd, path)
+            os.unlink(path)
+            # make sure the mtime changes even on coarse filesystems
+            stat = os.stat(self.path)
+            os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+            self.assertEqual(cp.cmd, None)
+
+    def test_follows_path_env(self):
+        path = self._make_exec('foo')
+        with monkey.patch_scope([(os, 'environ', {'PATH': self.path})]):
+            self.assertEqual(convirt.command.Path('foo').cmd, path)
+        with monkey.patch_scope([(os, 'environ', {'PATH': ''})]):
+            self.assertEqual(convirt.command.Path('foo').cmd, None)
+
+
 class CommandTests(testlib.RunnableTestCase):
 
     def test_from_name(self):
@@ -124,6 +185,106 @@ class CommandTests(testlib.RunnableTestCase):
                           message='test')
 
 
+class TemplateTests(testlib.TestCase):
+
+    def test_literal(self):
+        tmpl = convirt.command.Template('list-units --no-pager')
+        self.assertEqual(tmpl.fill({}), ['list-units', '--no-pager'])
+
+    def test_slots(self):
+        tmpl = convirt.command.Template('--unit=${unit} $name')
+        self.assertEqual(tmpl.fill({'unit': 'foo', 'name': 'bar'}),
+                         ['--unit=foo', 'bar'])
+
+    def test_splice(self):
+        tmpl = convirt.command.Template('--unit=foo ${command}')
+        self.assertEqual(tmpl.fill({'command': ['/bin/true', 'x']}),
+                         ['--unit=foo', '/bin/true', 'x'])
+
+    def test_escaped(self):
+        tmpl = convirt.command.Template('$$HOME')
+        self.assertEqual(tmpl.fill({}), ['$HOME'])
+
+    def test_missing(self):
+        tmpl = convirt.command.Template('${name}')
+        self.assertRaises(KeyError, tmpl.fill, {})
+
+    def test_unsafe_value(self):
+        tmpl = convirt.command.Template('${name}')
+        self.assertRaises(convirt.command.Unsafe,
+                          tmpl.fill, {'name': 'foo bar'})
+
+    def test_unsafe_splice(self):
+        tmpl = convirt.command.Template('--opt=${command}')
+        self.assertRaises(convirt.command.Unsafe,
+                          tmpl.fill, {'command': ['/bin/true']})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, convirt.command.Template, '$1')
+
+
+class CommandCompiledTests(testlib.RunnableTestCase):
+
+    def test_split_value(self):
+        cmd = convirt.command.Command.from_name('echo', '${message}')
+        self.assertEqual(cmd.cmdline(message='foo "bar baz"'),
+                         cmd._cmdline_slow(message='foo "bar baz"'))
+
+    def test_empty_value(self):
+        cmd = convirt.command.Command.from_name('echo', 'a ${message} b')
+        self.assertEqual(cmd.cmdline(message=''), [cmd.path, 'a', 'b'])
+
+    def test_quoted_template(self):
+        cmd = convirt.command.Command.from_name(
+            'echo', '"hello, world" ${message}')
+        self.assertEqual(cmd.cmdline(message='x'),
+                         [cmd.path, 'hello, world', 'x'])
+
+    def test_bound_at_creation(self):
+        cmd = convirt.command.Command.from_name(
+            'echo', '--unit=${unit} ${message}', unit='foo')
+        self.assertEqual(cmd.cmdline(message='x'),
+                         [cmd.path, '--unit=foo', 'x'])
+
+    def test_list_value(self):
+        cmd = convirt.command.Command.from_name('echo', 'a ${items} b')
+        items = ['x', 'y z']
+        self.assertEqual(cmd.cmdline(items=items),
+                         [cmd.path, 'a', 'x', 'y z', 'b'])
+        self.assertEqual(cmd._cmdline_slow(items=items),
+                         [cmd.path, 'a', 'x', 'y z', 'b'])
+
+    def test_same_as_slow_path(self):
+        sdrun = convirt.command.Command(
+            convirt.command.executables['systemd-run'],
+            convirt.runner._TEMPLATES['systemd-run'],
+            unit='convirt-test', slice='convirt')
+        inner = convirt.command.Command.from_name(
+            'echo', '--name=${unit_name} ${image}', unit_name='test')
+        kwargs = {
+            'command': inner, 'image': '/path/to/image',
+            'accounting': convirt.runner._accounting_options('full'),
+        }
+        self.assertEqual(sdrun.cmdline(**kwargs),
+                         sdrun._cmdline_slow(**kwargs))
+
+
+class StreamTests(testlib.TestCase):
+
+    def test_subproc_stream(self):
+        cmd = convirt.command.SubProcCommand.from_name('seq', '${last}')
+        self.assertEqual(list(cmd.stream(last=3)), ['1', '2', '3'])
+
+    def test_subproc_stream_failure(self):
+        cmd = convirt.command.SubProcCommand.from_name('false', '')
+        self.assertRaises(convirt.command.Failed, list, cmd.stream())
+
+    def test_fake_stream(self):
+        cmd = convirt.command.FakeCommand.from_name('echo', '${message}')
+        self.assertEqual(list(cmd.stream(message='test')),
+                         ['%s test' % cmd.path])
+
+
 class FakeCommandTests(testlib.RunnableTestCase):
 
     def test_call(self):
@@ -133,6 +294,465 @@ class FakeCommandTests(testlib.RunnableTestCase):
         self.assertEquals(cmd(message=msg), '%s %s' % (echo.cmd, msg))
 
 
+@unittest.skipIf(not convirt.command.spawn_available(),
+                 'posix_spawn not available')
+class SpawnCommandTests(testlib.TestCase):
+
+    def test_output(self):
+        cmd = convirt.command.SpawnCommand.from_name('echo', '${message}')
+        self.assertEqual(cmd(message='test'), b'test\n')
+
+    def test_failure(self):
+        cmd = convirt.command.SpawnCommand.from_name('false', '')
+        self.assertRaises(convirt.command.Failed, cmd)
+
+    def test_pass_fds(self):
+        rfd, wfd = os.pipe()
+        try:
+            cmd = convirt.command.SpawnCommand(
+                _python_path(), _WRITE_FD_TEMPLATE)
+            cmd.pass_fds = (wfd,)
+            cmd(fd=wfd)
+            self.assertEqual(os.read(rfd, 16), b'test')
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_fds_not_inherited(self):
+        rfd, wfd = os.pipe()
+        try:
+            cmd = convirt.command.SpawnCommand(
+                _python_path(), _WRITE_FD_TEMPLATE)
+            self.assertRaises(convirt.command.Failed, cmd, fd=wfd)
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_inheritable_fds_inherited(self):
+        rfd, wfd = os.pipe()
+        try:
+            os.set_inheritable(wfd, True)
+            cmd = convirt.command.SpawnCommand(
+                _python_path(), _WRITE_FD_TEMPLATE)
+            cmd(fd=wfd)
+            self.assertEqual(os.read(rfd, 16), b'test')
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_reaped_if_read_fails(self):
+        waited = []
+
+        def _fdopen(*args, **kwargs):
+            raise IOError('read failed')
+
+        def _waitpid(pid, options):
+            waited.append(pid)
+            return real_waitpid(pid, options)
+
+        real_waitpid = os.waitpid
+        cmd = convirt.command.SpawnCommand.from_name('true', '')
+        with monkey.patch_scope([(os, 'fdopen', _fdopen),
+                                 (os, 'waitpid', _waitpid)]):
+            self.assertRaises(IOError, cmd)
+        self.assertEqual(len(waited), 1)
+
+
+# the shell can't redirect to descriptors > 9
+_WRITE_FD_TEMPLATE = '-c \'import os; os.write(${fd}, b"test")\''
+
+
+def _python_path():
+    return convirt.command.Path(
+        os.path.basename(sys.executable),
+        paths=[os.path.dirname(sys.executable)])
+
+
+@unittest.skipIf(convirt.command.asyncio is None, 'asyncio not available')
+class AsyncSubProcCommandTests(testlib.TestCase):
+
+    def setUp(self):
+        self.loop = convirt.command.asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, func):
+        # commands must be invoked from within the running loop
+        res = convirt.command.asyncio.Future(loop=self.loop)
+        self.loop.call_soon(_chain, func, res)
+        return self.loop.run_until_complete(res)
+
+    def test_output(self):
+        cmd = convirt.command.AsyncSubProcCommand.from_name(
+            'echo', '${message}')
+        out = self._run(lambda: cmd(message='test'))
+        self.assertEqual(out, b'test\n')
+
+    def test_failure(self):
+        cmd = convirt.command.AsyncSubProcCommand.from_name('false', '')
+        self.assertRaises(convirt.command.Failed,
+                          self._run, lambda: cmd())
+
+    def test_concurrent(self):
+        # each command waits for all the others to be running:
+        # if they ran one at a time, the first one would fail
+        cmd = convirt.command.AsyncSubProcCommand(
+            _python_path(), _RENDEZVOUS_TEMPLATE)
+        async_ = convirt.command.asyncio
+        with testlib.named_temp_dir() as tmp_dir:
+            out = self._run(lambda: async_.gather(
+                *[cmd(path=tmp_dir, count='20') for _ in range(20)]
+            ))
+        self.assertEqual(out, [b'20\n'] * 20)
+
+    def test_cancel_kills(self):
+        cmd = convirt.command.AsyncSubProcCommand(
+            _python_path(), _SLEEP_TEMPLATE)
+        with testlib.named_temp_dir() as tmp_dir:
+            pid_file = os.path.join(tmp_dir, 'pid')
+            futs = []
+            self.loop.call_soon(lambda: futs.append(cmd(path=pid_file)))
+            pid = self._run_until(lambda: _read_pid(pid_file))
+            futs[0].cancel()
+            self._run_until(lambda: not _exists(pid))
+
+    def test_limited(self):
+        rp = convirt.command.Repo(
+            execs={'python': _python_path()},
+            default=convirt.command.AsyncSubProcCommand,
+            limits={'python': 1},
+        )
+        cmd = rp.get('python', _EXCLUSIVE_TEMPLATE)
+        async_ = convirt.command.asyncio
+        with testlib.named_temp_dir() as tmp_dir:
+            marker = os.path.join(tmp_dir, 'running')
+            # fails if another one is running
+            self._run(lambda: async_.gather(
+                *[cmd(path=marker) for _ in range(5)]
+            ))
+        stats = rp.limiters['python'].stats()
+        self.assertEqual(stats.running, 0)
+        self.assertEqual(stats.waiting, 0)
+        self.assertEqual(stats.waited, 4)
+
+    def test_limited_cancel_waiting(self):
+        rp = convirt.command.Repo(
+            execs={'python': _python_path()},
+            default=convirt.command.AsyncSubProcCommand,
+            limits={'python': 1},
+        )
+        sleeper = rp.get('python', _SLEEP_TEMPLATE)
+        limiter = rp.limiters['python']
+        with testlib.named_temp_dir() as tmp_dir:
+            pid_file = os.path.join(tmp_dir, 'pid')
+            futs = []
+            self.loop.call_soon(lambda: futs.extend([
+                sleeper(path=pid_file),
+                sleeper(path=os.path.join(tmp_dir, 'never')),
+            ]))
+            pid = self._run_until(lambda: _read_pid(pid_file))
+            self.assertEqual(limiter.stats().waiting, 1)
+            futs[1].cancel()
+            futs[0].cancel()
+            self._run_until(lambda: limiter.stats().running == 0)
+            self._run_until(lambda: not _exists(pid))
+            self.assertFalse(
+                os.path.exists(os.path.join(tmp_dir, 'never')))
+        out = self._run(lambda: rp.get('python', '-c "print(1)"')())
+        self.assertEqual(out, b'1\n')
+
+    def _run_until(self, pred, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            res = pred()
+            if res:
+                return res
+            self.loop.run_until_complete(
+                convirt.command.asyncio.sleep(0.01))
+        raise AssertionError('condition not met in %is' % timeout)
+
+    def test_repo_default(self):
+        rp = convirt.command.Repo(
+            default=convirt.command.AsyncSubProcCommand)
+        cmd = rp.get('systemctl', '--version')
+        self.assertTrue(
+            isinstance(cmd, convirt.command.AsyncSubProcCommand))
+
+
+_SLEEP_TEMPLATE = (
+    '-c \'import os, time; '
+    'open("${path}", "w").write(str(os.getpid())); '
+    'time.sleep(30)\''
+)
+
+
+_EXCLUSIVE_TEMPLATE = (
+    '-c \'import os, time\n'
+    'fd = os.open("${path}", os.O_CREAT | os.O_EXCL)\n'
+    'time.sleep(0.05)\n'
+    'os.close(fd)\n'
+    'os.unlink("${path}")\''
+)
+
+
+_RENDEZVOUS_TEMPLATE = (
+    '-c \'import os, sys, time\n'
+    'open(os.path.join("${path}", str(os.getpid())), "w").close()\n'
+    'deadline = time.time() + 30\n'
+    'while len(os.listdir("${path}")) < ${count}:\n'
+    '    if time.time() > deadline:\n'
+    '        sys.exit(1)\n'
+    '    time.sleep(0.01)\n'
+    'print(len(os.listdir("${path}")))\''
+)
+
+
+def _read_pid(path):
+    try:
+        with open(path) as src:
+            return int(src.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _exists(pid):
+    # also false once reaped, true while a zombie
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _chain(func, res):
+    def _copy(fut):
+        if fut.exception() is not None:
+            res.set_exception(fut.exception())
+        else:
+            res.set_result(fut.result())
+    func().add_done_callback(_copy)
+
+
+class SingleFlightTests(testlib.TestCase):
+
+    def test_sequential_calls_not_shared(self):
+        flights = convirt.command.SingleFlight()
+        calls = []
+
+        def _func(val):
+            calls.append(val)
+            return val
+
+        self.assertEqual(flights.call('key', _func, 1), 1)
+        self.assertEqual(flights.call('key', _func, 2), 2)
+        self.assertEqual(calls, [1, 2])
+
+    def test_concurrent_calls_shared(self):
+        flights = convirt.command.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def _func():
+            calls.append(None)
+            started.set()
+            release.wait()
+            return 42
+
+        def _call():
+            results.append(flights.call('key', _func))
+
+        leader = threading.Thread(target=_call)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=_call) for _ in range(4)]
+        for t in followers:
+            t.start()
+        # let the followers reach the wait
+        time.sleep(0.05)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [42] * 5)
+
+    def test_error_shared(self):
+        flights = convirt.command.SingleFlight()
+
+        def _fail():
+            raise convirt.command.Failed('test')
+
+        self.assertRaises(convirt.command.Failed,
+                          flights.call, 'key', _fail)
+
+    def test_concurrent_streams_shared(self):
+        flights = convirt.command.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def _lines():
+            calls.append(None)
+            started.set()
+            release.wait()
+            yield 'a'
+            yield 'b'
+
+        def _stream():
+            results.append(list(flights.stream('key', _lines)))
+
+        leader = threading.Thread(target=_stream)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=_stream) for _ in range(4)]
+        for t in followers:
+            t.start()
+        # let the followers reach the wait
+        time.sleep(0.05)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['a', 'b']] * 5)
+
+    def test_stream_leader_stops_early(self):
+        flights = convirt.command.SingleFlight()
+        leader = flights.stream('key', iter, ['a', 'b', 'c'])
+        self.assertEqual(next(leader), 'a')
+        results = []
+        follower = threading.Thread(
+            target=lambda: results.append(
+                list(flights.stream('key', iter, []))))
+        follower.start()
+        # let the follower reach the wait
+        time.sleep(0.05)
+        leader.close()
+        follower.join()
+        self.assertEqual(results, [['a', 'b', 'c']])
+        self.assertEqual(list(flights.stream('key', iter, ['d'])), ['d'])
+
+    def test_stream_not_started(self):
+        flights = convirt.command.SingleFlight()
+        flights.stream('key', iter, ['a'])
+        self.assertEqual(list(flights.stream('key', iter, ['b'])), ['b'])
+
+    def test_stream_error_shared(self):
+        flights = convirt.command.SingleFlight()
+
+        def _fail():
+            raise convirt.command.Failed('test')
+
+        self.assertRaises(convirt.command.Failed,
+                          list, flights.stream('key', _fail))
+
+
+class SlowCommand(convirt.command.FakeCommand):
+
+    def _execute(self, argv):
+        time.sleep(0.1)
+        return super(SlowCommand, self)._execute(argv)
+
+
+class ReadOnlyCommandTests(testlib.TestCase):
+
+    def _run_concurrently(self, cmd, count=8):
+        threads = [threading.Thread(target=cmd, kwargs={'message': 'x'})
+                   for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_read_only_marker(self):
+        cmd = SlowCommand.from_name(
+            'echo', convirt.command.ReadOnly('${message}'))
+        self.assertTrue(cmd.read_only)
+
+    def test_read_only_coalesced(self):
+        cmd = SlowCommand.from_name(
+            'echo', convirt.command.ReadOnly('${message}'))
+        self._run_concurrently(cmd)
+        self.assertEqual(len(cmd.executions), 1)
+
+    def test_read_write_not_coalesced(self):
+        cmd = SlowCommand.from_name('echo', '${message}')
+        self.assertFalse(cmd.read_only)
+        self._run_concurrently(cmd)
+        self.assertEqual(len(cmd.executions), 8)
+
+
+class LimiterTests(testlib.TestCase):
+
+    def test_invalid_limit(self):
+        self.assertRaises(ValueError, convirt.command.Limiter, 0)
+
+    def test_pristine_stats(self):
+        lim = convirt.command.Limiter(4)
+        stats = lim.stats()
+        self.assertEqual(stats.limit, 4)
+        self.assertEqual(stats.running, 0)
+        self.assertEqual(stats.waiting, 0)
+        self.assertEqual(stats.waited, 0)
+
+    def test_bounded(self):
+        LIMIT = 2
+        lim = convirt.command.Limiter(LIMIT)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def _work():
+            with lim:
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.02)
+                with lock:
+                    active[0] -= 1
+
+        threads = [threading.Thread(target=_work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(peak[0], LIMIT)
+        stats = lim.stats()
+        self.assertEqual(stats.running, 0)
+        self.assertEqual(stats.waiting, 0)
+
+    def test_fifo(self):
+        WORKERS = 6
+        lim = convirt.command.Limiter(1)
+        order = []
+
+        def _work(idx):
+            with lim:
+                order.append(idx)
+
+        # take the only slot, then queue the workers in a known order
+        lim.acquire()
+        threads = []
+        for idx in range(WORKERS):
+            t = threading.Thread(target=_work, args=(idx,))
+            t.start()
+            threads.append(t)
+            while lim.stats().waiting < idx + 1:
+                time.sleep(0.001)
+        lim.release()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(order, list(range(WORKERS)))
+        stats = lim.stats()
+        self.assertEqual(stats.waited, WORKERS)
+        self.assertGreater(stats.wait_time_max, 0)
+        self.assertGreaterEqual(stats.wait_time_total, stats.wait_time_max)
+
+
 class RepoTests(testlib.RunnableTestCase):
 
     def test_get_unknown_executable(self):
@@ -146,3 +766,30 @@ class RepoTests(testlib.RunnableTestCase):
         rp = convirt.command.Repo()
         cmd = rp.get('machinectl', 'poweroff ${vmname}')
         self.assertTrue(isinstance(cmd, convirt.command.Command))
+
+    def test_get_without_limits(self):
+        rp = convirt.command.Repo()
+        cmd = rp.get('systemctl', 'list-units')
+        self.assertIs(cmd.limiter, None)
+        self.assertEqual(rp.limiters, {})
+
+    def test_get_limited(self):
+        rp = convirt.command.Repo(
+            execs={'echo': convirt.command.Path('echo')},
+            default=convirt.command.FakeCommand,
+            limits={'echo': 1},
+        )
+        cmd = rp.get('echo', '${message}')
+        self.assertIs(cmd.limiter, rp.limiters['echo'])
+        cmd(message='test')
+        stats = rp.limiters['echo'].stats()
+        self.assertEqual(stats.running, 0)
+        self.assertEqual(stats.waited, 0)
+
+    def test_get_limited_non_blocking(self):
+        rp = convirt.command.Repo(
+            default=convirt.command.AsyncSubProcCommand,
+            limits={'systemctl': 1},
+        )
+        cmd = rp.get('systemctl', '--version')
+        self.assertIs(cmd.limiter, rp.limiters['systemctl'])
@@ -50,7 +50,10 @@ class EnvironTests(ConfigTestsMixin, testlib.TestCase):
     CONFIG_MODULE = convirt.config.environ
 
     def test_setup_new(self):
+        # every setting declared, with new values for the main ones
         conf = convirt.config.environ.Environment(
+            convirt.config.environ.current().items())
+        conf.update(
             uid=42,
             gid=42,
             tools_dir='/usr/local/libexec/convirt/test',
@@ -61,6 +64,16 @@ class EnvironTests(ConfigTestsMixin, testlib.TestCase):
         self.assertEquals(convirt.config.environ.current(), conf)
         self.assertFalse(convirt.config.environ.current() is conf)
 
+    def test_declared_defaults(self):
+        conf = convirt.config.environ.current()
+        self.assertEqual(conf.accounting, 'full')
+        self.assertEqual(conf.unit_mode, 'transient')
+        self.assertFalse(conf.async_start)
+        self.assertFalse(conf.use_helper)
+        self.assertFalse(conf.docker_api)
+        self.assertEqual(conf.wait_policies, {})
+        self.assertIs(conf.fake_behavior, None)
+
     def test_setup(self):
         conf = convirt.config.environ.current()
         conf.run_dir = '/run/convirt/random/dir'
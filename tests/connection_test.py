@@ -133,6 +133,61 @@ class ConnectionAPITests(testlib.FakeRunnableTestCase):
         self.assertTrue(dom)
         dom.destroy()
 
+    def test_defineXML(self):
+
+        self.runners = []
+
+        def _fake_create(*args, **kwargs):
+            rt = testlib.FakeRunner()
+            self.runners.append(rt)
+            return rt
+
+        conn = convirt.openConnection('convirt:///system')
+        with testlib.named_temp_dir() as tmp_dir:
+            with testlib.global_conf(run_dir=tmp_dir):
+                with monkey.patch_scope(
+                    [(convirt.runtime, 'create', _fake_create)]
+                ):
+                    dom = conn.defineXML(testlib.minimal_dom_xml())
+                    rt, = self.runners
+                    self.assertTrue(rt.prepared)
+                    self.assertFalse(rt.started)
+                    self.assertEquals(conn.listAllDomains(0), [])
+
+                    dom.createWithFlags(0)
+                    self.assertTrue(rt.started)
+                    self.assertEquals(conn.listAllDomains(0), [dom])
+
+        dom.destroy()
+
+    def test_destroy_defined(self):
+
+        self.runners = []
+
+        def _fake_create(*args, **kwargs):
+            rt = testlib.FakeRunner()
+            self.runners.append(rt)
+            return rt
+
+        conn = convirt.openConnection('convirt:///system')
+        with testlib.named_temp_dir() as tmp_dir:
+            with testlib.global_conf(run_dir=tmp_dir):
+                with monkey.patch_scope(
+                    [(convirt.runtime, 'create', _fake_create)]
+                ):
+                    dom = conn.defineXML(testlib.minimal_dom_xml())
+                    self.assertIs(
+                        conn.lookupByUUIDString(dom.UUIDString()), dom)
+
+                    dom.destroy()
+
+                    rt, = self.runners
+                    self.assertTrue(rt.teardown_done)
+                    self.assertFalse(rt.stopped)
+                    self.assertRaises(libvirt.libvirtError,
+                                      conn.lookupByUUIDString,
+                                      dom.UUIDString())
+
 
 class FakeDomain(object):
     def __init__(self, vm_uuid):
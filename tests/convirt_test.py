@@ -29,7 +29,9 @@ import convirt.doms
 import convirt.events
 import convirt.monitoring
 import convirt.runner
+import convirt.runtimes.rkt
 
+from . import monkey
 from . import testlib
 
 
@@ -65,5 +67,47 @@ class APITests(testlib.RunnableTestCase):
         self.assertEquals(delivered, expected)
 
 
+class PodsTests(testlib.TestCase):
+
+    def test_without_stopped_pods_rkt_unavailable(self):
+        with monkey.patch_scope([(convirt.runtimes.rkt.Rkt, 'available',
+                                  staticmethod(lambda: False)),
+                                 (convirt.runtimes.rkt.Rkt, 'get_stopped',
+                                  classmethod(_fail))]):
+            self.assertEqual(
+                convirt._without_stopped_pods(lambda: ['a', 'b'], None),
+                ['a', 'b'])
+
+    def test_without_stopped_pods_list_fails(self):
+        with monkey.patch_scope([(convirt.runtimes.rkt.Rkt, 'available',
+                                  staticmethod(lambda: True)),
+                                 (convirt.runtimes.rkt.Rkt, 'list_pods',
+                                  classmethod(_fail))]):
+            self.assertEqual(
+                convirt._without_stopped_pods(lambda: ['a', 'b'], None),
+                ['a', 'b'])
+
+    def test_prefetch_pods_list_fails(self):
+        with monkey.patch_scope([(convirt.runtimes.rkt.Rkt, 'available',
+                                  staticmethod(lambda: True)),
+                                 (convirt.runtimes.rkt.Rkt, 'list_pods',
+                                  classmethod(_fail))]):
+            self.assertNotRaises(convirt._prefetch_pods, None)
+
+    def test_prefetch_pods_bug_not_hidden(self):
+        def _bug(cls, repo):
+            raise AttributeError('bug')
+
+        with monkey.patch_scope([(convirt.runtimes.rkt.Rkt, 'available',
+                                  staticmethod(lambda: True)),
+                                 (convirt.runtimes.rkt.Rkt, 'list_pods',
+                                  classmethod(_bug))]):
+            self.assertRaises(AttributeError, convirt._prefetch_pods, None)
+
+
+def _fail(cls, *args, **kwargs):
+    raise convirt.command.Failed('rkt list failed', 1)
+
+
 def _handler(*args, **kwargs):
     pass
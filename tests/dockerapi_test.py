@@ -0,0 +1,395 @@
+#
+# Copyright 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+from __future__ import absolute_import
+
+import json
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+import convirt
+import convirt.command
+import convirt.dockerapi
+import convirt.runner
+import convirt.runtimes as rts
+import convirt.runtimes.docker
+
+from . import fakedocker
+from . import monkey
+from . import testlib
+
+
+class ClientTests(testlib.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.daemon = fakedocker.FakeDaemon(
+            os.path.join(self.tmp_dir, 'docker.sock'))
+        self.daemon.start()
+        self.client = convirt.dockerapi.Client(self.daemon.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lifecycle(self):
+        cont_id = self.client.create('test', 'busybox')
+        self.assertEqual(
+            self.client.inspect(cont_id)['State']['Status'], 'created')
+        self.client.start(cont_id)
+        self.assertEqual(
+            self.client.inspect('test')['State']['Pid'], 4242)
+        self.client.stop(cont_id)
+        self.assertFalse(
+            self.client.inspect(cont_id)['State']['Running'])
+        self.client.remove(cont_id)
+        self.assertEqual(self.daemon.containers, {})
+
+    def test_create_config(self):
+        cont_id = self.client.create(
+            'test', 'busybox', HostConfig={'Memory': 1 << 20})
+        self.assertEqual(
+            self.daemon.containers[cont_id]['HostConfig'],
+            {'Memory': 1 << 20})
+
+    def test_not_found(self):
+        self.assertRaises(convirt.dockerapi.NotFound,
+                          self.client.inspect, 'nonexistent')
+
+    def test_error(self):
+        self.client.create('test', 'busybox')
+        try:
+            self.client.create('test', 'busybox')
+        except convirt.dockerapi.Error as exc:
+            self.assertEqual(exc.status, 409)
+            self.assertIn('already in use', str(exc))
+        else:
+            self.fail('no error on duplicate name')
+
+    def test_connection_reused(self):
+        cont_id = self.client.create('test', 'busybox')
+        for _ in range(10):
+            self.client.inspect(cont_id)
+        self.assertEqual(self.daemon.connections, 1)
+
+    def test_stale_connection(self):
+        self.client.create('test', 'busybox')
+        # the daemon goes away, and comes back
+        self.daemon.stop()
+        self.daemon.start()
+        self.assertEqual(
+            self.client.inspect('test')['Name'], '/test')
+        self.assertEqual(self.daemon.connections, 2)
+
+    def test_events(self):
+        stream = self.client.events({'type': ['container']})
+        try:
+            _wait_for(lambda: self.daemon.subscribers == 1)
+            self.daemon.emit('die', 'test', exitCode='0')
+            event = next(iter(stream))
+        finally:
+            stream.close()
+        self.assertEqual(event['Action'], 'die')
+        self.assertEqual(event['Actor']['Attributes'],
+                         {'name': 'test', 'exitCode': '0'})
+        self.assertEqual(json.loads(self.daemon.event_filters[0]),
+                         {'type': ['container']})
+
+    def test_events_close_wakes_reader(self):
+        stream = self.client.events()
+        received = []
+        reader = threading.Thread(
+            target=lambda: received.extend(stream))
+        reader.start()
+        _wait_for(lambda: self.daemon.subscribers == 1)
+        stream.close()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(received, [])
+
+    def test_unreachable(self):
+        client = convirt.dockerapi.Client(
+            os.path.join(self.tmp_dir, 'nonexistent.sock'))
+        self.assertRaises(convirt.dockerapi.Error,
+                          client.inspect, 'test')
+
+
+class EventWatcherTests(testlib.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.daemon = fakedocker.FakeDaemon(
+            os.path.join(self.tmp_dir, 'docker.sock'))
+        self.daemon.start()
+        self.events = []
+        self.received = threading.Event()
+
+    def tearDown(self):
+        rts.docker.Docker.teardown_runtime()
+        self.daemon.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _callback(self, *args):
+        self.events.append(args)
+        self.received.set()
+
+    def test_convirt_containers_only(self):
+        rt_uuid = str(uuid.uuid4())
+        rts.docker.Docker.watch_events(self._callback, self.daemon.path)
+        _wait_for(lambda: self.daemon.subscribers == 1)
+        self.daemon.emit('die', 'unrelated', exitCode='0')
+        self.daemon.emit('die', convirt.runner.PREFIX + rt_uuid,
+                         exitCode='137')
+        self.assertTrue(self.received.wait(5))
+        self.assertEqual(self.events, [(
+            rt_uuid, 'die',
+            {'name': convirt.runner.PREFIX + rt_uuid, 'exitCode': '137'},
+        )])
+        filters = json.loads(self.daemon.event_filters[0])
+        self.assertEqual(sorted(filters['event']),
+                         sorted(rts.docker.EventWatcher.ACTIONS))
+
+    def test_watch_twice(self):
+        rts.docker.Docker.watch_events(self._callback, self.daemon.path)
+        self.assertRaises(convirt.runner.OperationFailed,
+                          rts.docker.Docker.watch_events,
+                          self._callback, self.daemon.path)
+
+    def test_unwatch(self):
+        rts.docker.Docker.watch_events(self._callback, self.daemon.path)
+        _wait_for(lambda: self.daemon.subscribers == 1)
+        rts.docker.Docker.unwatch_events()
+        self.assertIs(rts.docker.Docker._watcher, None)
+
+    def test_pushed(self):
+        # all the events come through the one stream, nothing is polled
+        rts.docker.Docker.watch_events(self._callback, self.daemon.path)
+        _wait_for(lambda: self.daemon.subscribers == 1)
+        for _ in range(3):
+            self.daemon.emit('die', convirt.runner.PREFIX + str(uuid.uuid4()))
+        _wait_for(lambda: len(self.events) == 3)
+        self.assertEqual(self.daemon.subscribers, 1)
+        self.assertEqual(len(self.daemon.event_filters), 1)
+        self.assertEqual(self.daemon.requests, [])
+
+
+class DockerAPIRuntimeTests(testlib.RunnableTestCase):
+
+    def setUp(self):
+        super(DockerAPIRuntimeTests, self).setUp()
+        self.daemon = fakedocker.FakeDaemon(
+            os.path.join(self.run_dir, 'docker.sock'))
+        self.daemon.start()
+        self.conf = testlib.make_conf(
+            run_dir=self.run_dir,
+            docker_api=True,
+            docker_socket=self.daemon.path,
+        )
+
+    def tearDown(self):
+        rts.docker.Docker.teardown_runtime()
+        self.daemon.stop()
+        super(DockerAPIRuntimeTests, self).tearDown()
+
+    def _make_docker(self):
+        docker = rts.docker.Docker(self.conf, testlib.FakeRepo())
+        docker.configure(ET.fromstring(testlib.minimal_dom_xml()))
+        return docker
+
+    def test_start_stop(self):
+        docker = self._make_docker()
+        docker.start()
+        try:
+            self.assertTrue(docker.running)
+            self.assertEqual(docker.pid, 4242)
+            cont, = self.daemon.containers.values()
+            self.assertEqual(cont['Name'], '/' + docker.unit_name())
+        finally:
+            docker.stop()
+        self.assertFalse(docker.running)
+        self.assertEqual(self.daemon.containers, {})
+        # the daemon runs the container, nothing else is spawned
+        self.assertEqual(docker._docker_run.executions, [])
+        self.assertEqual(docker._runner._systemd_run.executions, [])
+        self.assertEqual(docker._runner._systemctl_stop.executions, [])
+
+    def test_container_in_slice(self):
+        docker = self._make_docker()
+        docker.start()
+        try:
+            cont, = self.daemon.containers.values()
+            self.assertEqual(cont['HostConfig']['CgroupParent'],
+                             docker.cgroup_parent())
+        finally:
+            docker.stop()
+
+    def test_start_twice(self):
+        docker = self._make_docker()
+        docker.start()
+        try:
+            self.assertRaises(convirt.runner.OperationFailed,
+                              docker.start)
+        finally:
+            docker.stop()
+
+    def test_start_fails(self):
+        docker = self._make_docker()
+        self.daemon.containers['taken'] = {
+            'Id': 'taken', 'Name': '/' + docker.unit_name(), 'State': {},
+        }
+        self.assertRaises(convirt.runner.OperationFailed, docker.start)
+        self.assertFalse(docker.running)
+
+    def test_start_fails_container_removed(self):
+        docker = self._make_docker()
+        self.daemon.broken_images.add(docker.runtime_config.image_path)
+        self.assertRaises(convirt.runner.OperationFailed, docker.start)
+        self.assertFalse(docker.running)
+        self.assertEqual(self.daemon.containers, {})
+        self.assertEqual(docker._runner._systemd_run.executions, [])
+
+    def test_available_without_binary(self):
+        execs = dict(convirt.command.executables)
+        execs['docker'] = convirt.command.Path('docker', paths=())
+        with monkey.patch_scope([(convirt.command, 'executables', execs)]):
+            with testlib.global_conf(docker_api=True,
+                                     docker_socket=self.daemon.path):
+                self.assertTrue(rts.docker.Docker.available())
+            with testlib.global_conf(
+                    docker_api=True,
+                    docker_socket=os.path.join(self.run_dir, 'nothing')):
+                self.assertFalse(rts.docker.Docker.available())
+
+    def test_get_all(self):
+        running = self._make_docker()
+        running.start()
+        stopped = self._make_docker()
+        stopped.start()
+        self.daemon.containers[stopped._container_id]['State'] = {
+            'Running': False, 'Status': 'exited', 'Pid': 0}
+        # the name filter of the daemon matches anywhere in the name
+        self.daemon.containers['other'] = {
+            'Id': 'other', 'Name': '/not-' + running.unit_name(),
+            'State': {'Running': True, 'Status': 'running', 'Pid': 1},
+        }
+        try:
+            self.assertEqual(
+                rts.docker.Docker.get_all(self.daemon.path),
+                [running.uuid])
+        finally:
+            running.stop()
+
+    def test_found_by_monitoring_and_recovery(self):
+        docker = self._make_docker()
+        docker.start()
+        try:
+            with testlib.global_conf(docker_api=True,
+                                     docker_socket=self.daemon.path):
+                self.assertEqual(
+                    convirt._with_docker_api(lambda: ['unit']),
+                    ['unit', docker.uuid])
+                # no units: the fake systemctl lists nothing
+                self.assertEqual(
+                    convirt._recoverable(testlib.FakeRepo()),
+                    [docker.uuid])
+        finally:
+            docker.stop()
+
+    def test_resync(self):
+        docker = self._make_docker()
+        docker.start()
+        recovered = rts.docker.Docker(
+            self.conf, testlib.FakeRepo(), rt_uuid=docker.uuid)
+        recovered.resync()
+        try:
+            self.assertTrue(recovered.running)
+            self.assertEqual(recovered.pid, 4242)
+        finally:
+            recovered.stop()
+        self.assertEqual(self.daemon.containers, {})
+
+    def test_resync_not_found(self):
+        docker = self._make_docker()
+        self.assertRaises(convirt.runner.OperationFailed, docker.resync)
+        self.assertFalse(docker.running)
+
+    def test_own_events_ignored(self):
+        events = []
+        rts.docker.Docker.watch_events(
+            lambda *args: events.append(args), self.daemon.path)
+        _wait_for(lambda: self.daemon.subscribers == 1)
+        docker = self._make_docker()
+        docker.start()
+        docker.stop()
+        # the daemon reports in order: once this one is in, so are the
+        # events of start() and stop()
+        sentinel = convirt.runner.PREFIX + str(uuid.uuid4())
+        self.daemon.emit('die', sentinel, exitCode='0')
+        _wait_for(lambda: events)
+        self.assertEqual([(rt_uuid, action) for rt_uuid, action, _ in events],
+                         [(sentinel[len(convirt.runner.PREFIX):], 'die')])
+        self.assertEqual(rts.docker.Docker._expected, {})
+
+    def test_unexpected_die_delivered(self):
+        events = []
+        rts.docker.Docker.watch_events(
+            lambda *args: events.append(args), self.daemon.path)
+        _wait_for(lambda: self.daemon.subscribers == 1)
+        docker = self._make_docker()
+        docker.start()
+        try:
+            self.daemon.emit('die', docker.unit_name(), exitCode='1')
+            _wait_for(lambda: events)
+            self.assertEqual(events, [(
+                docker.uuid, 'die',
+                {'name': docker.unit_name(), 'exitCode': '1'},
+            )])
+        finally:
+            docker.stop()
+
+    def test_failed_start_expects_nothing(self):
+        rts.docker.Docker.watch_events(lambda *args: None, self.daemon.path)
+        docker = self._make_docker()
+        self.daemon.broken_images.add(docker.runtime_config.image_path)
+        self.assertRaises(convirt.runner.OperationFailed, docker.start)
+        self.assertEqual(rts.docker.Docker._expected, {})
+
+    def test_shared_client(self):
+        first = self._make_docker()
+        second = self._make_docker()
+        self.assertIs(first._api, second._api)
+        first.start()
+        second.start()
+        first.stop()
+        second.stop()
+        self.assertEqual(self.daemon.connections, 1)
+
+
+def _wait_for(pred, timeout=5):
+    deadline = time.time() + timeout
+    while not pred():
+        if time.time() > deadline:
+            raise AssertionError('condition not met in %is' % timeout)
+        time.sleep(0.01)
@@ -27,7 +27,11 @@ import convirt
 import convirt.command
 import convirt.domain
 import convirt.doms
+import convirt.events
+import convirt.runner
+import convirt.runtime
 import convirt.runtimes
+import convirt.runtimes.fake
 
 
 from . import monkey
@@ -150,6 +154,115 @@ class DomainAPITests(testlib.FakeRunnableTestCase):
                           libvirt.VIR_DOMAIN_RUNNING)
 
 
+class AsyncStartTests(testlib.FakeRunnableTestCase):
+
+    def setUp(self):
+        super(AsyncStartTests, self).setUp()
+        convirt.doms.clear()
+        self.fired = []
+        self.root = convirt.events.Handler(name='test')
+        self.root.register(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                           None, None, self._lifecycle)
+
+    def test_started_event(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            conf = testlib.make_conf(run_dir=tmp_dir, async_start=True)
+            with monkey.patch_scope([(convirt.events, 'root', self.root)]):
+                dom = convirt.domain.Domain.create(
+                    testlib.minimal_dom_xml(),
+                    conf,
+                    testlib.FakeRepo(),
+                )
+
+        self.assertTrue(dom._rt.actions['start'])
+        self.assertEqual(self.fired, [
+            (dom.UUIDString(),
+             libvirt.VIR_DOMAIN_EVENT_STARTED,
+             libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED),
+        ])
+        self.assertEqual(convirt.doms.get_all(), [dom])
+
+    def test_pending_until_started(self):
+        dom = self._create(HeldStartFake)
+        vm_uuid = dom.UUIDString()
+        # the watchdog must not see it yet, lookups must
+        self.assertEqual(convirt.doms.get_all(), [])
+        self.assertIs(convirt.doms.get_pending(vm_uuid), dom)
+
+        dom._rt.finish_start(None)
+
+        self.assertEqual(convirt.doms.get_all(), [dom])
+        self.assertRaises(KeyError, convirt.doms.get_pending, vm_uuid)
+        self.assertEqual(self.fired, [
+            (vm_uuid,
+             libvirt.VIR_DOMAIN_EVENT_STARTED,
+             libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED),
+        ])
+
+    def test_failed_start_unregisters(self):
+        dom = self._create(HeldStartFake)
+
+        dom._rt.finish_start(convirt.runner.OperationFailed('unit failed'))
+
+        self.assertEqual(self.fired, [
+            (dom.UUIDString(),
+             libvirt.VIR_DOMAIN_EVENT_STOPPED,
+             libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED),
+        ])
+        self.assertEqual(convirt.doms.get_all(), [])
+        self.assertRaises(KeyError, convirt.doms.get_pending,
+                          dom.UUIDString())
+
+    def test_failed_at_once(self):
+        dom = self._create(FailedStartFake)
+
+        self.assertEqual(convirt.doms.get_all(), [])
+        self.assertRaises(KeyError, convirt.doms.get_pending,
+                          dom.UUIDString())
+
+    def test_destroy_while_starting(self):
+        dom = self._create(HeldStartFake)
+        dom.destroy()
+        self.assertTrue(dom._rt.actions['stop'])
+
+        dom._rt.finish_start(None)
+
+        self.assertEqual(self.fired, [])
+        self.assertEqual(convirt.doms.get_all(), [])
+
+    def _create(self, rt_class):
+        def _create_rt(rt, conf, repo, **kwargs):
+            return rt_class(conf, repo, **kwargs)
+
+        with testlib.named_temp_dir() as tmp_dir:
+            conf = testlib.make_conf(run_dir=tmp_dir, async_start=True)
+            with monkey.patch_scope([
+                (convirt.events, 'root', self.root),
+                (convirt.runtime, 'create', _create_rt),
+            ]):
+                return convirt.domain.Domain.create(
+                    testlib.minimal_dom_xml(), conf, testlib.FakeRepo())
+
+    def _lifecycle(self, conn, dom, event, detail):
+        self.fired.append((dom.UUIDString(), event, detail))
+
+
+class HeldStartFake(convirt.runtimes.fake.Fake):
+    """
+    The start completes only when the test calls finish_start().
+    """
+
+    def start_async(self, callback, target=None):
+        self.start(target)
+        self.finish_start = callback
+
+
+class FailedStartFake(convirt.runtimes.fake.Fake):
+
+    def start_async(self, callback, target=None):
+        callback(convirt.runner.OperationFailed('unit failed'))
+
+
 class UnsupportedAPITests(testlib.RunnableTestCase):
 
     def test_migrate(self):
@@ -0,0 +1,262 @@
+#
+# Copyright 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+"""
+Stand-in for the Docker daemon: serves the subset of the Engine API
+used by convirt over a unix socket, keeping the containers in memory.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import socket
+import threading
+import uuid
+
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.fake.connected(self.connection)
+
+    def log_message(self, *args):
+        pass  # keep the test output clean
+
+    def address_string(self):
+        return 'unix'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        params = dict(
+            (key, val[0]) for key, val in parse_qs(url.query).items()
+        )
+        size = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(size).decode('utf-8')) \
+            if size else None
+        # strip the /v<version> prefix
+        parts = url.path.strip('/').split('/')[1:]
+        if method == 'GET' and parts == ['events']:
+            self._stream_events(params)
+            return
+        status, reply = self.server.fake.handle(
+            method, parts, params, body)
+        data = b'' if reply is None else json.dumps(reply).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream_events(self, params):
+        events = self.server.fake.subscribe(params.get('filters'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            data = json.dumps(event).encode('utf-8') + b'\n'
+            try:
+                self.wfile.write(
+                    ('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+            except (IOError, OSError):
+                break  # the client went away
+        self.close_connection = True
+
+
+class FakeDaemon(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.containers = {}
+        # images whose containers fail to start
+        self.broken_images = set()
+        self.requests = []
+        self.connections = 0
+        self._socks = []
+        self._subscribers = []
+        self.event_filters = []
+        self._emitted = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._server = _Server(self.path, _Handler)
+        self._server.fake = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for events in subscribers:
+            events.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        os.unlink(self.path)
+        # like a restarted daemon, drop the persistent connections
+        with self._lock:
+            socks, self._socks = self._socks, []
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # already closed by the client
+
+    def connected(self, sock):
+        with self._lock:
+            self.connections += 1
+            self._socks.append(sock)
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(self, filters):
+        events = queue.Queue()
+        with self._lock:
+            self.event_filters.append(filters)
+            self._subscribers.append(events)
+        return events
+
+    def emit(self, action, name, **attributes):
+        attributes['name'] = name
+        event = {
+            'Type': 'container',
+            'Action': action,
+            'status': action,
+            'Actor': {'ID': uuid.uuid4().hex, 'Attributes': attributes},
+        }
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            events.put(event)
+
+    def handle(self, method, parts, params, body):
+        # like the daemon, report the containers starting and dying
+        with self._lock:
+            res = self._handle(method, parts, params, body)
+            emitted, self._emitted = self._emitted, []
+        for action, name, attributes in emitted:
+            self.emit(action, name, **attributes)
+        return res
+
+    def _handle(self, method, parts, params, body):
+        self.requests.append((method, '/'.join(parts)))
+        if parts == ['containers', 'create'] and method == 'POST':
+            return self._create(params['name'], body)
+        if parts == ['containers', 'json'] and method == 'GET':
+            return 200, self._list(params.get('filters'))
+        if len(parts) < 2 or parts[0] != 'containers':
+            return 404, {'message': 'page not found'}
+        cont = self._find(parts[1])
+        if cont is None:
+            return 404, {'message': 'No such container: %s' % parts[1]}
+        action = parts[2] if len(parts) > 2 else None
+        if method == 'POST' and action == 'start':
+            if cont['Config']['Image'] in self.broken_images:
+                return 500, {'message': 'cannot start %s' % parts[1]}
+            cont['State'] = {'Running': True, 'Status': 'running',
+                             'Pid': 4242}
+            self._emit_later('start', cont)
+            return 204, None
+        if method == 'POST' and action == 'stop':
+            if cont['State'].get('Running'):
+                self._emit_later('die', cont, exitCode='143')
+            cont['State'] = {'Running': False, 'Status': 'exited',
+                             'Pid': 0}
+            return 204, None
+        if method == 'GET' and action == 'json':
+            return 200, cont
+        if method == 'DELETE' and action is None:
+            if cont['State'].get('Running'):
+                self._emit_later('die', cont, exitCode='137')
+            del self.containers[cont['Id']]
+            return 204, None
+        return 404, {'message': 'page not found'}
+
+    def _create(self, name, body):
+        if self._find(name) is not None:
+            return 409, {'message': 'name %r already in use' % name}
+        cont_id = uuid.uuid4().hex
+        self.containers[cont_id] = {
+            'Id': cont_id,
+            'Name': '/' + name,
+            'Config': {'Image': body['Image']},
+            'HostConfig': body.get('HostConfig', {}),
+            'State': {'Running': False, 'Status': 'created', 'Pid': 0},
+        }
+        return 201, {'Id': cont_id, 'Warnings': None}
+
+    def _emit_later(self, action, cont, **attributes):
+        self._emitted.append((action, cont['Name'].lstrip('/'), attributes))
+
+    def _list(self, filters):
+        # only the name filter, a substring match like the daemon's
+        names = json.loads(filters).get('name', []) if filters else []
+        return [
+            {'Id': cont['Id'], 'Names': [cont['Name']],
+             'State': cont['State']['Status']}
+            for cont in self.containers.values()
+            if cont['State']['Running'] and
+            all(name in cont['Name'] for name in names)
+        ]
+
+    def _find(self, ident):
+        for cont in self.containers.values():
+            if ident in (cont['Id'], cont['Name'].lstrip('/')):
+                return cont
+        return None
@@ -21,11 +21,14 @@ from __future__ import absolute_import
 
 import os
 import tempfile
+import threading
+import time
 import uuid
 
 import convirt
 import convirt.fs
 
+from . import monkey
 from . import testlib
 
 
@@ -73,3 +76,93 @@ class RMFileTests(testlib.TestCase):
         self.assertRaises(OSError,
                           convirt.fs.rm_file,
                           '/var/log/lastlog')
+
+
+class WaitForFileTests(testlib.TestCase):
+
+    def setUp(self):
+        if not convirt.fs.inotify_available():
+            self.skipTest('inotify not available')
+
+    def _write_later(self, path, delay, tmp_path=None):
+        def _write():
+            time.sleep(delay)
+            with open(tmp_path or path, 'wt') as f:
+                f.write('%s\n' % str(uuid.uuid4()))
+            if tmp_path is not None:
+                os.rename(tmp_path, path)
+
+        writer = threading.Thread(target=_write)
+        writer.start()
+        return writer
+
+    def test_existing(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertTrue(convirt.fs.wait_for_file(f.name, 0.1))
+
+    def test_written(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'foobar')
+            writer = self._write_later(path, 0.05)
+            self.assertTrue(convirt.fs.wait_for_file(path, 5))
+            writer.join()
+
+    def test_watch_before_check(self):
+        calls = []
+        libc = WatchingLibc(convirt.fs._libc, calls)
+        exists = os.path.exists
+
+        def _exists(path):
+            calls.append('exists')
+            return exists(path)
+
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'foobar')
+            with monkey.patch_scope([(convirt.fs, '_libc', libc),
+                                     (os.path, 'exists', _exists)]):
+                self.assertFalse(convirt.fs.wait_for_file(path, 0.01))
+        self.assertEqual(calls, ['inotify_add_watch', 'exists'])
+
+    def test_moved_in_place(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'foobar')
+            writer = self._write_later(
+                path, 0.05, tmp_path=os.path.join(tmp_dir, 'foobar.tmp'))
+            self.assertTrue(convirt.fs.wait_for_file(path, 5))
+            writer.join()
+
+    def test_other_file_ignored(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            writer = self._write_later(
+                os.path.join(tmp_dir, 'other'), 0.01)
+            self.assertFalse(convirt.fs.wait_for_file(
+                os.path.join(tmp_dir, 'foobar'), 0.2))
+            writer.join()
+
+    def test_timeout(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'foobar')
+            self.assertFalse(convirt.fs.wait_for_file(path, 0.05))
+
+    def test_unavailable(self):
+        with monkey.patch_scope([(convirt.fs, '_libc', None)]):
+            self.assertRaises(convirt.fs.WatchUnavailable,
+                              convirt.fs.wait_for_file,
+                              '/most/likely/does/not/exist', 0.1)
+
+
+class WatchingLibc(object):
+    """
+    Records the inotify watches added through the real libc.
+    """
+
+    def __init__(self, libc, calls):
+        self._libc = libc
+        self._calls = calls
+
+    def inotify_init1(self, flags):
+        return self._libc.inotify_init1(flags)
+
+    def inotify_add_watch(self, fd, path, mask):
+        self._calls.append('inotify_add_watch')
+        return self._libc.inotify_add_watch(fd, path, mask)
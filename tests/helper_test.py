@@ -0,0 +1,199 @@
+#
+# Copyright 2015-2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+from __future__ import absolute_import
+
+import os.path
+import shutil
+import socket
+import tempfile
+import threading
+
+import convirt
+import convirt.command
+import convirt.config.environ
+import convirt.helper
+import convirt.runtime
+
+from . import testlib
+
+
+class ServerTestCase(testlib.TestCase):
+
+    FAKE = False
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = convirt.helper.default_path(self.tmp_dir)
+        self.server = convirt.helper.Server(path, fake=self.FAKE)
+        self.server.bind()
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_command(self, name, template):
+        cmd = convirt.helper.HelperCommand.from_name(name, template)
+        cmd.socket_path = self.server.path
+        return cmd
+
+
+class HelperCommandTests(ServerTestCase):
+
+    def test_output(self):
+        cmd = self.make_command('echo', '${message}')
+        self.assertEqual(cmd(message='test'), b'test\n')
+
+    def test_failure(self):
+        cmd = self.make_command('false', '')
+        self.assertRaises(convirt.command.Failed, cmd)
+
+    def test_spawn_error(self):
+        cmd = self.make_command('echo', '')
+        self.assertRaises(convirt.helper.Error,
+                          cmd._execute, ['/nonexistent/nonsense'])
+
+    def test_concurrent(self):
+        cmd = self.make_command('echo', '${message}')
+        results = {}
+
+        def _run(idx):
+            results[idx] = cmd(message=str(idx))
+
+        threads = [threading.Thread(target=_run, args=(idx,))
+                   for idx in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {
+            idx: ('%i\n' % idx).encode('ascii') for idx in range(16)
+        })
+
+    def test_repo_default(self):
+        rp = convirt.command.Repo(
+            execs={'echo': convirt.command.Path('echo')},
+            default=convirt.helper.HelperCommand,
+        )
+        cmd = rp.get('echo', '${message}')
+        cmd.socket_path = self.server.path
+        self.assertEqual(cmd(message='test'), b'test\n')
+
+
+class ServerSecurityTests(ServerTestCase):
+
+    def test_socket_owner_only(self):
+        mode = os.stat(self.server.path).st_mode & 0o777
+        self.assertEqual(mode, 0o600)
+
+    def test_foreign_uid_refused(self):
+        self.server._uids = frozenset([os.geteuid() + 1])
+        cmd = self.make_command('echo', '${message}')
+        self.assertRaises(convirt.helper.Error, cmd, message='test')
+
+    def test_error_reply_on_bad_request(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.server.path)
+            sock.sendall(b'{"not": "argv"}\n')
+            res = convirt.helper._recv(sock)
+        finally:
+            sock.close()
+        self.assertIn('error', res)
+
+
+class FakeServerTests(ServerTestCase):
+
+    FAKE = True
+
+    def test_like_fake_command(self):
+        cmd = self.make_command('echo', '${message}')
+        fake = convirt.command.FakeCommand.from_name('echo', '${message}')
+        self.assertEqual(cmd(message='test').decode('utf-8'),
+                         fake(message='test'))
+
+
+class HelperTests(testlib.TestCase):
+
+    def test_start_stop(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            helper = convirt.helper.Helper(
+                convirt.helper.default_path(tmp_dir), fake=True)
+            helper.start()
+            try:
+                self.assertTrue(helper.running)
+                cmd = convirt.helper.HelperCommand.from_name(
+                    'echo', '${message}')
+                with testlib.global_conf(run_dir=tmp_dir):
+                    self.assertEqual(cmd(message='test').decode('utf-8'),
+                                     '%s test' % cmd.path)
+            finally:
+                helper.stop()
+            self.assertFalse(helper.running)
+            self.assertFalse(os.path.exists(helper.path))
+
+    def test_stale_socket(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = convirt.helper.default_path(tmp_dir)
+            # what a crashed helper leaves behind
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(path)
+            stale.close()
+            helper = convirt.helper.Helper(path, fake=True)
+            helper.start()
+            try:
+                cmd = convirt.helper.HelperCommand.from_name(
+                    'echo', '${message}')
+                cmd.socket_path = path
+                self.assertEqual(cmd(message='test').decode('utf-8'),
+                                 '%s test' % cmd.path)
+            finally:
+                helper.stop()
+
+
+class HelperSetupTests(testlib.RunnableTestCase):
+
+    def test_started_by_setup(self):
+        with testlib.global_conf(run_dir=self.run_dir, use_helper=True):
+            convirt.runtime.setup()
+            try:
+                cmd = convirt.command.Repo(
+                    execs={'echo': convirt.command.Path('echo')},
+                ).get('echo', '${message}')
+                self.assertIsInstance(cmd, convirt.helper.HelperCommand)
+                self.assertEqual(cmd(message='test'), b'test\n')
+            finally:
+                convirt.runtime.teardown()
+            cmd = convirt.command.Repo().get('systemctl', 'list-units')
+            self.assertIsInstance(cmd, convirt.command.SubProcCommand)
+            self.assertFalse(os.path.exists(
+                convirt.helper.default_path(self.run_dir)))
+
+    def test_not_started_by_default(self):
+        with testlib.global_conf(run_dir=self.run_dir):
+            convirt.runtime.setup()
+            try:
+                self.assertFalse(os.path.exists(
+                    convirt.helper.default_path(self.run_dir)))
+            finally:
+                convirt.runtime.teardown()
@@ -19,6 +19,7 @@
 #
 from __future__ import absolute_import
 
+import uuid
 
 import libvirt
 
@@ -26,6 +27,7 @@ import convirt
 import convirt.command
 import convirt.config.environ
 import convirt.connection
+import convirt.doms
 import convirt.events
 import convirt.monitoring
 import convirt.runner
@@ -88,3 +90,69 @@ class MonitoringTests(testlib.RunnableTestCase):
 
 def _handler(*args, **kwargs):
     pass
+
+
+class FakeDockerDomain(object):
+
+    def __init__(self, rt_uuid):
+        self.rt_uuid = rt_uuid
+        self.events = convirt.events.Handler(name='FakeDockerDomain')
+        self.delivered = []
+        self.events.register(
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, None, self, self._cb)
+
+    def _cb(self, conn, dom, *args):
+        self.delivered.append(args)
+
+    def UUIDString(self):
+        return self.rt_uuid
+
+    def runtimeUUIDString(self):
+        return self.rt_uuid
+
+
+class DockerEventTests(testlib.TestCase):
+
+    def setUp(self):
+        self.dom = FakeDockerDomain(str(uuid.uuid4()))
+        convirt.doms.add(self.dom)
+
+    def tearDown(self):
+        convirt.doms.clear()
+
+    def test_die(self):
+        convirt.monitoring.docker_event(
+            self.dom.rt_uuid, 'die', {'exitCode': '0'})
+        self.assertEquals(self.dom.delivered, [(
+            libvirt.VIR_DOMAIN_EVENT_STOPPED,
+            libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN,
+        )])
+
+    def test_die_failed(self):
+        convirt.monitoring.docker_event(
+            self.dom.rt_uuid, 'die', {'exitCode': '1'})
+        self.assertEquals(self.dom.delivered, [(
+            libvirt.VIR_DOMAIN_EVENT_STOPPED,
+            libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED,
+        )])
+
+    def test_oom(self):
+        convirt.monitoring.docker_event(self.dom.rt_uuid, 'oom', {})
+        self.assertEquals(self.dom.delivered, [])
+        convirt.monitoring.docker_event(
+            self.dom.rt_uuid, 'die', {'exitCode': '137'})
+        self.assertEquals(self.dom.delivered, [(
+            libvirt.VIR_DOMAIN_EVENT_STOPPED,
+            libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED,
+        )])
+
+    def test_start(self):
+        convirt.monitoring.docker_event(self.dom.rt_uuid, 'start', {})
+        self.assertEquals(self.dom.delivered, [(
+            libvirt.VIR_DOMAIN_EVENT_STARTED,
+            libvirt.VIR_DOMAIN_EVENT_STARTED_BOOTED,
+        )])
+
+    def test_unknown_container(self):
+        convirt.monitoring.docker_event(str(uuid.uuid4()), 'die', {})
+        self.assertEquals(self.dom.delivered, [])
@@ -0,0 +1,190 @@
+#
+# Copyright 2015-2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+from __future__ import absolute_import
+
+import io
+import os.path
+import subprocess
+import uuid
+
+import convirt
+import convirt.command
+import convirt.recording
+import convirt.runner
+
+from . import monkey
+from . import testlib
+
+
+class RecordReplayTests(testlib.TestCase):
+
+    def test_record(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            klass = convirt.recording.recording(path)
+            cmd = klass.from_name('echo', '${message}')
+            self.assertEqual(cmd(message='test'), b'test\n')
+            recs = convirt.recording.load(path)
+        self.assertEqual(len(recs), 1)
+        self.assertEqual(recs[0].argv, cmd.cmdline(message='test'))
+        self.assertEqual(recs[0].returncode, 0)
+        self.assertEqual(recs[0].output, b'test\n')
+        self.assertGreater(recs[0].latency, 0)
+
+    def test_record_failure(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            klass = convirt.recording.recording(path)
+            cmd = klass.from_name('false', '')
+            self.assertRaises(convirt.command.Failed, cmd)
+            recs = convirt.recording.load(path)
+        self.assertEqual(recs[0].returncode, 1)
+
+    def test_replay(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            rec = convirt.recording.recording(path)
+            for msg in ('first', 'second'):
+                rec.from_name('echo', '${message}')(message=msg)
+            self.assertRaises(convirt.command.Failed,
+                              rec.from_name('false', ''))
+
+            replay = convirt.recording.replaying(path, scale=0)
+            cmd = replay.from_name('echo', '${message}')
+            self.assertEqual(cmd(message='second'), b'second\n')
+            self.assertEqual(cmd(message='first'), b'first\n')
+            self.assertRaises(convirt.command.Failed,
+                              replay.from_name('false', ''))
+            self.assertRaises(convirt.recording.NotRecorded,
+                              cmd, message='third')
+
+    def test_replay_in_order(self):
+        recs = [
+            convirt.recording.Record(['/bin/x'], 0, b'1', 0),
+            convirt.recording.Record(['/bin/x'], 0, b'2', 0),
+        ]
+        replay = convirt.recording.Replay(recs)
+        self.assertEqual(replay.next(['/bin/x']).output, b'1')
+        self.assertEqual(replay.next(['/bin/x']).output, b'2')
+        # the last one is served again
+        self.assertEqual(replay.next(['/bin/x']).output, b'2')
+
+    def test_replay_other_host(self):
+        recs = [
+            convirt.recording.Record(
+                ['/usr/bin/systemctl', 'stop',
+                 'convirt-5bc080ca-4f1e-4a55-8b52-6f2b3c1a9e01.service'],
+                0, b'stopped', 0),
+        ]
+        replay = convirt.recording.Replay(recs)
+        rec = replay.next(
+            ['/bin/systemctl', 'stop',
+             'convirt-0B3C9E4D-7A1F-4D6E-9C2B-1E5F8A7D6C02.service'])
+        self.assertEqual(rec.output, b'stopped')
+        self.assertRaises(convirt.recording.NotRecorded,
+                          replay.next, ['/bin/systemctl', 'start',
+                                        'convirt-test.service'])
+
+    def test_normalize(self):
+        self.assertEqual(
+            convirt.recording.normalize(
+                ['/usr/bin/rkt', 'status',
+                 '5bc080ca-4f1e-4a55-8b52-6f2b3c1a9e01']),
+            ('rkt', 'status', '<uuid>'))
+
+    def test_replay_scaled_latency(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            recorder = convirt.recording.Recorder(path)
+            echo = convirt.command.Path('echo')
+            recorder.add(convirt.recording.Record(
+                [echo.cmd, 'test'], 0, b'test\n', 0.4))
+            replay = convirt.recording.replaying(path, scale=0.5)
+            cmd = replay.from_name('echo', '${message}')
+            clock = testlib.FakeTime()
+            with monkey.patch_scope([(convirt.recording, 'time', clock)]):
+                self.assertEqual(cmd(message='test'), b'test\n')
+        self.assertEqual(clock.sleeps, [0.2])
+
+    def test_repo_default(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            rp = convirt.command.Repo(
+                execs={'echo': convirt.command.Path('echo')},
+                default=convirt.recording.recording(
+                    path, backend=convirt.command.FakeCommand),
+            )
+            cmd = rp.get('echo', '${message}')
+            cmd(message='test')
+            recs = convirt.recording.load(path)
+        self.assertEqual(recs[0].output,
+                         ('%s test' % cmd.path).encode('utf-8'))
+
+    def test_record_replay_stream(self):
+        vm_uuid = str(uuid.uuid4())
+        tmpl = testlib.read_test_data('systemctl_vdsm_service.txt')
+        output = (tmpl % (convirt.runner.PREFIX + vm_uuid)).encode('utf-8')
+
+        class FakePopen(object):
+            def __init__(self, *args, **kwargs):
+                self.stdout = io.BytesIO(output)
+
+            def wait(self):
+                return 0
+
+        class NoPopen(object):
+            def __init__(self, *args, **kwargs):
+                raise AssertionError('replay must not run anything')
+
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            with monkey.patch_scope([(subprocess, 'Popen', FakePopen)]):
+                recorded = convirt.runner.Runner.get_all(
+                    convirt.command.Repo(
+                        default=convirt.recording.recording(path)))
+            rec, = convirt.recording.load(path)
+            with monkey.patch_scope([(subprocess, 'Popen', NoPopen)]):
+                replayed = convirt.runner.Runner.get_all(
+                    convirt.command.Repo(
+                        default=convirt.recording.replaying(path)))
+        self.assertEqual(recorded, [vm_uuid])
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(rec.returncode, 0)
+        self.assertEqual(rec.output, output)
+
+    def test_record_stream_failure(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            klass = convirt.recording.recording(path)
+            cmd = klass.from_name('false', '')
+            self.assertRaises(convirt.command.Failed, list, cmd.stream())
+            rec, = convirt.recording.load(path)
+        self.assertEqual(rec.returncode, 1)
+
+    def test_record_stream_not_streaming_backend(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, 'record.jsonl')
+            klass = convirt.recording.recording(
+                path, backend=convirt.command.FakeCommand)
+            cmd = klass.from_name('echo', '${message}')
+            self.assertEqual(list(cmd.stream(message='test')),
+                             ['%s test' % cmd.path])
+            # recorded once, through _execute
+            rec, = convirt.recording.load(path)
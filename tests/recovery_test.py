@@ -44,6 +44,9 @@ class FakeSystemctlList(object):
         )
         return output
 
+    def stream(self, *args, **kwargs):
+        return iter(self(*args, **kwargs).splitlines())
+
 
 class FakeRepo(object):
 
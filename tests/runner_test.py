@@ -19,11 +19,19 @@
 #
 from __future__ import absolute_import
 
+import io
+import os
+import os.path
 import subprocess
+import threading
+import time
 import uuid
 
+import six
+
 import convirt
 import convirt.command
+import convirt.config.environ
 import convirt.runner
 
 from . import monkey
@@ -54,12 +62,17 @@ class RuntimeListTests(testlib.TestCase):
     def test_single_service(self):
         VM_UUID = 'd7a0005e-ee05-4e61-9fbe-d2e93d59327c'
 
-        def fake_check_output(*args):
-            tmpl = testlib.read_test_data('systemctl_vdsm_service.txt')
-            return tmpl % VM_UUID
+        class FakePopen(object):
+            def __init__(self, *args, **kwargs):
+                tmpl = testlib.read_test_data('systemctl_vdsm_service.txt')
+                # systemctl lists only units matching the prefix
+                unit = convirt.runner.PREFIX + VM_UUID
+                self.stdout = io.BytesIO((tmpl % unit).encode('utf-8'))
+
+            def wait(self):
+                return 0
 
-        with monkey.patch_scope([(subprocess, 'check_output',
-                                  fake_check_output)]):
+        with monkey.patch_scope([(subprocess, 'Popen', FakePopen)]):
             runr = convirt.runner.Runner(
                 'testing',
                 convirt.command.Repo(),
@@ -67,6 +80,75 @@ class RuntimeListTests(testlib.TestCase):
             conts = list(runr.get_all())
             self.assertEqual(conts, [VM_UUID])
 
+    def test_concurrent_calls_fork_once(self):
+        VM_UUID = 'd7a0005e-ee05-4e61-9fbe-d2e93d59327c'
+        tmpl = testlib.read_test_data('systemctl_vdsm_service.txt')
+        output = (tmpl % (convirt.runner.PREFIX + VM_UUID)).encode('utf-8')
+        started = threading.Event()
+        release = threading.Event()
+        procs = []
+
+        class SlowPopen(object):
+            def __init__(self, *args, **kwargs):
+                procs.append(self)
+                self.stdout = SlowOutput(output, started, release)
+
+            def wait(self):
+                return 0
+
+        results = []
+
+        def _get_all():
+            runr = convirt.runner.Runner('testing', convirt.command.Repo())
+            results.append(list(runr.get_all()))
+
+        with monkey.patch_scope([(subprocess, 'Popen', SlowPopen)]):
+            leader = threading.Thread(target=_get_all)
+            leader.start()
+            started.wait(5)
+            followers = [threading.Thread(target=_get_all)
+                         for _ in range(4)]
+            for t in followers:
+                t.start()
+            # let the followers reach the wait
+            time.sleep(0.05)
+            release.set()
+            for t in [leader] + followers:
+                t.join()
+
+        self.assertEqual(len(procs), 1)
+        self.assertEqual(results, [[VM_UUID]] * 5)
+
+    def test_done_before_returning(self):
+        # the callers may run systemctl for each container: with only
+        # one systemctl allowed, this would hang if get_all held it
+        VM_UUID = 'd7a0005e-ee05-4e61-9fbe-d2e93d59327c'
+        tmpl = testlib.read_test_data('systemctl_vdsm_service.txt')
+        output = (tmpl % (convirt.runner.PREFIX + VM_UUID)).encode('utf-8')
+
+        class FakePopen(object):
+            def __init__(self, *args, **kwargs):
+                self.stdout = io.BytesIO(output)
+
+            def wait(self):
+                return 0
+
+        repo = convirt.command.Repo(limits={'systemctl': 1})
+        results = []
+
+        def _nested():
+            for rt_uuid in convirt.runner.Runner.get_all(repo):
+                results.append(
+                    (rt_uuid, list(convirt.runner.Runner.get_all(repo))))
+
+        with monkey.patch_scope([(subprocess, 'Popen', FakePopen)]):
+            worker = threading.Thread(target=_nested)
+            worker.daemon = True
+            worker.start()
+            worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(results, [(VM_UUID, [VM_UUID])])
+
     def test__parse_systemctl_one_service(self):
         output = testlib.read_test_data('systemctl_foobar_service.txt')
         names = list(convirt.runner._parse_systemctl_list_units(output))
@@ -84,12 +166,584 @@ foobar.service    somehow messed
         names = list(convirt.runner._parse_systemctl_list_units(output))
         self.assertEqual(names, [])
 
+    def test__parse_systemctl_lines(self):
+        output = testlib.read_test_data('systemctl_foobar_service.txt')
+        names = list(convirt.runner._parse_systemctl_list_units(
+            iter(output.splitlines())))
+        self.assertEqual(names, ["foobar"])
+
+    def test__parse_systemctl_skip_prefix(self):
+        output = '\n'.join([
+            'foobar.service   loaded active running useless',
+            'convirt-foo.service   loaded active running useless',
+        ])
+        names = list(convirt.runner._parse_systemctl_list_units(
+            output, convirt.runner.PREFIX))
+        self.assertEqual(names, ["foo"])
+
     def test__parse_systemctl_no_services(self):
         output = testlib.read_test_data('systemctl_list.txt')
         names = list(convirt.runner._parse_systemctl_list_units(output))
         self.assertEqual(names, [])
 
 
+class SlowOutput(object):
+    """
+    Process output which blocks before the first line
+    until `release` is set.
+    """
+
+    def __init__(self, data, started, release):
+        self._lines = io.BytesIO(data)
+        self._started = started
+        self._release = release
+
+    def __iter__(self):
+        self._started.set()
+        self._release.wait(5)
+        return iter(self._lines)
+
+    def close(self):
+        self._lines.close()
+
+
+class FakeSystemctl(object):
+
+    def __init__(self, output):
+        self.output = output
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.output
+
+
+class FakeSystemctlRepo(object):
+
+    def __init__(self, output):
+        self.systemctl = FakeSystemctl(output)
+
+    def get(self, *args, **kwargs):
+        return self.systemctl
+
+
+class ShowAllTests(testlib.TestCase):
+
+    def test_parse(self):
+        uuid1, uuid2 = str(uuid.uuid4()), str(uuid.uuid4())
+        output = testlib.read_test_data('systemctl_show.txt').format(
+            uuid1=uuid1, uuid2=uuid2)
+        repo = FakeSystemctlRepo(output.encode('utf-8'))
+        info = convirt.runner.Runner.show_all(repo, [uuid1, uuid2])
+        self.assertEqual(len(repo.systemctl.calls), 1)
+        self.assertEqual(repo.systemctl.calls[0]['units'], [
+            'convirt-%s.service' % uuid1,
+            'convirt@%s.service' % uuid1,
+            'convirt-%s.service' % uuid2,
+            'convirt@%s.service' % uuid2,
+        ])
+        self.assertEqual(sorted(info.keys()), sorted([uuid1, uuid2]))
+        self.assertEqual(info[uuid1].main_pid, 4242)
+        self.assertEqual(info[uuid1].control_group,
+                         '/convirt.slice/convirt-%s.service' % uuid1)
+        self.assertEqual(info[uuid1].active_state, 'active')
+        self.assertEqual(info[uuid1].sub_state, 'running')
+        self.assertTrue(info[uuid1].start_timestamp)
+        self.assertEqual(info[uuid2].main_pid, 0)
+        self.assertEqual(info[uuid2].active_state, 'inactive')
+
+    def test_no_units(self):
+        repo = FakeSystemctlRepo('')
+        self.assertEqual(convirt.runner.Runner.show_all(repo, []), {})
+        self.assertEqual(repo.systemctl.calls, [])
+
+    def test_command_line(self):
+        uuids = [str(uuid.uuid4()) for _ in range(3)]
+        repo = RecordingRepo()
+        # FakeCommand output is the command line itself
+        info = convirt.runner.Runner.show_all(repo, uuids)
+        self.assertEqual(info, {})
+        cmd, = repo.commands
+        argv, = cmd.executions
+        self.assertEqual(argv[1:], [
+            'show',
+            '--property=Id,MainPID,ControlGroup,ActiveState,SubState,'
+            'ActiveEnterTimestamp',
+        ] + [unit % rt_uuid
+             for rt_uuid in uuids
+             for unit in ('convirt-%s.service', 'convirt@%s.service')])
+
+    def test_instance_unit(self):
+        rt_uuid = str(uuid.uuid4())
+        output = '\n\n'.join([
+            'Id=convirt-%s.service\nMainPID=0\nActiveState=inactive\n'
+            'SubState=dead' % rt_uuid,
+            'Id=convirt@%s.service\nMainPID=4242\nActiveState=active\n'
+            'SubState=running' % rt_uuid,
+        ])
+        repo = FakeSystemctlRepo(output.encode('utf-8'))
+        info = convirt.runner.Runner.show_all(repo, [rt_uuid])
+        self.assertEqual(list(info.keys()), [rt_uuid])
+        self.assertEqual(info[rt_uuid].unit, 'convirt@%s.service' % rt_uuid)
+        self.assertEqual(info[rt_uuid].main_pid, 4242)
+
+    def test_transient_unit_preferred_if_alive(self):
+        rt_uuid = str(uuid.uuid4())
+        output = '\n\n'.join([
+            'Id=convirt-%s.service\nMainPID=4242\nActiveState=active\n'
+            'SubState=running' % rt_uuid,
+            'Id=convirt@%s.service\nMainPID=0\nActiveState=inactive\n'
+            'SubState=dead' % rt_uuid,
+        ])
+        repo = FakeSystemctlRepo(output.encode('utf-8'))
+        info = convirt.runner.Runner.show_all(repo, [rt_uuid])
+        self.assertEqual(info[rt_uuid].unit, 'convirt-%s.service' % rt_uuid)
+
+
+class RecordingRepo(testlib.FakeRepo):
+    """
+    Keeps the FakeCommands it creates, to check their executions.
+    """
+
+    def __init__(self):
+        super(RecordingRepo, self).__init__()
+        self.commands = []
+
+    def get(self, *args, **kwargs):
+        cmd = super(RecordingRepo, self).get(*args, **kwargs)
+        self.commands.append(cmd)
+        return cmd
+
+
+class FailingSystemctl(FakeSystemctl):
+
+    def __init__(self, bad):
+        super(FailingSystemctl, self).__init__('')
+        self.bad = bad
+
+    def __call__(self, **kwargs):
+        super(FailingSystemctl, self).__call__(**kwargs)
+        if self.bad in kwargs['name']:
+            raise convirt.command.Failed('fake failure', 5)
+        return self.output
+
+
+class StopAllTests(testlib.TestCase):
+
+    def setUp(self):
+        self.units = [
+            'convirt-%s.service' % uuid.uuid4() for _ in range(10)
+        ]
+
+    def test_single_call(self):
+        repo = FakeSystemctlRepo('')
+        res = convirt.runner.Runner.stop_all(self.units, repo)
+        self.assertEqual(repo.systemctl.calls, [{'name': self.units}])
+        self.assertEqual(res, dict((unit, True) for unit in self.units))
+
+    def test_chunked(self):
+        repo = FakeSystemctlRepo('')
+        # room for three units per call
+        max_bytes = (len(self.units[0]) + 1) * 3
+        res = convirt.runner.Runner.stop_all(
+            self.units, repo, max_bytes=max_bytes)
+        calls = [call['name'] for call in repo.systemctl.calls]
+        self.assertEqual([len(c) for c in calls], [3, 3, 3, 1])
+        self.assertEqual(sum(calls, []), self.units)
+        self.assertEqual(res, dict((unit, True) for unit in self.units))
+
+    def test_partial_failure(self):
+        bad = self.units[4]
+        repo = FakeSystemctlRepo('')
+        repo.systemctl = FailingSystemctl(bad)
+        res = convirt.runner.Runner.stop_all(self.units, repo)
+        expected = dict((unit, True) for unit in self.units)
+        expected[bad] = False
+        self.assertEqual(res, expected)
+
+    def test_command_line(self):
+        # the real command class must expand the list in arguments
+        cmd = convirt.command.FakeCommand.from_name(
+            'systemctl', convirt.runner._TEMPLATES['systemctl_stop'])
+        argv = cmd.cmdline(name=self.units[:2])
+        self.assertEqual(argv[1:], ['stop'] + self.units[:2])
+
+
+class FakeShow(object):
+
+    def __init__(self, states):
+        self.states = list(states)
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        state = self.states.pop(0) if len(self.states) > 1 else \
+            self.states[0]
+        return '\n\n'.join(
+            'Id=%s\nMainPID=42\nActiveState=%s\nSubState=running' % (
+                unit, state)
+            for unit in kwargs['units']
+        )
+
+
+class AsyncStartRepo(testlib.FakeRepo):
+
+    def __init__(self, states):
+        super(AsyncStartRepo, self).__init__()
+        self.show = FakeShow(states)
+
+    def get(self, name, template, **kwargs):
+        if template == convirt.runner._TEMPLATES['systemctl_show']:
+            return self.show
+        return super(AsyncStartRepo, self).get(name, template, **kwargs)
+
+
+class AsyncStartTests(testlib.TestCase):
+
+    def test_no_block(self):
+        runr = convirt.runner.Runner('test', AsyncStartRepo(['active']))
+        job = runr.start_async(command='/bin/sleep 42m')
+        cmd = runr._systemd_run_no_block.executions[0]  # FIXME
+        self.assertIn('--no-block', cmd)
+        self.assertTrue(job.wait(5))
+
+    def test_completion(self):
+        repo = AsyncStartRepo(['activating', 'activating', 'active'])
+        completed = []
+        runr = convirt.runner.Runner('test', repo)
+        job = runr.start_async(callback=completed.append,
+                               command='/bin/sleep 42m')
+        self.assertTrue(job.wait(5))
+        self.assertTrue(job.succeeded)
+        self.assertEqual(job.info.unit, 'test.service')
+        self.assertEqual(job.info.main_pid, 42)
+        self.assertEqual(completed, [job])
+        self.assertTrue(runr.running)
+        self.assertGreaterEqual(len(repo.show.calls), 3)
+
+    def test_failed(self):
+        runr = convirt.runner.Runner('test', AsyncStartRepo(['failed']))
+        job = runr.start_async(command='/bin/sleep 42m')
+        self.assertTrue(job.wait(5))
+        self.assertFalse(job.succeeded)
+        self.assertFalse(runr.running)
+
+    def test_timeout(self):
+        runr = convirt.runner.Runner('test', AsyncStartRepo(['activating']))
+        job = runr.start_async(timeout=0.1, command='/bin/sleep 42m')
+        self.assertTrue(job.wait(5))
+        self.assertFalse(job.succeeded)
+        self.assertIs(job.info, None)
+
+    def test_batched_poll(self):
+        repo = AsyncStartRepo(['activating', 'active'])
+        jobs = [
+            convirt.runner.Runner('test%i' % idx, repo).start_async(
+                command='/bin/sleep 42m')
+            for idx in range(8)
+        ]
+        for job in jobs:
+            self.assertTrue(job.wait(5))
+        self.assertLess(len(repo.show.calls), len(jobs))
+
+    def test_show_fails_job_expires(self):
+        repo = AsyncStartRepo(['active'])
+        repo.show = FailingShow()
+        runr = convirt.runner.Runner('test', repo)
+        job = runr.start_async(timeout=0.1, command='/bin/sleep 42m')
+        self.assertTrue(job.wait(5))
+        self.assertFalse(job.succeeded)
+        self.assertIs(job.info, None)
+
+    def test_failing_group_does_not_block_others(self):
+        broken = AsyncStartRepo(['active'])
+        broken.show = FailingShow()
+        stuck = convirt.runner.Runner('stuck', broken).start_async(
+            timeout=1, command='/bin/sleep 42m')
+        good = convirt.runner.Runner('good', AsyncStartRepo(['active']))
+        job = good.start_async(command='/bin/sleep 42m')
+        self.assertTrue(job.wait(5))
+        self.assertTrue(job.succeeded)
+        self.assertFalse(stuck.done)
+        self.assertTrue(stuck.wait(5))
+        self.assertIs(stuck.info, None)
+
+
+class FailingShow(object):
+
+    def __call__(self, **kwargs):
+        raise convirt.command.Failed('systemctl show failed', 1)
+
+
+class ListUnitsParseTests(testlib.TestCase):
+
+    def test_busy_host(self):
+        lines = []
+        expected = []
+        for idx in range(1000):
+            # a busy host: mostly unrelated units
+            if idx % 20 == 0:
+                vm_uuid = str(uuid.uuid4())
+                expected.append(vm_uuid)
+                name = convirt.runner.PREFIX + vm_uuid
+            else:
+                name = 'unrelated-unit-%i' % idx
+            lines.append('%s.service   loaded active running '
+                         'some description of the unit' % name)
+        stream = io.StringIO(six.text_type('\n'.join(lines) + '\n'))
+        found = list(convirt.runner._parse_systemctl_list_units(
+            (line.rstrip('\n') for line in stream),
+            convirt.runner.PREFIX))
+        self.assertEqual(found, expected)
+
+
+class CgroupfsListTests(testlib.TestCase):
+
+    def _make_unit(self, base, unit, procs=''):
+        path = os.path.join(base, unit)
+        os.makedirs(path)
+        with open(os.path.join(path, 'cgroup.procs'), 'wt') as dst:
+            dst.write(procs)
+        return path
+
+    def _check_layout(self, layout):
+        running = str(uuid.uuid4())
+        nested = str(uuid.uuid4())
+        empty = str(uuid.uuid4())
+        with testlib.named_temp_dir() as root:
+            base = os.path.join(root, layout, 'convirt.slice')
+            self._make_unit(base, 'convirt-%s.service' % running, '42\n')
+            path = self._make_unit(base, 'convirt-%s.service' % nested)
+            self._make_unit(path, 'payload', '42\n43\n')
+            self._make_unit(base, 'convirt-%s.service' % empty)
+            self._make_unit(base, 'foobar.service', '42\n')
+            self._make_unit(base, 'convirt-foo.scope', '42\n')
+            found = set(convirt.runner.Runner.get_all_from_cgroupfs(
+                'convirt', root=root))
+        self.assertEqual(found, set([running, nested]))
+
+    def test_unified(self):
+        self._check_layout('')
+
+    def test_hybrid(self):
+        self._check_layout('unified')
+
+    def test_legacy(self):
+        self._check_layout('systemd')
+
+    def test_missing_slice(self):
+        with testlib.named_temp_dir() as root:
+            found = list(convirt.runner.Runner.get_all_from_cgroupfs(
+                'convirt', root=root))
+        self.assertEqual(found, [])
+
+    def test_default_slice(self):
+        vm_uuid = str(uuid.uuid4())
+        with testlib.named_temp_dir() as root:
+            with testlib.global_conf(cgroup_slice='testing') as conf:
+                base = os.path.join(root, conf.cgroup_slice + '.slice')
+                self._make_unit(base, 'convirt-%s.service' % vm_uuid, '1')
+                found = list(convirt.runner.Runner.get_all_from_cgroupfs(
+                    root=root))
+        self.assertEqual(found, [vm_uuid])
+
+    def test_nested_slice(self):
+        vm_uuid = str(uuid.uuid4())
+        with testlib.named_temp_dir() as root:
+            base = os.path.join(root, 'machine.slice',
+                                'machine-convirt.slice')
+            self._make_unit(base, 'convirt-%s.service' % vm_uuid, '42\n')
+            found = list(convirt.runner.Runner.get_all_from_cgroupfs(
+                'machine-convirt', root=root))
+        self.assertEqual(found, [vm_uuid])
+
+
+class SliceUnitTests(testlib.TestCase):
+
+    def test_slice_unit(self):
+        self.assertEqual(convirt.runner.slice_unit('convirt'),
+                         'convirt.slice')
+        self.assertEqual(convirt.runner.slice_unit('convirt_test'),
+                         'convirt_test.slice')
+
+    def test_nested(self):
+        self.assertEqual(convirt.runner.slice_unit('machine-convirt'),
+                         'machine-convirt.slice')
+        self.assertEqual(
+            convirt.runner._slice_path('machine-convirt-test.slice'),
+            os.path.join('machine.slice', 'machine-convirt.slice',
+                         'machine-convirt-test.slice'))
+
+    def test_invalid_rejected(self):
+        for name in ('', 'con/virt', 'con virt',
+                     '-convirt', 'convirt-', 'con--virt'):
+            self.assertRaises(ValueError, convirt.runner.slice_unit, name)
+
+    def test_runner_dashed_slice(self):
+        with testlib.global_conf(cgroup_slice='machine-convirt'):
+            runr = convirt.runner.Runner('testing', testlib.FakeRepo())
+        self.assertIn('--slice=machine-convirt.slice',
+                      runr._systemd_run.cmdline(command='/bin/true',
+                                                accounting=[]))
+
+    def test_systemd_run_slice(self):
+        runr = convirt.runner.Runner('testing', testlib.FakeRepo())
+        self.assertIn('--slice=convirt.slice',
+                      runr._systemd_run.cmdline(command='/bin/true',
+                                                accounting=[]))
+
+
+class InstanceRunnerTests(testlib.TestCase):
+
+    def setUp(self):
+        self.vm_uuid = str(uuid.uuid4())
+        self.unit_name = convirt.runner.PREFIX + self.vm_uuid
+
+    def test_create_default_transient(self):
+        runr = convirt.runner.create(
+            self.unit_name, testlib.FakeRepo(),
+            convirt.config.environ.current())
+        self.assertEqual(type(runr), convirt.runner.Runner)
+
+    def test_create_instance(self):
+        conf = testlib.make_conf(unit_mode='instance')
+        runr = convirt.runner.create(
+            self.unit_name, testlib.FakeRepo(), conf)
+        self.assertTrue(isinstance(runr, convirt.runner.InstanceRunner))
+        self.assertEqual(
+            runr.instance_name,
+            'convirt@%s.service' % self.vm_uuid)
+
+    def test_create_unknown_mode(self):
+        conf = testlib.make_conf(unit_mode='nonexistent')
+        self.assertRaises(ValueError,
+                          convirt.runner.create,
+                          self.unit_name, testlib.FakeRepo(), conf)
+
+    def test_start_stop(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            conf = testlib.make_conf(
+                run_dir=tmp_dir, unit_dir=tmp_dir, unit_mode='instance')
+            runr = convirt.runner.create(
+                self.unit_name, testlib.FakeRepo(), conf)
+            runr.start(command='/bin/sleep 42m')
+            self.assertTrue(runr.running)
+
+            cmd = runr._systemctl_start.executions[0]  # FIXME
+            self.assertEqual(cmd[1:], ['start', runr.instance_name])
+            with open(runr.env_path, 'rt') as src:
+                self.assertEqual(
+                    src.read(), 'CONVIRT_COMMAND=/bin/sleep 42m\n')
+
+            template = os.path.join(tmp_dir, 'convirt@.service')
+            self.assertTrue(os.path.exists(template))
+
+            runr.stop()
+            self.assertFalse(runr.running)
+            self.assertFalse(os.path.exists(runr.env_path))
+
+    def test_install_once(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            conf = testlib.make_conf(run_dir=tmp_dir, unit_dir=tmp_dir)
+            repo = testlib.FakeRepo()
+            self.assertTrue(
+                convirt.runner.InstanceRunner.install(conf, repo))
+            self.assertFalse(
+                convirt.runner.InstanceRunner.install(conf, repo))
+
+            conf.cgroup_slice = 'other'
+            self.assertTrue(
+                convirt.runner.InstanceRunner.install(conf, repo))
+
+    def test_start_rejects_whitespace(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            conf = testlib.make_conf(
+                run_dir=tmp_dir, unit_dir=tmp_dir, unit_mode='instance')
+            runr = convirt.runner.create(
+                self.unit_name, testlib.FakeRepo(), conf)
+            self.assertRaises(convirt.runner.OperationFailed,
+                              runr.start,
+                              command='/bin/sh -c "sleep 42m"')
+            self.assertFalse(runr.running)
+
+    def test_vm_uuid_from_instance_unit(self):
+        self.assertEqual(
+            convirt.runner._vm_uuid_from_unit(
+                'convirt@%s.service' % self.vm_uuid),
+            self.vm_uuid)
+
+    def test_list_instance_units(self):
+        output = (
+            'convirt@%s.service loaded active running convirt container\n'
+            % self.vm_uuid
+        )
+        units = list(convirt.runner._parse_systemctl_list_units(
+            output, (convirt.runner.PREFIX, convirt.runner.INSTANCE_PREFIX)))
+        self.assertEqual(len(units), 1)
+
+
+class AccountingTests(testlib.TestCase):
+
+    def setUp(self):
+        self.unit_name = convirt.runner.PREFIX + str(uuid.uuid4())
+
+    def _start(self, runr):
+        runr.start(command='/bin/sleep 42m')
+        return runr._systemd_run.executions[0]  # FIXME
+
+    def test_default_full(self):
+        runr = convirt.runner.Runner(self.unit_name, testlib.FakeRepo())
+        self.assertEqual(runr.accounting, 'full')
+        cmd = self._start(runr)
+        for res in ('CPU', 'Memory', 'BlockIO'):
+            self.assertIn('--property=%sAccounting=1' % res, cmd)
+
+    def test_cpu_memory(self):
+        runr = convirt.runner.Runner(self.unit_name, testlib.FakeRepo())
+        runr.accounting = 'cpu+memory'
+        cmd = self._start(runr)
+        self.assertIn('--property=CPUAccounting=1', cmd)
+        self.assertIn('--property=MemoryAccounting=1', cmd)
+        self.assertNotIn('--property=BlockIOAccounting=1', cmd)
+
+    def test_none(self):
+        runr = convirt.runner.Runner(self.unit_name, testlib.FakeRepo())
+        runr.accounting = 'none'
+        cmd = self._start(runr)
+        self.assertFalse(any('Accounting' in arg for arg in cmd))
+        self.assertEqual(cmd[-2:], ['/bin/sleep', '42m'])
+
+    def test_host_wide(self):
+        conf = testlib.make_conf(accounting='none')
+        runr = convirt.runner.create(
+            self.unit_name, testlib.FakeRepo(), conf)
+        self.assertEqual(runr.accounting, 'none')
+
+    def test_unknown_profile(self):
+        runr = convirt.runner.Runner(self.unit_name, testlib.FakeRepo())
+
+        def _set():
+            runr.accounting = 'nonexistent'
+
+        self.assertRaises(ValueError, _set)
+
+    def test_instance_override(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            conf = testlib.make_conf(
+                run_dir=tmp_dir, unit_dir=tmp_dir, unit_mode='instance')
+            runr = convirt.runner.create(
+                self.unit_name, testlib.FakeRepo(), conf)
+            runr.accounting = 'cpu+memory'
+            runr.start(command='/bin/sleep 42m')
+            cmd = runr._systemctl_set_property.executions[0]  # FIXME
+            self.assertEqual(cmd[1:], [
+                'set-property', '--runtime', runr.instance_name,
+                'CPUAccounting=1', 'MemoryAccounting=1',
+                'BlockIOAccounting=0',
+            ])
+            runr.stop()
+
+
 class RunnerTests(testlib.TestCase):
 
     def setUp(self):
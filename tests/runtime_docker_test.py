@@ -19,6 +19,7 @@
 #
 from __future__ import absolute_import
 
+import uuid
 import xml.etree.ElementTree as ET
 
 import convirt
@@ -27,6 +28,7 @@ import convirt.config.environ
 import convirt.command
 import convirt.runner
 import convirt.runtimes as rts
+import convirt.runtimes.docker
 
 from . import testlib
 
@@ -77,3 +79,90 @@ class DockerTests(testlib.RunnableTestCase):
         )
         self.assertFalse(docker.running)
         self.assertRaises(convirt.runner.OperationFailed, docker.stop)
+
+
+class DockerCgroupTests(testlib.TestCase):
+
+    def setUp(self):
+        self.repo = testlib.FakeRepo()
+        self.docker = rts.docker.Docker(
+            testlib.make_conf(cgroup_slice='convirt'),
+            self.repo,
+        )
+        self.docker.configure(ET.fromstring(testlib.minimal_dom_xml()))
+
+    def test_cgroup_parent(self):
+        self.assertEqual(self.docker.cgroup_parent(), 'convirt.slice')
+
+    def test_run_detached_in_slice(self):
+        argv = self.docker._docker_run.cmdline(image='busybox:latest')
+        self.assertIn('--detach', argv)
+        self.assertIn('--cgroup-parent=convirt.slice', argv)
+        self.assertEqual(argv[-1], 'busybox:latest')
+
+    def test_unit_waits_for_container(self):
+        self.assertEqual(
+            self.docker._docker_wait.cmdline()[-2:],
+            ['wait', self.docker.unit_name()]
+        )
+
+    def test_same_slice_as_unit(self):
+        # the container is not in the unit cgroup, but in the same slice:
+        # the slice accounting covers both
+        argv = self.docker._runner._systemd_run.cmdline(
+            accounting=[], command=self.docker._docker_wait)
+        self.assertIn('--slice=%s' % self.docker.cgroup_parent(), argv)
+
+    def test_start_runs_before_unit(self):
+        calls = []
+        for name in ('_docker_run', '_docker_pid'):
+            _record_calls(self.docker, name, calls)
+        _record_calls(self.docker._runner, 'start', calls)
+        self.docker.start()
+        self.assertEqual(calls, ['_docker_run', 'start', '_docker_pid'])
+        # FakeCommand output is not a pid
+        self.assertEqual(self.docker.pid, 0)
+
+    def test_inspect_pid_format(self):
+        self.assertIn('--format={{.State.Pid}}',
+                      self.docker._docker_pid.cmdline())
+
+
+def _record_calls(obj, name, calls):
+    func = getattr(obj, name)
+
+    def _call(*args, **kwargs):
+        calls.append(name)
+        return func(*args, **kwargs)
+
+    setattr(obj, name, _call)
+
+
+class DockerResyncTests(testlib.TestCase):
+
+    def setUp(self):
+        self.docker = rts.docker.Docker(
+            convirt.config.environ.current(),
+            testlib.FakeRepo(),
+            rt_uuid=str(uuid.uuid4()),
+        )
+
+    def test_resync(self):
+        self.docker._docker_pid = lambda: '4242\n'
+        self.docker.resync()
+        self.assertTrue(self.docker.running)
+        self.assertEqual(self.docker.pid, 4242)
+
+    def test_resync_not_running(self):
+        # docker reports pid 0 for the stopped containers
+        self.docker._docker_pid = lambda: '0\n'
+        self.assertRaises(convirt.runner.OperationFailed, self.docker.resync)
+        self.assertFalse(self.docker.running)
+
+    def test_resync_not_found(self):
+        def _fail():
+            raise convirt.command.Failed('no such container', 1)
+
+        self.docker._docker_pid = _fail
+        self.assertRaises(convirt.runner.OperationFailed, self.docker.resync)
+        self.assertFalse(self.docker.running)
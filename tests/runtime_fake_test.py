@@ -19,15 +19,24 @@
 #
 from __future__ import absolute_import
 
+import random
 import xml.etree.ElementTree as ET
 
+import libvirt
+
 import convirt
 import convirt.config
 import convirt.config.environ
 import convirt.command
+import convirt.domain
+import convirt.doms
+import convirt.events
+import convirt.monitoring
 import convirt.runner
 import convirt.runtimes as rts
+import convirt.runtimes.fake
 
+from . import monkey
 from . import testlib
 
 
@@ -80,3 +89,186 @@ class RuntimeFakeTests(testlib.RunnableTestCase):
         )
         self.assertFalse(fake.running)
         self.assertRaises(convirt.runner.OperationFailed, fake.stop)
+
+
+class LatencyTests(testlib.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(42)
+
+    def test_fixed(self):
+        self.assertEqual(rts.fake.Latency.fixed(0.25).sample(self.rand), 0.25)
+
+    def test_uniform(self):
+        latency = rts.fake.Latency.uniform(0.1, 0.2)
+        for _ in range(100):
+            self.assertTrue(0.1 <= latency.sample(self.rand) <= 0.2)
+
+    def test_lognormal_median(self):
+        latency = rts.fake.Latency.lognormal(0.01, 1.)
+        samples = sorted(latency.sample(self.rand) for _ in range(1001))
+        self.assertAlmostEqual(samples[500], 0.01, delta=0.002)
+        self.assertTrue(samples[-1] > 0.05)  # the long tail
+
+    def test_unknown_distribution(self):
+        self.assertRaises(ValueError, rts.fake.Latency, 'pareto', 1.)
+
+
+class BehaviorTests(testlib.TestCase):
+
+    def test_default_instant_and_reliable(self):
+        behavior = rts.fake.Behavior()
+        for action in behavior.ACTIONS:
+            self.assertEqual(behavior.delay(action), 0.)
+            self.assertFalse(behavior.fails(action))
+
+    def test_failure_rate(self):
+        behavior = rts.fake.Behavior(failures={'start': 0.25}, seed=7)
+        failed = sum(behavior.fails('start') for _ in range(4000))
+        self.assertAlmostEqual(failed / 4000., 0.25, delta=0.03)
+        self.assertFalse(behavior.fails('stop'))
+
+    def test_unknown_action(self):
+        self.assertRaises(ValueError, rts.fake.Behavior,
+                          failures={'reboot': 0.5})
+
+
+class FakeBehaviorTests(testlib.RunnableTestCase):
+
+    def setUp(self):
+        super(FakeBehaviorTests, self).setUp()
+        self.delays = []
+        self._sleep = rts.fake._sleep
+        rts.fake._sleep = self.delays.append
+
+    def tearDown(self):
+        rts.fake._sleep = self._sleep
+        super(FakeBehaviorTests, self).tearDown()
+
+    def _make_fake(self, **kwargs):
+        fake = rts.fake.Fake(
+            testlib.make_conf(
+                run_dir=self.run_dir,
+                fake_behavior=rts.fake.Behavior(seed=1, **kwargs)),
+            convirt.command.Repo(),
+        )
+        fake.configure(ET.fromstring(testlib.minimal_dom_xml()))
+        return fake
+
+    def test_latency(self):
+        fake = self._make_fake(
+            latencies={'start': rts.fake.Latency.fixed(0.5)})
+        fake.start()
+        fake.stop()
+        self.assertEqual(self.delays, [0.5])
+
+    def test_start_fails(self):
+        fake = self._make_fake(failures={'start': 1.})
+        self.assertRaises(convirt.runner.OperationFailed, fake.start)
+        self.assertFalse(fake.running)
+        self.assertEqual(fake.failures['start'], 1)
+        self.assertEqual(fake.actions['start'], 1)
+
+    def test_stop_fails_keeps_running(self):
+        fake = self._make_fake(failures={'stop': 1.})
+        fake.start()
+        self.assertRaises(convirt.runner.OperationFailed, fake.stop)
+        self.assertTrue(fake.running)
+
+    def test_stats(self):
+        fake = self._make_fake()
+        self.assertIsNone(fake.stats)
+        fake.start()
+        try:
+            self.assertNotEqual(fake.pid, 0)
+            stats = fake.stats
+            stats.update()
+            self.assertEqual(stats.pid, fake.pid)
+            self.assertTrue(stats.memory.rss > 0)
+            self.assertTrue(stats.cpuacct.user >= 0)
+        finally:
+            fake.stop()
+        self.assertIsNone(fake.stats)
+        self.assertEqual(fake.pid, 0)
+
+    def test_pids_unique(self):
+        fakes = [self._make_fake() for _ in range(3)]
+        for fake in fakes:
+            fake.start()
+        self.assertEqual(len(set(fake.pid for fake in fakes)), 3)
+
+
+class StatsTests(testlib.TestCase):
+
+    def test_cpu_grows_with_time(self):
+        clock = [100.]
+        stats = rts.fake.Stats(
+            1, memory_kib=1024., load=0.5, now=lambda: clock[0])
+        stats.update()
+        self.assertEqual(stats.cpuacct.user + stats.cpuacct.system, 0)
+        clock[0] += 10.
+        stats.update()
+        # 10s at half a CPU, in USER_HZ
+        self.assertEqual(stats.cpuacct.user + stats.cpuacct.system, 500)
+        self.assertAlmostEqual(stats.memory.rss, 1024., delta=52.)
+
+
+class FakeLoadTests(testlib.RunnableTestCase):
+
+    CONTAINERS = 500
+
+    WORKERS = 20
+
+    def setUp(self):
+        super(FakeLoadTests, self).setUp()
+        convirt.doms.clear()
+        self.stopped = []
+        self.root = convirt.events.Handler(name='test')
+        self.root.register(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                           None, None, self._lifecycle)
+
+    def tearDown(self):
+        convirt.doms.clear()
+        super(FakeLoadTests, self).tearDown()
+
+    def test_many_domains(self):
+        conf = testlib.make_conf(
+            run_dir=self.run_dir,
+            fake_behavior=rts.fake.Behavior(
+                latencies={
+                    'start': rts.fake.Latency.lognormal(0.0005, 0.5),
+                    'stop': rts.fake.Latency.uniform(0., 0.0005),
+                },
+                failures={'start': 0.01},
+                seed=0,
+            ),
+        )
+        with monkey.patch_scope([(convirt.events, 'root', self.root)]):
+            started, failed = testlib.start_fake_domains(
+                conf, self.CONTAINERS, self.WORKERS)
+            self._watch(started)
+
+        self.assertEqual(len(failed) + len(self.stopped), self.CONTAINERS)
+        self.assertEqual(len(set(self.stopped)), len(self.stopped))
+        self.assertEqual(convirt.doms.get_all(), [])
+
+    def _watch(self, doms):
+        # half of the containers die behind convirt's back:
+        # the watchdog must report exactly those
+        died = doms[::2]
+        for dom in died:
+            dom._rt.stop()
+        alive = frozenset(dom.runtimeUUIDString() for dom in doms[1::2])
+        convirt.monitoring.watchdog(lambda: alive)
+        self.assertEqual(sorted(self.stopped),
+                         sorted(dom.UUIDString() for dom in died))
+        # the others are stopped through the API
+        for dom in doms[1::2]:
+            dom.destroy()
+            self.stopped.append(dom.UUIDString())
+        for dom in died:
+            convirt.doms.remove(dom.UUIDString())
+
+    def _lifecycle(self, conn, dom, event, detail):
+        if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            self.stopped.append(dom.UUIDString())
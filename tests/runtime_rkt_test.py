@@ -19,16 +19,23 @@
 #
 from __future__ import absolute_import
 
+import json
 import os.path
+import shutil
+import tempfile
+import threading
 import time
+import uuid
 import xml.etree.ElementTree as ET
 
 import convirt
 import convirt.command
 import convirt.config
 import convirt.config.environ
+import convirt.fs
 import convirt.runner
 import convirt.runtimes as rts
+import convirt.runtimes.rkt
 
 from . import monkey
 from . import testlib
@@ -88,6 +95,158 @@ class RktTests(testlib.RunnableTestCase):
         self.assertFalse(rkt.running)
         self.assertRaises(convirt.runner.OperationFailed, rkt.stop)
 
+    def test_start_stop_polling(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo()
+        )
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        with monkey.patch_scope([(convirt.fs, '_libc', None)]):
+            rkt.start()
+        try:
+            self.assertTrue(rkt.running)
+        finally:
+            rkt.stop()
+
+    def test_uuid_read_at_once(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo()
+        )
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        rkt.start()
+        try:
+            if convirt.fs.inotify_available():
+                wait = rkt.waits[0]
+                self.assertEqual(wait.what, 'read rkt UUID')
+                self.assertEqual(len(wait.attempts), 1)
+        finally:
+            rkt.stop()
+
+    def test_start_async(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo()
+        )
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        results = []
+        done = threading.Event()
+
+        def _started(error):
+            results.append(error)
+            done.set()
+
+        with monkey.patch_scope([(rkt._runner, 'start_async',
+                                  _start_now(rkt._runner, 'active'))]):
+            rkt.start_async(_started)
+        self.assertTrue(done.wait(5))
+        try:
+            self.assertEqual(results, [None])
+            self.assertTrue(rkt.running)
+        finally:
+            rkt.stop()
+
+    def test_start_async_unit_failed(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo()
+        )
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        results = []
+        done = threading.Event()
+
+        def _started(error):
+            results.append(error)
+            done.set()
+
+        with monkey.patch_scope([(rkt._runner, 'start_async',
+                                  _start_now(rkt._runner, 'failed'))]):
+            rkt.start_async(_started)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], convirt.runner.OperationFailed)
+        self.assertFalse(rkt.running)
+
+    def test_prepare_start(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo()
+        )
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        rkt.prepare()
+        self.assertTrue(rkt.prepared)
+        self.assertFalse(rkt.running)
+        rkt_uuid = rkt._prepared_uuid
+
+        rkt.start()
+        try:
+            self.assertTrue(rkt.running)
+            self.assertFalse(rkt.prepared)
+            self.assertEqual(rkt.runtime_name(), 'rkt-%s' % rkt_uuid)
+            with open(rkt._rkt_uuid_path, 'rt') as src:
+                self.assertEqual(src.read(), rkt_uuid)
+        finally:
+            rkt.stop()
+
+    def test_prepare_twice(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo()
+        )
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        rkt.prepare()
+        self.assertRaises(convirt.runner.OperationFailed, rkt.prepare)
+        rkt.teardown()
+        self.assertFalse(rkt.prepared)
+
+    def test_start_other_target_discards_prepared(self):
+        conf = testlib.make_conf(
+            run_dir=self.run_dir,
+            wait_policies={'rkt': rts.WaitPolicy(deadline=0.1)})
+        rkt = rts.rkt.Rkt(conf, testlib.FakeRepo())
+        root = ET.fromstring(testlib.minimal_dom_xml())
+        rkt.configure(root)
+        rkt._prepared_uuid = str(uuid.uuid4())
+        self.assertRaises(convirt.runner.OperationFailed,
+                          rkt.start, '/some/other/image')
+        self.assertFalse(rkt.prepared)
+        self.assertEqual(len(rkt._rkt_rm.executions), 1)
+        self.assertEqual(rkt._rkt_run_prepared.executions, [])
+
+    def test_start_prepared_fails(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir), testlib.FakeRepo())
+        rkt.configure(ET.fromstring(testlib.minimal_dom_xml()))
+        rkt_uuid = str(uuid.uuid4())
+        rkt._prepared_uuid = rkt_uuid
+
+        def _fail(**kwargs):
+            raise convirt.command.Failed('systemd-run failed', 1)
+
+        with monkey.patch_scope([(rkt._runner, 'start', _fail)]):
+            self.assertRaises(convirt.command.Failed, rkt.start)
+        self.assertFalse(rkt.prepared)
+        self.assertFalse(rkt.running)
+        argv, = rkt._rkt_rm.executions
+        self.assertIn(rkt_uuid, argv)
+        self.assertFalse(os.path.exists(rkt._rkt_uuid_path))
+
+    def test_read_uuid_empty(self):
+        rkt = rts.rkt.Rkt(
+            testlib.make_conf(run_dir=self.run_dir),
+            convirt.command.Repo(),
+            read_file=lambda path: '\n',
+        )
+        self.assertRaises(rts.NotYetReady,
+                          rkt._read_rkt_uuid, rkt._rkt_uuid_path)
+        self.assertFalse(rkt.running)
+
     def test_read_uuid_fails(self):
 
         def _fail_read(*args):
@@ -96,7 +255,10 @@ class RktTests(testlib.RunnableTestCase):
         with monkey.patch_scope([
             (time, 'sleep', lambda _: None),
         ]):
-            rkt = rts.rkt.Rkt(testlib.make_conf(run_dir=self.run_dir),
+            conf = testlib.make_conf(
+                run_dir=self.run_dir,
+                wait_policies={'rkt': rts.WaitPolicy(deadline=0.1)})
+            rkt = rts.rkt.Rkt(conf,
                               convirt.command.Repo(),
                               read_file=_fail_read)
             root = ET.fromstring(testlib.minimal_dom_xml())
@@ -117,6 +279,178 @@ class RktTests(testlib.RunnableTestCase):
             rkt.stop()
 
 
+def _start_now(runr, state):
+    """
+    Replaces Runner.start_async with a synchronous start, completing
+    the job with the given unit `state` at once.
+    """
+    def _start_async(callback=None, **kwargs):
+        if state == 'active':
+            runr.start(**kwargs)
+        job = convirt.runner.StartJob('test', runr.repo, callback)
+        job.complete(convirt.runner.UnitInfo(
+            'test.service', 0, '', state, 'running', None))
+        return job
+    return _start_async
+
+
+class FakeRktList(object):
+
+    def __init__(self, output):
+        self.output = output
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        return self.output.encode('utf-8')
+
+
+class FakeRktListRepo(object):
+
+    def __init__(self, output):
+        self.rkt_list = FakeRktList(output)
+
+    def get(self, *args, **kwargs):
+        return self.rkt_list
+
+
+class PodListTests(testlib.TestCase):
+
+    RUNNING = '5bc080ca-4f1e-4a55-8b52-6f2b3c1a9e01'
+
+    EXITED = '0b3c9e4d-7a1f-4d6e-9c2b-1e5f8a7d6c02'
+
+    def setUp(self):
+        self.repo = FakeRktListRepo(testlib.read_test_data('rkt_list.json'))
+
+    def tearDown(self):
+        rts.rkt.Rkt._pods = {}
+        rts.rkt.Rkt._pods_time = 0.
+
+    def test_list_pods(self):
+        pods = rts.rkt.Rkt.list_pods(self.repo)
+        self.assertEqual(self.repo.rkt_list.calls, 1)
+        self.assertEqual(len(pods), 3)
+        self.assertEqual(pods[self.RUNNING],
+                         rts.rkt.PodStatus('running', 4242))
+        self.assertEqual(pods[self.EXITED],
+                         rts.rkt.PodStatus('exited', 0))
+
+    def test_list_pods_empty(self):
+        self.assertEqual(rts.rkt.Rkt.list_pods(FakeRktListRepo('[]')), {})
+
+    def test_cached_pod(self):
+        rts.rkt.Rkt.list_pods(self.repo)
+        self.assertEqual(rts.rkt.Rkt._cached_pod(self.RUNNING).pid, 4242)
+
+    def test_cached_pod_expired(self):
+        rts.rkt.Rkt.list_pods(self.repo)
+        rts.rkt.Rkt._pods_time -= rts.rkt.Rkt._PODS_MAX_AGE + 1
+        self.assertIs(rts.rkt.Rkt._cached_pod(self.RUNNING), None)
+
+    def test_get_stopped(self):
+        with testlib.named_temp_dir() as tmp_dir:
+            saved = {
+                str(uuid.uuid4()): self.RUNNING,
+                str(uuid.uuid4()): self.EXITED,
+                str(uuid.uuid4()): str(uuid.uuid4()),  # garbage collected
+            }
+            for rt_uuid, rkt_uuid in saved.items():
+                path = os.path.join(tmp_dir, '%s.rkt' % rt_uuid)
+                with open(path, 'wt') as dst:
+                    dst.write(rkt_uuid)
+
+            stopped = rts.rkt.Rkt.get_stopped(
+                self.repo, testlib.make_conf(run_dir=tmp_dir))
+
+        self.assertEqual(
+            sorted(stopped),
+            sorted(rt_uuid for rt_uuid, rkt_uuid in saved.items()
+                   if rkt_uuid != self.RUNNING))
+        self.assertEqual(self.repo.rkt_list.calls, 1)
+
+    def test_fetch_state_from_snapshot(self):
+        rkt = rts.rkt.Rkt(convirt.config.environ.current(),
+                          testlib.FakeRepo())
+        rts.rkt.Rkt.list_pods(self.repo)
+        rkt._rkt_uuid = self.RUNNING
+        rkt._fetch_rkt_state()
+        self.assertEqual(rkt.pid, 4242)
+        self.assertEqual(rkt._rkt_status.executions, [])
+
+
+class ResyncTests(testlib.TestCase):
+
+    RUNNING = PodListTests.RUNNING
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self.rt_uuid = str(uuid.uuid4())
+        self.repo = testlib.FakeRepo()
+        with open(os.path.join(self.run_dir,
+                               '%s.rkt' % self.rt_uuid), 'wt') as dst:
+            dst.write(self.RUNNING)
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+        rts.rkt.Rkt._pods = {}
+        rts.rkt.Rkt._pods_time = 0.
+
+    def _make_rkt(self):
+        return rts.rkt.Rkt(testlib.make_conf(run_dir=self.run_dir),
+                           self.repo, rt_uuid=self.rt_uuid)
+
+    def _save_record(self, pid):
+        rkt = self._make_rkt()
+        rkt._rkt_uuid = self.RUNNING
+        rkt._pid = pid
+        rkt._save_record()
+
+    def test_from_record(self):
+        self._save_record(os.getpid())
+        rkt = self._make_rkt()
+        rkt.resync()
+        self.assertTrue(rkt.running)
+        self.assertEqual(rkt.runtime_name(), 'rkt-%s' % self.RUNNING)
+        self.assertEqual(rkt.pid, os.getpid())
+        self.assertEqual(rkt._rkt_status.executions, [])
+
+    def test_stale_record(self):
+        self._save_record(os.getpid())
+        record_path = os.path.join(self.run_dir, '%s.rkt.json' % self.rt_uuid)
+        with open(record_path, 'rt') as src:
+            data = json.load(src)
+        data['start_time'] += 1  # as if the pid was reused
+        with open(record_path, 'wt') as dst:
+            json.dump(data, dst)
+
+        rts.rkt.Rkt.list_pods(
+            FakeRktListRepo(testlib.read_test_data('rkt_list.json')))
+        rkt = self._make_rkt()
+        rkt.resync()
+        self.assertEqual(rkt.pid, 4242)
+        self.assertEqual(rkt._rkt_status.executions, [])
+
+    def test_record_of_dead_process(self):
+        # no start time saved, and none found: the record can't be trusted
+        self._save_record(0)
+        rts.rkt.Rkt.list_pods(
+            FakeRktListRepo(testlib.read_test_data('rkt_list.json')))
+        rkt = self._make_rkt()
+        rkt.resync()
+        self.assertEqual(rkt.pid, 4242)
+
+    def test_missing_uuid_file(self):
+        os.unlink(os.path.join(self.run_dir, '%s.rkt' % self.rt_uuid))
+        rkt = self._make_rkt()
+        self.assertRaises(convirt.runner.OperationFailed, rkt.resync)
+        self.assertFalse(rkt.running)
+
+    def test_start_time(self):
+        self.assertTrue(rts.rkt._start_time(os.getpid()))
+        self.assertIs(rts.rkt._start_time(0), None)
+
+
 class NetworkTests(testlib.TestCase):
 
     def test_path(self):
@@ -19,6 +19,10 @@
 #
 from __future__ import absolute_import
 
+import itertools
+import os
+import subprocess
+import sys
 import uuid
 import xml.etree.ElementTree as ET
 
@@ -26,9 +30,12 @@ import convirt
 import convirt.command
 import convirt.config
 import convirt.config.environ
+import convirt.runner
 import convirt.runtime
 import convirt.runtimes
+import convirt.runtimes.fake
 
+from . import monkey
 from . import testlib
 
 
@@ -55,6 +62,9 @@ class RuntimeContainerUnimplementedAPITests(testlib.TestCase):
     def test_runtime_name(self):
         self.assertRaises(NotImplementedError, self.base.runtime_name)
 
+    def test_resync(self):
+        self.assertRaises(convirt.runner.OperationFailed, self.base.resync)
+
     def test_setup_runtime(self):
         self.assertNotRaises(
             convirt.runtimes.ContainerRuntime.setup_runtime())
@@ -111,6 +121,24 @@ class RuntimeContainerConfigureTests(testlib.TestCase):
             "data": "vda",
         })  # FIXME
 
+    def test_accounting_default(self):
+        root = ET.fromstring(testlib.metadata_drive_map_dom_xml())
+        self.assertNotRaises(self.base.configure, root)
+        self.assertEquals(self.base.accounting, ('CPU', 'Memory', 'BlockIO'))
+
+    def test_accounting_from_metadata(self):
+        root = ET.fromstring(_with_accounting(
+            testlib.metadata_drive_map_dom_xml(), 'cpu+memory'))
+        self.assertNotRaises(self.base.configure, root)
+        self.assertEquals(self.base.accounting, ('CPU', 'Memory'))
+
+    def test_accounting_unknown(self):
+        root = ET.fromstring(_with_accounting(
+            testlib.metadata_drive_map_dom_xml(), 'nonexistent'))
+        self.assertRaises(convirt.runtimes.ConfigError,
+                          self.base.configure,
+                          root)
+
     def test_bridge_down(self):
         root = ET.fromstring(testlib.bridge_down_dom_xml())
         with testlib.global_conf() as conf:
@@ -243,3 +271,226 @@ class RuntimeAPITests(testlib.RunnableTestCase):
         self.assertNotRaises(convirt.runtime.teardown())
         self.assertRaises(convirt.runtime.SetupError,
                           convirt.runtime.teardown)
+
+
+class AltRuntime(convirt.runtimes.ContainerRuntime):
+
+    NAME = 'alt'
+
+    setups = 0
+
+    @classmethod
+    def setup_runtime(cls):
+        cls.setups += 1
+
+
+def register():
+    return {AltRuntime.NAME: AltRuntime}
+
+
+class RegistryTests(testlib.RunnableTestCase):
+
+    def setUp(self):
+        super(RegistryTests, self).setUp()
+        convirt.runtime.clear()
+        self.modules = convirt.runtime._modules.copy()
+        self.scanned = convirt.runtime._scanned
+        self.entry_points = convirt.runtime._entry_points
+
+    def tearDown(self):
+        convirt.runtime._entry_points = self.entry_points
+        convirt.runtime._scanned = self.scanned
+        convirt.runtime._modules = self.modules
+        convirt.runtime.clear()
+        super(RegistryTests, self).tearDown()
+
+    def test_probe_on_first_use(self):
+        self.assertEqual(convirt.runtime.supported(register=False),
+                         frozenset())
+        convirt.runtime.create('fake', testlib.make_conf(),
+                               testlib.FakeRepo())
+        self.assertEqual(convirt.runtime.supported(register=False),
+                         frozenset(['fake']))
+
+    def test_declare(self):
+        convirt.runtime.declare('alt', __name__)
+        self.assertIsInstance(
+            convirt.runtime.create('alt', testlib.make_conf(),
+                                   testlib.FakeRepo()),
+            AltRuntime)
+
+    def test_declare_missing_module(self):
+        convirt.runtime.declare('alt', 'tests.no_such_module')
+        self.assertRaises(convirt.runtime.Unsupported,
+                          convirt.runtime.create,
+                          'alt', testlib.make_conf(), testlib.FakeRepo())
+
+    def test_entry_points(self):
+        convirt.runtime._scanned = False
+        convirt.runtime._entry_points = lambda: {'alt': __name__}
+        self.assertIn('alt', convirt.runtime.supported())
+
+    def test_builtin_not_overridden(self):
+        warnings = []
+
+        def _warning(msg, *args):
+            warnings.append(msg % args)
+
+        convirt.runtime._scanned = False
+        convirt.runtime._entry_points = lambda: {'fake': __name__}
+        with monkey.patch_scope([(convirt.runtime._log, 'warning',
+                                  _warning)]):
+            self.assertIsInstance(
+                convirt.runtime.create('fake', testlib.make_conf(),
+                                       testlib.FakeRepo()),
+                convirt.runtimes.fake.Fake)
+            self.assertNotIn('alt', convirt.runtime.supported())
+        self.assertEqual(convirt.runtime._modules['fake'],
+                         'convirt.runtimes.fake')
+        self.assertEqual(warnings, [
+            "runtime 'fake' from %r already declared, ignored" % __name__,
+        ])
+
+    def test_declare_after_setup(self):
+        AltRuntime.setups = 0
+        convirt.runtime.setup()
+        try:
+            convirt.runtime.declare('alt', __name__)
+            self.assertEqual(AltRuntime.setups, 0)  # still lazy
+            convirt.runtime.create('alt', testlib.make_conf(),
+                                   testlib.FakeRepo())
+            convirt.runtime.create('alt', testlib.make_conf(),
+                                   testlib.FakeRepo())
+            self.assertEqual(AltRuntime.setups, 1)
+        finally:
+            convirt.runtime.teardown()
+
+    def test_declare_before_setup(self):
+        AltRuntime.setups = 0
+        convirt.runtime.declare('alt', __name__)
+        convirt.runtime.setup()
+        try:
+            self.assertEqual(AltRuntime.setups, 1)
+            convirt.runtime.create('alt', testlib.make_conf(),
+                                   testlib.FakeRepo())
+            self.assertEqual(AltRuntime.setups, 1)
+        finally:
+            convirt.runtime.teardown()
+
+    def test_import_does_not_load_runtimes(self):
+        loaded = _run_python(
+            'import sys, convirt; '
+            'print(sorted(m for m in sys.modules '
+            'if m.startswith("convirt.runtimes.")))')
+        self.assertEqual(loaded.strip(), '[]')
+
+    def test_create_loads_one_runtime(self):
+        loaded = _run_python(
+            'import sys, convirt, convirt.runtime, convirt.command; '
+            'convirt.runtime.create("fake", convirt.config.environ.current(),'
+            ' convirt.command.Repo()); '
+            'print(sorted(m for m in sys.modules '
+            'if m.startswith("convirt.runtimes.")))')
+        self.assertEqual(loaded.strip(), "['convirt.runtimes.fake']")
+
+
+def _run_python(code):
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=topdir)
+    return out.decode('utf-8')
+
+
+class WaitPolicyTests(testlib.TestCase):
+
+    def test_exponential(self):
+        policy = convirt.runtimes.WaitPolicy(
+            initial=0.01, factor=2., max_delay=0.05, jitter=0.)
+        delays = list(itertools.islice(policy.delays(), 5))
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.05, 0.05])
+
+    def test_jitter(self):
+        policy = convirt.runtimes.WaitPolicy(
+            initial=1., factor=1., max_delay=1., jitter=0.1)
+        low = next(policy.delays(rand=lambda: 0.))
+        high = next(policy.delays(rand=lambda: 1.))
+        self.assertAlmostEqual(low, 0.9)
+        self.assertAlmostEqual(high, 1.1)
+
+
+class RetryTests(testlib.TestCase):
+
+    def setUp(self):
+        self.base = convirt.runtimes.ContainerRuntime(
+            testlib.make_conf(wait_policies={
+                '': convirt.runtimes.WaitPolicy(
+                    initial=0.001, max_delay=0.01, deadline=0.2),
+            }),
+            testlib.FakeRepo(),
+        )
+
+    def _ready_after(self, tries):
+        calls = []
+
+        def _check():
+            calls.append(None)
+            if len(calls) < tries:
+                raise convirt.runtimes.NotYetReady()
+            return len(calls)
+
+        return _check
+
+    def test_default_policy(self):
+        base = convirt.runtimes.ContainerRuntime(
+            convirt.config.environ.current(),
+            testlib.FakeRepo(),
+        )
+        self.assertIs(base.wait_policy,
+                      convirt.runtimes.ContainerRuntime.WAIT_POLICY)
+
+    def test_ready_at_once(self):
+        self.assertEqual(
+            self.base._retry('test', self._ready_after(1)), 1)
+        wait, = self.base.waits
+        self.assertTrue(wait.ready)
+        self.assertEqual(len(wait.attempts), 1)
+
+    def test_ready_after_tries(self):
+        clock = testlib.FakeTime()
+        with monkey.patch_scope([(convirt.runtimes, 'time', clock)]):
+            self.assertEqual(
+                self.base._retry('test', self._ready_after(4)), 4)
+        # 1, 2, 4 ms, each with its jitter: much less than the old 1s
+        self.assertEqual(len(clock.sleeps), 3)
+        self.assertEqual(clock.sleeps, sorted(clock.sleeps))
+        policy = self.base.wait_policy
+        for delay in clock.sleeps:
+            self.assertLessEqual(delay,
+                                 policy.max_delay * (1. + policy.jitter))
+        wait, = self.base.waits
+        self.assertTrue(wait.ready)
+        self.assertEqual(wait.what, 'test')
+        self.assertEqual(len(wait.attempts), 4)
+        self.assertEqual(list(wait.attempts), sorted(wait.attempts))
+        self.assertEqual(wait.elapsed, wait.attempts[-1])
+
+    def test_deadline(self):
+        clock = testlib.FakeTime()
+        with monkey.patch_scope([
+            (convirt.runtimes, 'time', clock),
+            (convirt.runtimes.command, 'monotonic_time',
+             clock.monotonic_time),
+        ]):
+            self.assertRaises(convirt.runner.OperationFailed,
+                              self.base._retry,
+                              'test', self._ready_after(10000))
+        wait, = self.base.waits
+        self.assertFalse(wait.ready)
+        # the last sleep is cut short to end right at the deadline
+        self.assertAlmostEqual(wait.elapsed, 0.2)
+        self.assertAlmostEqual(sum(clock.sleeps), 0.2)
+
+
+def _with_accounting(xml_data, profile):
+    return xml_data.replace(
+        '<convirt:container ',
+        '<convirt:container accounting="%s" ' % profile)
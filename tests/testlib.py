@@ -27,13 +27,16 @@ import os.path
 import shutil
 import tarfile
 import tempfile
+import threading
 import uuid
 import unittest
 
 import convirt.command
 import convirt.config
 import convirt.config.environ
+import convirt.domain
 import convirt.metrics.cgroups
+import convirt.runner
 import convirt.runtime
 import convirt.runtimes
 from convirt.runtimes import fake
@@ -206,6 +209,7 @@ class FakeRunner(object):
         self.teardown_done = False
         self.configured = False
         self.resynced = False
+        self.prepared = False
         self.uuid = '00000000-0000-0000-0000-000000000000'
 
     def setup(self, *args, **kwargs):
@@ -220,6 +224,9 @@ class FakeRunner(object):
     def resync(self):
         self.resynced = True
 
+    def prepare(self, *args, **kwargs):
+        self.prepared = True
+
     def stop(self):
         self.stopped = True
 
@@ -227,12 +234,73 @@ class FakeRunner(object):
         self.configured = True
 
 
+class FakeTime(object):
+    """
+    Records the sleeps instead of doing them; the clock only moves
+    when something sleeps.
+    """
+
+    def __init__(self):
+        self.sleeps = []
+        self.now = 0.
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def monotonic_time(self):
+        return self.now
+
+
 def minimal_dom_xml(vm_uuid=None):
     data = read_test_data('minimal_dom.xml')
     vm_uuid = str(uuid.uuid4()) if vm_uuid is None else vm_uuid
     return data.format(vm_uuid=vm_uuid)
 
 
+def fake_dom_xml(vm_uuid=None):
+    # like minimal_dom_xml, but for the fake runtime
+    return minimal_dom_xml(vm_uuid).replace(
+        '>rkt</convirt:container>', '>fake</convirt:container>')
+
+
+def start_fake_domains(conf, count, workers):
+    """
+    Creates `count` fake domains from `workers` threads, through the
+    runtime registry and Domain. Returns the domains which started,
+    and the failures of the others.
+    """
+    repo = convirt.command.Repo()
+    started = []
+    failed = []
+    lock = threading.Lock()
+
+    def _work(num):
+        for _ in range(num):
+            try:
+                dom = convirt.domain.Domain.create(
+                    fake_dom_xml(), conf, repo)
+            except convirt.runner.OperationFailed as exc:
+                with lock:
+                    failed.append(exc)
+            else:
+                dom._rt.stats.update()
+                with lock:
+                    started.append(dom)
+
+    threads = [
+        threading.Thread(target=_work,
+                         args=(count // workers +
+                               (1 if i < count % workers else 0),))
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return started, failed
+
+
 def full_dom_xml(vm_uuid=None):
     data = read_test_data('full_dom.xml')
     vm_uuid = str(uuid.uuid4()) if vm_uuid is None else vm_uuid